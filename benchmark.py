@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from lumen.AsyncLumenAPIManager import AsyncLumenAPIManager
+from lumen.CacheBackend import DirectoryCache, SQLiteCache
+from lumen.CrawlCluster import CrawlCoordinator
+from lumen.CrawlJob import CrawlJob
+from lumen.Export import export_cache, pa
+from lumen.LumenAPIManager import LumenAPIManager
+from lumen.MockLumenServer import (FIRST_NOTICE, NOTICE_INTERVAL,
+                                   MockLumenServer, synthetic_notice)
+from lumen.PaginatedSearchQuery import PaginatedSearchQuery
+from lumen.RateLimiter import TokenBucket
+from lumen.Retry import AdaptiveConcurrency, RetryPolicy
+from lumen.SearchResult import load_all_cache_entries, notice_from_data
+
+# Runs every benchmark against a MockLumenServer, so no API key or network is
+# needed. Save the results with --save and compare later runs against them
+# with --baseline to catch performance regressions.
+#
+# By default the server runs in this process, so it fights the client for the
+# GIL and concurrent benchmarks come out slower than they should. For more
+# realistic numbers, run `python -m lumen.MockLumenServer` separately and pass
+# --url http://127.0.0.1:8000.
+
+
+class Result:
+    """How long each of `count` operations took."""
+
+    def __init__(self, name: str, latencies: List[float], elapsed: float):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.elapsed = elapsed
+
+    @property
+    def throughput(self) -> float:
+        return len(self.latencies) / self.elapsed
+
+    def percentile(self, p: float) -> float:
+        return self.latencies[min(
+            len(self.latencies) - 1, int(p / 100 * len(self.latencies)))]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": len(self.latencies),
+            "throughput": self.throughput,
+            "mean": statistics.fmean(self.latencies),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+def timed(name: str, calls: List[Callable[[], Any]]) -> Result:
+    latencies = []
+    start = time.perf_counter()
+    for call in calls:
+        call_start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - call_start)
+    return Result(name, latencies, time.perf_counter() - start)
+
+
+async def timed_async(name: str, calls: List[Callable[[], Any]]) -> Result:
+    latencies = []
+
+    async def run(call: Callable[[], Any]) -> None:
+        call_start = time.perf_counter()
+        await call()
+        latencies.append(time.perf_counter() - call_start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(call) for call in calls))
+    return Result(name, latencies, time.perf_counter() - start)
+
+
+def unlimited() -> TokenBucket:
+    # The mock server is what rate limits (if asked to), not the client
+    return TokenBucket(rate=1e9, burst=1_000_000)
+
+
+def sync_manager(url: str, cache=None) -> LumenAPIManager:
+    return LumenAPIManager("benchmark",
+                           cache=cache,
+                           rate_limiter=unlimited(),
+                           retry=RetryPolicy(base_delay=0.1),
+                           memory_cache_size=0,
+                           base_url=url)
+
+
+def async_manager(url: str,
+                  cache=None,
+                  concurrency: int = 16) -> AsyncLumenAPIManager:
+    return AsyncLumenAPIManager("benchmark",
+                                cache=cache,
+                                rate_limiter=unlimited(),
+                                retry=RetryPolicy(base_delay=0.1),
+                                concurrency=AdaptiveConcurrency(
+                                    initial=concurrency, maximum=concurrency),
+                                memory_cache_size=0,
+                                base_url=url)
+
+
+def crawl_cluster(url: str, pages: int, per_page: int, workdir: Path) -> None:
+    """Crawl about pages pages with a CrawlCoordinator and two worker
+    processes, failing unless every page is done."""
+    end = FIRST_NOTICE + NOTICE_INTERVAL * pages * per_page
+
+    async def crawl() -> None:
+        async with async_manager(url, workdir / "crawl_cache") as api:
+            with CrawlJob(api, workdir / "crawl.sqlite",
+                          per_page=per_page) as job:
+                job.add_specs([{
+                    "start": FIRST_NOTICE.date().isoformat(),
+                    "end": end.date().isoformat()
+                }])
+                progress = await CrawlCoordinator(job).run(
+                    processes=2,
+                    api_key="benchmark",
+                    cache=workdir / "crawl_cache",
+                    store=workdir / "crawl_notices.sqlite")
+        if progress.failed or progress.pending:
+            raise Exception(f"The crawl didn't finish: {progress}")
+
+    asyncio.run(crawl())
+
+
+def run_benchmarks(url: str, n: int, pages: int, per_page: int,
+                   workdir: Path) -> List[Result]:
+    results = []
+    ids = range(1, n + 1)
+
+    with sync_manager(url) as api:
+        results.append(
+            timed("sync get_notice",
+                  [lambda id=id: api.get_notice(id) for id in ids]))
+
+    async def async_benchmarks() -> List[Result]:
+        async with async_manager(url) as api:
+            notices = await timed_async(
+                "async get_notice",
+                [lambda id=id: api.get_notice(id) for id in ids])
+        async with async_manager(url) as api:
+            query = PaginatedSearchQuery(api).with_amount_per_page(
+                per_page).with_page_range(1, pages)
+            paginated = await timed_async("PaginatedSearchQuery.search",
+                                          [query.search])
+        return [notices, paginated]
+
+    results.extend(asyncio.run(async_benchmarks()))
+
+    for name, cache in (("directory", DirectoryCache(workdir / "cache")),
+                        ("sqlite", SQLiteCache(workdir / "cache.sqlite"))):
+        with sync_manager(url, cache) as api:
+            results.append(
+                timed(f"{name} cache miss",
+                      [lambda id=id: api.get_notice(id) for id in ids]))
+            results.append(
+                timed(f"{name} cache hit",
+                      [lambda id=id: api.get_notice(id) for id in ids]))
+
+    data = [synthetic_notice(id) for id in ids]
+    results.append(
+        timed("notice_from_data",
+              [lambda notice=notice: notice_from_data(notice)
+               for notice in data]))
+
+    # Fill a cache with search pages to load back
+    cache = DirectoryCache(workdir / "search_cache")
+
+    async def fill_cache() -> None:
+        async with async_manager(url, cache) as api:
+            await PaginatedSearchQuery(api).with_amount_per_page(
+                per_page).with_page_range(1, pages).search()
+
+    asyncio.run(fill_cache())
+    results.append(
+        timed("load_all_cache_entries",
+              [lambda: load_all_cache_entries(workdir / "search_cache")]))
+    results.append(
+        timed("load_all_cache_entries parallel", [
+            lambda: load_all_cache_entries(workdir / "search_cache",
+                                           parallel=True)
+        ]))
+    exports = ["ndjson"] + (["parquet"] if pa is not None else [])
+    for suffix in exports:
+        results.append(
+            timed(f"export {suffix}", [
+                lambda suffix=suffix: export_cache(
+                    workdir / "search_cache", workdir / f"export.{suffix}")
+            ]))
+    results.append(
+        timed("crawl cluster",
+              [lambda: crawl_cluster(url, pages, per_page, workdir)]))
+    return results
+
+
+def compare(results: Dict[str, Dict[str, Any]],
+            baseline: Dict[str, Dict[str, Any]], tolerance: float) -> bool:
+    """Print how throughput changed since the baseline, returning False if
+    anything got slower by more than tolerance."""
+    ok = True
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result["throughput"] / baseline[name]["throughput"] - 1
+        regressed = change < -tolerance
+        ok = ok and not regressed
+        print(f"{name:36} {change:+8.1%}{'  REGRESSED' if regressed else ''}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the library against a local mock Lumen.")
+    parser.add_argument("-n",
+                        type=int,
+                        default=500,
+                        help="notices to fetch per benchmark")
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--per-page", type=int, default=100)
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0,
+                        help="seconds the mock server takes per response")
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--rate-limit",
+                        type=float,
+                        help="requests per second before the server 429s")
+    parser.add_argument("--throttle-probability", type=float, default=0)
+    parser.add_argument("--url", help="use an already running mock server")
+    parser.add_argument("--save", type=Path, help="save results as JSON")
+    parser.add_argument("--baseline",
+                        type=Path,
+                        help="compare against results saved with --save")
+    parser.add_argument("--tolerance",
+                        type=float,
+                        default=0.2,
+                        help="slowdown allowed before failing, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.url:
+            results = run_benchmarks(args.url, args.n, args.pages,
+                                     args.per_page, Path(workdir))
+        else:
+            with MockLumenServer(
+                    latency=args.latency,
+                    jitter=args.jitter,
+                    rate_limit=args.rate_limit,
+                    throttle_probability=args.throttle_probability,
+                    retry_after=0.1) as server:
+                results = run_benchmarks(server.url, args.n, args.pages,
+                                         args.per_page, Path(workdir))
+                print(f"{server.requests} requests to the mock server, "
+                      f"{server.throttled} throttled, "
+                      f"{server.bytes_sent} bytes\n")
+
+    print(f"{'benchmark':36} {'ops/s':>10} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9}")
+    summary = {}
+    for result in results:
+        summary[result.name] = result.to_dict()
+        print(f"{result.name:36} {result.throughput:10.1f} "
+              f"{result.percentile(50) * 1000:9.2f} "
+              f"{result.percentile(95) * 1000:9.2f} "
+              f"{result.percentile(99) * 1000:9.2f}")
+
+    if args.save:
+        args.save.write_text(json.dumps(summary, indent=2))
+    if args.baseline:
+        print()
+        if not compare(summary, json.loads(args.baseline.read_text()),
+                       args.tolerance):
+            sys.exit(1)
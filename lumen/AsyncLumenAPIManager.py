@@ -1,25 +1,93 @@
-import json
+import asyncio
 import logging
-from hashlib import sha256
+import time
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Union
 
 import httpx
 
+from lumen.CacheBackend import (CacheBackend, cache_key, canonical_params,
+                                open_cache)
+from lumen.CachePolicy import EXPIRED, FRESH, STALE, CachePolicy
+from lumen.Codec import loads
+from lumen.HTTPClient import (DEFAULT_LIMITS, DEFAULT_TIMEOUT, ConnectionTrace,
+                               async_client)
+from lumen.Metrics import Hooks, endpoint_of
+from lumen.NoticeBatch import NoticeBatch, NoticeFetch
+from lumen.NoticeStore import NoticeStore
+from lumen.RateLimiter import TokenBucket
+from lumen.Retry import AdaptiveConcurrency, CircuitBreaker, RetryPolicy
+from lumen.StreamParser import StreamParser
+
+
+def _size(req: httpx.Response) -> int:
+    if req.is_stream_consumed:
+        return len(req.content)
+    return int(req.headers.get("Content-Length", 0))
+
 
 class AsyncLumenAPIManager:
     """Manage requests to the Lumen database and timing requests."""
 
-    def __init__(self, api_key: str, cache: Optional[Path] = Path("cache")):
-        headers = {
-            "User-Agent": "CSE291BResearch",
-            "X-Authentication-Token": api_key,
-            "Accept-Encoding": "gzip"
-        }
-        self.session = httpx.AsyncClient(headers=headers, timeout=None)
-        self.cache = cache
-        if self.cache:
-            self.cache.mkdir(exist_ok=True)
+    def __init__(self,
+                 api_key: str,
+                 cache: Optional[Union[Path, CacheBackend]] = Path("cache"),
+                 rate_limiter: Optional[TokenBucket] = None,
+                 retry: RetryPolicy = RetryPolicy(),
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 concurrency: Optional[AdaptiveConcurrency] = None,
+                 memory_cache_size: int = 32,
+                 hooks: Optional[Hooks] = None,
+                 base_url: str = "https://lumendatabase.org",
+                 client: Optional[httpx.AsyncClient] = None,
+                 http2: bool = False,
+                 limits: httpx.Limits = DEFAULT_LIMITS,
+                 http_timeout: httpx.Timeout = DEFAULT_TIMEOUT,
+                 store: Optional[NoticeStore] = None,
+                 cache_policy: Optional[CachePolicy] = None):
+        """By default, requests are limited to one every 2 seconds. To share a
+        limit between several managers, pass them the same rate_limiter (a
+        SharedTokenBucket also works across processes).
+
+        Failed requests (429s, 5xxs and connection errors) are retried
+        according to retry, and too many failures in a row trip the
+        circuit_breaker. concurrency limits how many requests are in flight,
+        backing off when Lumen rate limits us.
+
+        The memory_cache_size most recently used responses are also kept in
+        memory, up to 64 MB of them and none bigger than 16 MB (set it to 0
+        to turn that off).
+
+        hooks are told about every request, cache lookup and sleep, pass a
+        MetricsRecorder to see where time goes. base_url is where Lumen lives,
+        point it at a MockLumenServer to try things out offline.
+
+        Requests go over a pool of up to limits connections (over one
+        connection with http2), giving up on ones that hang for longer than
+        http_timeout. To share one pool between several managers, make a
+        client with HTTPClient.async_client and pass it to each of them.
+
+        get_notice looks in store first, if given, see NoticeStore.
+
+        Cached responses are kept forever, unless cache_policy gives their
+        endpoint or query a TTL. Stale responses are returned straight away
+        and refreshed in the background."""
+        self.headers = {"X-Authentication-Token": api_key}
+        # A shared client is closed by whoever made it, not by us
+        self._owns_session = client is None
+        self.session = client or async_client(http2, limits, http_timeout)
+        self.cache = open_cache(cache, memory_cache_size)
+        # Requests being made right now, so identical requests can share them
+        self._in_flight: Dict[str, asyncio.Future[Dict[str, Any]]] = {}
+        self.rate_limiter = rate_limiter or TokenBucket(rate=1 / 2)
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        self.hooks = hooks or Hooks()
+        self.base_url = base_url
+        self.store = store
+        self.cache_policy = cache_policy or CachePolicy()
 
     async def __aenter__(self):
         """Start the session using a with-context block."""
@@ -31,13 +99,56 @@ class AsyncLumenAPIManager:
 
     async def close(self):
         """Close the requests session."""
-        await self.session.aclose()
+        # Background refreshes can't finish without the session
+        for request in list(self._in_flight.values()):
+            request.cancel()
+        if self._owns_session:
+            await self.session.aclose()
+        if self.cache:
+            self.cache.close()
+
+    async def warm_up(self, connections: int = 4) -> None:
+        """Open connections to Lumen ahead of time, so the first requests of
+        a crawl don't each wait on a handshake. This only HEADs the home page,
+        so it doesn't use up any API requests."""
+
+        async def connect() -> None:
+            connection = ConnectionTrace()
+            await self.session.head(self.base_url + "/",
+                                    extensions={"trace": connection.atrace})
+            self.hooks.on_connection("warm_up", connection.new,
+                                     connection.seconds)
+
+        await asyncio.gather(*(connect() for _ in range(connections)))
 
     async def get_notice(self, id: int) -> Dict[str, Any]:
         """Return a JSON-encoded representation of selected notice attributes.
         Notice Types will have mapped attributes applied, and be under a root
-        key articulating their type."""
-        return await self._req(f"/notices/{id}.json")
+        key articulating their type.
+
+        With a store, notices in it are served from there without a request,
+        and fetched notices are added to it."""
+        if self.store is not None:
+            stored = self.store.get_response(id)
+            if stored is not None:
+                logging.info("Store hit on notice %s", id)
+                return stored
+        data = await self._req(f"/notices/{id}.json")
+        if self.store is not None:
+            self.store.add_response(data)
+        return data
+
+    def get_notices(self,
+                    ids: Iterable[int],
+                    ordered: bool = True,
+                    concurrency: int = 32,
+                    checkpoint: Optional[Path] = None
+                    ) -> AsyncIterator[NoticeFetch]:
+        """Fetch many notices concurrently, yielding a parsed NoticeFetch for
+        each id (in order of ids, or as they finish if ordered is False).
+        Errors are yielded rather than raised. To resume a batch later, pass
+        a checkpoint file, or use NoticeBatch directly."""
+        return NoticeBatch(self, ids, concurrency, checkpoint).run(ordered)
 
     async def get_topics(self) -> List[Any]:
         """Return a JSON-encoded array of topics, including an id, name, and
@@ -61,38 +172,230 @@ class AsyncLumenAPIManager:
 
     async def _req(self,
                    path: str,
-                   params: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
-        """Make a request on the path on the lumen database (or load from cache)."""
-        key = {}
-        if params:
-            key.update(params)
-        key['path'] = path
-        hash_key = sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+                   params: Optional[Dict[str, str]] = None,
+                   refresh: bool = False) -> Dict[str, Any]:
+        """Make a request on the path on the lumen database (or load from cache).
+        Params are canonicalized first, so equivalent requests share an entry,
+        and if the same request is already being made, wait for that one
+        instead of making it twice. With refresh set, the cache is skipped
+        (but still updated)."""
+        params = canonical_params(path, params)
+        cached = None if refresh else self._load_cached(path, params)
+        if cached is not None:
+            return cached
+
+        _, hash_key = cache_key(path, params)
+        request = self._in_flight.get(hash_key)
+        if request is None:
+            request = self._start_fetch(path, params, hash_key)
+        else:
+            logging.info("Joining in-flight request for %s with %s", path,
+                         params)
+
+        # Shielded so one caller being cancelled doesn't cancel the request
+        # for everyone else waiting on it
+        return await asyncio.shield(request)
 
+    def _start_fetch(self, path: str, params: Dict[str, str],
+                     hash_key: str) -> "asyncio.Future[Dict[str, Any]]":
+        """Start fetching a request in the background, registered as in
+        flight so identical requests join it."""
+        request = asyncio.ensure_future(self._fetch(path, params))
+        self._in_flight[hash_key] = request
+
+        def finished(request: asyncio.Future[Dict[str, Any]]) -> None:
+            del self._in_flight[hash_key]
+            if not request.cancelled():
+                # Mark the exception as seen, each waiter gets it raised
+                request.exception()
+
+        request.add_done_callback(finished)
+        return request
+
+    def _revalidate(self, path: str, params: Dict[str, str],
+                    hash_key: str) -> None:
+        """Refresh a stale cached response in the background, unless it's
+        already being fetched."""
+        if hash_key in self._in_flight:
+            return
+        logging.info("Refreshing stale %s with %s in the background", path,
+                     params)
+
+        def failed(request: asyncio.Future[Dict[str, Any]]) -> None:
+            if not request.cancelled() and request.exception() is not None:
+                logging.warning("Refreshing %s with %s failed: %r", path,
+                                params, request.exception())
+
+        self._start_fetch(path, params, hash_key).add_done_callback(failed)
+
+    async def _stream(self,
+                      path: str,
+                      params: Optional[Dict[str, str]] = None,
+                      key: str = "notices") -> AsyncIterator[Any]:
+        """Like _req, but yield the items of the response's `key` array one at
+        a time as they're downloaded, so only one item is ever decoded at
+        once however big the response is. The raw response is written to the
+        cache as it arrives, and only kept if it all arrives. Unlike _req,
+        identical requests in flight aren't shared."""
+        params = canonical_params(path, params)
+        cached = self._load_cached(path, params)
+        if cached is not None:
+            for item in cached[key]:
+                yield item
+            return
+
+        cache_entry, hash_key = cache_key(path, params)
+        req = await self._get_with_retries(path, params, stream=True)
+        parser = StreamParser(key)
+        decoding = 0.0
+        try:
+            with (self.cache.writer(hash_key, cache_entry) if self.cache else
+                  nullcontext(lambda chunk: None)) as write:
+                async for chunk in req.aiter_bytes():
+                    write(chunk)
+                    start = time.perf_counter()
+                    items = parser.feed(chunk)
+                    decoding += time.perf_counter() - start
+                    for item in items:
+                        yield item
+                start = time.perf_counter()
+                items = parser.close()
+                decoding += time.perf_counter() - start
+                for item in items:
+                    yield item
+        finally:
+            await req.aclose()
         if self.cache:
-            # Try loading from cache
-            cache_path = self.cache / f"{hash_key}.json"
-            try:
-                with cache_path.open() as input:
-                    logging.info(
-                        f"Cache hit on {path} with {params} at {cache_path}")
-                    return json.load(input)
-            except FileNotFoundError:
-                # File was not found, continue to make api request
-                pass
-
-        logging.info(f"Requesting {path} with params {params}")
-        req = await self.session.get("https://lumendatabase.org" + path,
-                                     params=params)
-        req.raise_for_status()  # Raises exception on error
-        req_json = req.json()
+            logging.info("Cached stream at %s in %s", hash_key, self.cache)
+        self.hooks.on_decode(endpoint_of(path), decoding)
+
+    def _load_cached(
+            self,
+            path: str,
+            params: Optional[Dict[str, str]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Return the cached response for a request, or None if it isn't
+        cached (or has expired). A stale response is returned, and refreshed
+        in the background. Doesn't wait on the network or the rate limiter."""
+        if not self.cache:
+            return None
+
+        _, hash_key = cache_key(path, params)
+        start = time.perf_counter()
+        cached = self.cache.lookup(hash_key)
+        state = FRESH
+        if cached is not None:
+            state = self.cache_policy.state(self.cache, hash_key, path,
+                                            params)
+            if state == EXPIRED:
+                cached = None
+        self.hooks.on_cache(endpoint_of(path), cached is not None,
+                            time.perf_counter() - start)
+        if cached is not None:
+            self.cache.touch(hash_key)
+            logging.info("Cache hit on %s with %s at %s", path, params,
+                         hash_key)
+            if state == STALE:
+                self._revalidate(path, canonical_params(path, params),
+                                 hash_key)
+        return cached
+
+    async def _fetch(self,
+                     path: str,
+                     params: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """Request the path from the lumen database (waiting on the rate
+        limiter first, and retrying if it fails) and cache the response."""
+        key, hash_key = cache_key(path, params)
+        req = await self._get_with_retries(path, params)
+        start = time.perf_counter()
+        req_json = loads(req.content)
+        self.hooks.on_decode(endpoint_of(path), time.perf_counter() - start)
 
         # Save to cache
         if self.cache:
-            with cache_path.open("w+") as output:
-                logging.info(f"Caching at {cache_path}")
-                json.dump(req_json, output)
-            with (self.cache / f"{hash_key}.metadata").open("w+") as output:
-                json.dump(key, output, sort_keys=True, indent=2)
+            logging.info("Caching at %s in %s", hash_key, self.cache)
+            self.cache.put(hash_key, key, req_json)
 
         return req_json
+
+    async def _get_with_retries(self,
+                                path: str,
+                                params: Optional[Dict[str, str]] = None,
+                                stream: bool = False) -> httpx.Response:
+        """Make the request, retrying with backoff on 429s, server errors and
+        connection errors. Raises once the retries run out. With stream set,
+        the response is returned as soon as its headers arrive, and the caller
+        has to read and close it."""
+        for attempt in range(self.retry.max_attempts):
+            last_attempt = attempt == self.retry.max_attempts - 1
+            self.circuit_breaker.check()
+
+            slept = await self.rate_limiter.acquire_async()
+            if slept:
+                self.hooks.on_wait(slept)
+                logging.info("Slept for %.2f seconds", slept)
+
+            async with self.concurrency:
+                logging.info("Requesting %s with params %s", path, params)
+                connection = ConnectionTrace()
+                request = self.session.build_request(
+                    "GET",
+                    self.base_url + path,
+                    params=params,
+                    headers=self.headers,
+                    extensions={"trace": connection.atrace})
+                start = time.perf_counter()
+                try:
+                    req = await self.session.send(request, stream=stream)
+                except httpx.TransportError as e:
+                    self._record(path, start, connection)
+                    self.circuit_breaker.record_failure()
+                    if last_attempt:
+                        raise
+                    delay = self.retry.delay(attempt)
+                    logging.warning(
+                        "Request for %s failed (%r), retrying in %.1f seconds",
+                        path, e, delay)
+                else:
+                    self._record(path, start, connection, req)
+                    if req.is_error:
+                        # Nothing wants an error's body, free the connection
+                        await req.aclose()
+                    if req.status_code not in self.retry.statuses:
+                        # Lumen answered, even if it's an error, so it's up
+                        self.circuit_breaker.record_success()
+                        req.raise_for_status()  # Raises exception on error
+                        self.concurrency.on_success()
+                        return req
+
+                    if req.status_code == 429:
+                        # Lumen is fine, we're just going too fast
+                        self.circuit_breaker.record_success()
+                        self.concurrency.on_throttle()
+                    else:
+                        self.circuit_breaker.record_failure()
+                    if last_attempt:
+                        req.raise_for_status()
+                    delay = self.retry.delay(attempt, req)
+                    logging.warning(
+                        "Got %s for %s, retrying in %.1f seconds",
+                        req.status_code, path, delay)
+
+            await asyncio.sleep(delay)
+
+        raise Exception("Retry policy needs at least one attempt!")
+
+    def _record(self,
+                path: str,
+                start: float,
+                connection: ConnectionTrace,
+                req: Optional[httpx.Response] = None) -> None:
+        """Tell the hooks about a request that started at start (req is None
+        if it failed without a response). A streamed response is recorded
+        when its headers arrive, with the size it says it'll be."""
+        endpoint = endpoint_of(path)
+        self.hooks.on_request(endpoint,
+                              time.perf_counter() - start,
+                              _size(req) if req else 0,
+                              req.status_code if req else 0)
+        self.hooks.on_connection(endpoint, connection.new, connection.seconds)
@@ -0,0 +1,863 @@
+import argparse
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from hashlib import sha256
+from pathlib import Path
+from typing import (Any, Callable, Dict, Iterator, List, NamedTuple,
+                    Optional, Set, Tuple, Union)
+
+from lumen.Codec import CacheCodec, loads, train_dictionary
+
+
+# Bumped whenever canonical_params changes, so entries keyed the old way get
+# new hashes (rekey_cache moves them over). Version 1 hashed params as given,
+# version 2 also folded case and spacing in topics and names, version 3 only
+# did that for the full text search but dropped leading zeros from every
+# number (so a title of 007 became 7)
+KEY_VERSION = 4
+# Params searched as full text, where case and spacing don't change the
+# results. Others (topics, names...) are matched as given, and some topics
+# even have spaces at the ends
+TEXT_PARAMS = frozenset({"term"})
+# Params Lumen reads as numbers, where leading zeros don't matter. Any other
+# param that happens to be digits (a title, a tag...) is text
+NUMBER_PARAMS = frozenset({"page", "per_page"})
+# What Lumen does when a param isn't given, so giving it changes nothing
+DEFAULT_PARAMS = {
+    "/notices/search.json": {
+        "page": "1",
+        "sort_by": "relevancy desc"
+    },
+    "/entities/search.json": {
+        "page": "1"
+    },
+}
+# Hits are written out this often, rather than on every one
+USAGE_FLUSH_EVERY = 1000
+
+
+def canonical_params(path: str,
+                     params: Optional[Dict[str, str]] = None
+                     ) -> Dict[str, str]:
+    """The params of a request in a standard form, so requests that ask Lumen
+    for the same thing have the same params: enums become their values,
+    spacing in the full text search is tidied up and it's lowercased, page
+    numbers lose leading zeros, and params set to their default (like page 1,
+    or require-all false) are left out. Everything else is kept as given.
+    These are the params sent to Lumen, so nothing that could change the
+    results is touched."""
+    defaults = DEFAULT_PARAMS.get(path, {})
+    canonical = {}
+    for name, value in (params or {}).items():
+        value = str(value)
+        if name in TEXT_PARAMS:
+            value = " ".join(value.split()).lower()
+        elif name.endswith("-require-all"):
+            value = value.strip().lower()
+        elif name in NUMBER_PARAMS and value.isdigit():
+            value = str(int(value))
+        if value == defaults.get(name) or (name.endswith("-require-all")
+                                           and value == "false"):
+            continue
+        canonical[name] = value
+    return canonical
+
+
+def cache_key(path: str,
+              params: Optional[Dict[str, str]] = None
+              ) -> Tuple[Dict[str, str], str]:
+    """Build the cache key for a request, returning both the key itself (the
+    canonical params plus the path) and its sha256 hash."""
+    key = canonical_params(path, params)
+    key['path'] = path
+    hash_key = sha256(
+        json.dumps(dict(key, key_version=KEY_VERSION),
+                   sort_keys=True).encode()).hexdigest()
+    return key, hash_key
+
+
+class EntryStats(NamedTuple):
+    """What gc_cache needs to know about an entry, without reading it."""
+    hash_key: str
+    # Bytes on disk
+    size: int
+    # When it was cached and last hit, in seconds since the epoch
+    created: float
+    accessed: float
+    hits: int
+
+
+class _Usage:
+    """Hits on entries since they were last written out. Safe to count from
+    several threads."""
+
+    def __init__(self) -> None:
+        self.pending: Dict[str, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def touch(self, hash_key: str) -> bool:
+        """Count a hit, returning whether it's time to write them out."""
+        with self._lock:
+            usage = self.pending.setdefault(hash_key, [0.0, 0])
+            usage[0] = time.time()
+            usage[1] += 1
+            return len(self.pending) >= USAGE_FLUSH_EVERY
+
+    def take(self) -> List[Tuple[float, int, str]]:
+        with self._lock:
+            rows = [(accessed, hits, hash_key)
+                    for hash_key, (accessed, hits) in self.pending.items()]
+            self.pending.clear()
+        return rows
+
+
+class CacheBackend:
+    """Where the API managers store responses. Entries are addressed by the
+    hash from cache_key, and also keep the key they were made from so we know
+    what request they came from."""
+
+    def get(self, hash_key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached response, or None if it isn't cached."""
+        raise NotImplementedError
+
+    def lookup(self, hash_key: str) -> Optional[Dict[str, Any]]:
+        """Like get, but an entry that can't be decoded (cut short, or
+        compressed with a dictionary we don't have) is a miss instead of an
+        error, so it's just requested again."""
+        try:
+            return self.get(hash_key)
+        except Exception as e:
+            logging.warning("Couldn't decode cache entry %s, ignoring it: %r",
+                            hash_key, e)
+            return None
+
+    def put(self, hash_key: str, key: Dict[str, str],
+            data: Dict[str, Any]) -> None:
+        """Store a response along with the key it was requested with."""
+        raise NotImplementedError
+
+    @contextmanager
+    def writer(self, hash_key: str,
+               key: Dict[str, str]) -> Iterator[Callable[[bytes], None]]:
+        """Store a response's JSON as it's downloaded, without decoding and
+        re-encoding it: call the function this gives with each chunk. The
+        entry is only stored if the block finishes without an exception.
+
+        By default the chunks are gathered up and decoded for put, backends
+        that can write them as they come do so instead."""
+        chunks: List[bytes] = []
+        yield chunks.append
+        self.put(hash_key, key, loads(b"".join(chunks)))
+
+    def delete(self, hash_key: str) -> None:
+        """Remove an entry, doing nothing if it isn't cached."""
+        raise NotImplementedError
+
+    def keys(self) -> Iterator[str]:
+        """Iterate over the hashes of every cached entry."""
+        raise NotImplementedError
+
+    def metadata(self, hash_key: str) -> Optional[Dict[str, str]]:
+        """Return the key an entry was stored with, if we have it."""
+        raise NotImplementedError
+
+    def created(self, hash_key: str) -> Optional[float]:
+        """When an entry was cached (in seconds since the epoch), or None if
+        it isn't cached or the backend doesn't know. Entries of unknown age
+        never expire."""
+        return None
+
+    def touch(self, hash_key: str) -> None:
+        """Note that an entry was used, for eviction. The managers call this
+        on cache hits, so bulk reads like items() don't count."""
+        pass
+
+    def stats(self) -> Iterator[EntryStats]:
+        """Iterate over the size, age and use of every entry."""
+        raise NotImplementedError
+
+    def compact(self) -> None:
+        """Reclaim space left behind by deleted entries."""
+        pass
+
+    def __contains__(self, hash_key: str) -> bool:
+        return self.get(hash_key) is not None
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Iterate over every (hash, response) pair in the cache."""
+        for hash_key in self.keys():
+            data = self.get(hash_key)
+            if data is not None:
+                yield hash_key, data
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Group several puts together. Backends that support transactions
+        commit them all at once at the end of the block."""
+        yield
+
+    def close(self) -> None:
+        """Release anything the backend holds open."""
+        pass
+
+
+def _check_dictionary(codec: CacheCodec, stored: Optional[bytes]) -> bool:
+    """Check a codec's dictionary against the one a cache was written with,
+    taking the cache's if the codec has none. Returns whether the codec's
+    dictionary should be saved, as the cache doesn't have one yet."""
+    if stored is None:
+        return codec.dictionary is not None
+    if codec.dictionary is None:
+        codec.dictionary = stored
+    elif codec.dictionary != stored:
+        raise Exception("This cache was compressed with a different "
+                        "dictionary, its entries couldn't be read! Convert "
+                        "it into a new cache with python -m lumen.CacheBackend"
+                        " instead.")
+    return False
+
+
+class DirectoryCache(CacheBackend):
+    """The original cache layout: a folder with a `<hash>.json` file holding
+    each response and a `<hash>.metadata` file holding its key.
+
+    Responses are written with codec, plain JSON by default. A compression
+    dictionary is saved in the folder so later sessions can read the entries
+    without being given it again."""
+
+    def __init__(self, path: Path, codec: Optional[CacheCodec] = None):
+        self.path = path
+        self.path.mkdir(exist_ok=True)
+        self.codec = codec or CacheCodec()
+
+        dictionary_path = self.path / "dictionary"
+        if _check_dictionary(
+                self.codec,
+                dictionary_path.read_bytes()
+                if dictionary_path.exists() else None):
+            dictionary_path.write_bytes(self.codec.dictionary)
+
+        # Hits are kept in a small database next to the entries, opened the
+        # first time they're needed. The entries are plain files any thread
+        # can read, so the database is shared between threads too, one at a
+        # time through _usage_lock
+        self._usage = _Usage()
+        self._usage_conn: Optional[sqlite3.Connection] = None
+        self._usage_lock = threading.RLock()
+
+    @property
+    def usage_conn(self) -> sqlite3.Connection:
+        with self._usage_lock:
+            if self._usage_conn is None:
+                conn = sqlite3.connect(self.path / "usage.sqlite",
+                                       check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""CREATE TABLE IF NOT EXISTS usage (
+                        hash_key TEXT PRIMARY KEY,
+                        accessed REAL NOT NULL,
+                        hits INTEGER NOT NULL)""")
+                self._usage_conn = conn
+            return self._usage_conn
+
+    def get(self, hash_key: str) -> Optional[Dict[str, Any]]:
+        try:
+            raw = (self.path / f"{hash_key}.json").read_bytes()
+        except FileNotFoundError:
+            return None
+        return self.codec.decode(raw)
+
+    def put(self, hash_key: str, key: Dict[str, str],
+            data: Dict[str, Any]) -> None:
+        (self.path / f"{hash_key}.json").write_bytes(self.codec.encode(data))
+        self._write_metadata(hash_key, key)
+
+    def _write_metadata(self, hash_key: str, key: Dict[str, str]) -> None:
+        with (self.path / f"{hash_key}.metadata").open("w+") as output:
+            json.dump(key, output, sort_keys=True, indent=2)
+
+    @contextmanager
+    def writer(self, hash_key: str,
+               key: Dict[str, str]) -> Iterator[Callable[[bytes], None]]:
+        # Chunks go straight to a file that's renamed into place once it's
+        # complete, so readers never see half an entry
+        partial = self.path / f"{hash_key}.partial"
+        compressor = self.codec.compressor()
+        try:
+            with partial.open("wb") as output:
+                yield lambda chunk: output.write(compressor.compress(chunk))
+                output.write(compressor.flush())
+            partial.replace(self.path / f"{hash_key}.json")
+        finally:
+            partial.unlink(missing_ok=True)
+        self._write_metadata(hash_key, key)
+
+    def delete(self, hash_key: str) -> None:
+        (self.path / f"{hash_key}.json").unlink(missing_ok=True)
+        (self.path / f"{hash_key}.metadata").unlink(missing_ok=True)
+
+    def keys(self) -> Iterator[str]:
+        for file in self.path.iterdir():
+            if file.suffix == ".json":
+                yield file.stem
+
+    def metadata(self, hash_key: str) -> Optional[Dict[str, str]]:
+        try:
+            with (self.path / f"{hash_key}.metadata").open() as input:
+                return json.load(input)
+        except FileNotFoundError:
+            return None
+
+    def created(self, hash_key: str) -> Optional[float]:
+        try:
+            return (self.path / f"{hash_key}.json").stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def touch(self, hash_key: str) -> None:
+        if self._usage.touch(hash_key):
+            self._flush_usage()
+
+    def _flush_usage(self) -> None:
+        with self._usage_lock:
+            rows = self._usage.take()
+            if rows:
+                with self.usage_conn:
+                    self.usage_conn.executemany(
+                        "INSERT INTO usage (accessed, hits, hash_key) "
+                        "VALUES (?, ?, ?) ON CONFLICT (hash_key) DO UPDATE "
+                        "SET accessed = excluded.accessed, "
+                        "hits = hits + excluded.hits", rows)
+
+    def stats(self) -> Iterator[EntryStats]:
+        with self._usage_lock:
+            self._flush_usage()
+            usage = {
+                hash_key: (accessed, hits)
+                for hash_key, accessed, hits in self.usage_conn.execute(
+                    "SELECT hash_key, accessed, hits FROM usage")
+            }
+        for file in self.path.iterdir():
+            if file.suffix != ".json":
+                continue
+            metadata = self.path / f"{file.stem}.metadata"
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            size = stat.st_size
+            if metadata.exists():
+                size += metadata.stat().st_size
+            accessed, hits = usage.get(file.stem, (stat.st_mtime, 0))
+            yield EntryStats(file.stem, size, stat.st_mtime, accessed, hits)
+
+    def compact(self) -> None:
+        """Remove metadata left without an entry, downloads that never
+        finished, and hits on entries that are gone."""
+        entries = set(self.keys())
+        for file in self.path.iterdir():
+            orphan = file.suffix == ".metadata" and file.stem not in entries
+            # A streamed entry still being written is only an hour old
+            abandoned = (file.suffix == ".partial"
+                         and time.time() - file.stat().st_mtime > 60 * 60)
+            if orphan or abandoned:
+                file.unlink(missing_ok=True)
+        with self._usage_lock:
+            self._flush_usage()
+            with self.usage_conn:
+                self.usage_conn.executemany(
+                    "DELETE FROM usage WHERE hash_key = ?",
+                    [(hash_key, ) for (hash_key, ) in self.usage_conn.execute(
+                        "SELECT hash_key FROM usage").fetchall()
+                     if hash_key not in entries])
+            self.usage_conn.execute("VACUUM")
+
+    def close(self) -> None:
+        with self._usage_lock:
+            self._flush_usage()
+            if self._usage_conn is not None:
+                self._usage_conn.close()
+                self._usage_conn = None
+
+    def __contains__(self, hash_key: str) -> bool:
+        return (self.path / f"{hash_key}.json").exists()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The dictionary is saved in the folder, no need to send it along
+        return {"path": self.path, "compression": self.codec.compression}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["path"], CacheCodec(state["compression"]))
+
+    def __repr__(self) -> str:
+        return f"DirectoryCache({self.path})"
+
+
+class SQLiteCache(CacheBackend):
+    """Keeps the whole cache in a single SQLite file, so a big crawl is one
+    file on disk instead of millions of tiny ones. Entries are indexed on
+    their path and params so they can be looked up by request too.
+
+    Responses are written with codec, plain JSON by default. A compression
+    dictionary is saved in the database alongside the entries."""
+
+    def __init__(self, path: Path, codec: Optional[CacheCodec] = None):
+        self.path = path
+        self.codec = codec or CacheCodec()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._in_batch = False
+        self._usage = _Usage()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # Opened lazily so the cache can be pickled and handed to other
+        # processes, which each open their own connection
+        if self._conn is None:
+            conn = sqlite3.connect(self.path)
+            try:
+                self._set_up(conn)
+            except BaseException:
+                conn.close()
+                raise
+            # Only kept once it's ready, so a failed set up is retried
+            self._conn = conn
+        return self._conn
+
+    def _set_up(self, conn: sqlite3.Connection) -> None:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                hash_key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                params TEXT NOT NULL,
+                body BLOB NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL,
+                hits INTEGER NOT NULL DEFAULT 0)""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS entries_request
+                ON entries (path, params)""")
+        # Caches made before eviction was added don't track hits yet. Several
+        # processes can open the cache at once, so check again while holding
+        # the write lock, and add both columns or neither
+        if "hits" not in self._columns(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if "hits" not in self._columns(conn):
+                    conn.execute(
+                        "ALTER TABLE entries ADD COLUMN accessed REAL")
+                    conn.execute("ALTER TABLE entries ADD COLUMN hits "
+                                 "INTEGER NOT NULL DEFAULT 0")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        conn.execute("""CREATE TABLE IF NOT EXISTS settings (
+                name TEXT PRIMARY KEY,
+                value BLOB NOT NULL)""")
+
+        row = conn.execute(
+            "SELECT value FROM settings WHERE name = 'dictionary'").fetchone()
+        if _check_dictionary(self.codec, row[0] if row else None):
+            # Another process may have saved its dictionary in the meantime,
+            # in which case ours has to match it
+            conn.execute("INSERT OR IGNORE INTO settings VALUES "
+                         "('dictionary', ?)", (self.codec.dictionary, ))
+            conn.commit()
+            row = conn.execute("SELECT value FROM settings "
+                               "WHERE name = 'dictionary'").fetchone()
+            _check_dictionary(self.codec, row[0])
+
+    @staticmethod
+    def _columns(conn: sqlite3.Connection) -> Set[str]:
+        return {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {"path": self.path, "compression": self.codec.compression}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["path"], CacheCodec(state["compression"]))
+
+    def _decode(self, body: Any) -> Dict[str, Any]:
+        # Entries from before compression was added are stored as text
+        return self.codec.decode(
+            body.encode() if isinstance(body, str) else body)
+
+    def get(self, hash_key: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute("SELECT body FROM entries WHERE hash_key = ?",
+                                (hash_key, )).fetchone()
+        return self._decode(row[0]) if row else None
+
+    def put(self, hash_key: str, key: Dict[str, str],
+            data: Dict[str, Any]) -> None:
+        self._insert(hash_key, key, self.codec.encode(data))
+
+    def _insert(self, hash_key: str, key: Dict[str, str],
+                body: bytes) -> None:
+        params = {k: v for k, v in key.items() if k != "path"}
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entries (hash_key, path, params, body, "
+            "created) VALUES (?, ?, ?, ?, ?)",
+            (hash_key, key["path"], json.dumps(params, sort_keys=True), body,
+             time.time()))
+        if not self._in_batch:
+            self.conn.commit()
+
+    @contextmanager
+    def writer(self, hash_key: str,
+               key: Dict[str, str]) -> Iterator[Callable[[bytes], None]]:
+        # A row is written in one go, but at least only the compressed body
+        # is held until then
+        compressor = self.codec.compressor()
+        body: List[bytes] = []
+        yield lambda chunk: body.append(compressor.compress(chunk))
+        body.append(compressor.flush())
+        self._insert(hash_key, key, b"".join(body))
+
+    def delete(self, hash_key: str) -> None:
+        self.conn.execute("DELETE FROM entries WHERE hash_key = ?",
+                          (hash_key, ))
+        if not self._in_batch:
+            self.conn.commit()
+
+    def keys(self) -> Iterator[str]:
+        # fetchall so the caller can write to the cache while iterating
+        for (hash_key, ) in self.conn.execute(
+                "SELECT hash_key FROM entries").fetchall():
+            yield hash_key
+
+    def metadata(self, hash_key: str) -> Optional[Dict[str, str]]:
+        row = self.conn.execute(
+            "SELECT path, params FROM entries WHERE hash_key = ?",
+            (hash_key, )).fetchone()
+        if not row:
+            return None
+        key = json.loads(row[1])
+        key["path"] = row[0]
+        return key
+
+    def created(self, hash_key: str) -> Optional[float]:
+        row = self.conn.execute(
+            "SELECT created FROM entries WHERE hash_key = ?",
+            (hash_key, )).fetchone()
+        return row[0] if row else None
+
+    def touch(self, hash_key: str) -> None:
+        if self._usage.touch(hash_key) and not self._in_batch:
+            self._flush_usage()
+
+    def _flush_usage(self) -> None:
+        rows = self._usage.take()
+        if rows:
+            self.conn.executemany(
+                "UPDATE entries SET accessed = ?, hits = hits + ? "
+                "WHERE hash_key = ?", rows)
+            if not self._in_batch:
+                self.conn.commit()
+
+    def stats(self) -> Iterator[EntryStats]:
+        self._flush_usage()
+        for row in self.conn.execute(
+                "SELECT hash_key, length(body) + length(params), created, "
+                "COALESCE(accessed, created), hits FROM entries").fetchall():
+            yield EntryStats(*row)
+
+    def compact(self) -> None:
+        self._flush_usage()
+        self.conn.execute("VACUUM")
+
+    def find(
+            self,
+            path: str,
+            params: Optional[Dict[str, str]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Look up a response by the request that made it, using the index on
+        path and params."""
+        row = self.conn.execute(
+            "SELECT body FROM entries WHERE path = ? AND params = ?",
+            (path, json.dumps(canonical_params(path, params),
+                              sort_keys=True))).fetchone()
+        return self._decode(row[0]) if row else None
+
+    def __contains__(self, hash_key: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM entries WHERE hash_key = ?",
+                                 (hash_key, )).fetchone() is not None
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        if self._in_batch:
+            # Already inside a batch, the outer one will commit
+            yield
+            return
+
+        self._in_batch = True
+        try:
+            yield
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            self._in_batch = False
+
+    def close(self) -> None:
+        self._flush_usage()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __repr__(self) -> str:
+        return f"SQLiteCache({self.path})"
+
+
+def _approx_size(data: Any, limit: int) -> int:
+    """Roughly how much memory a decoded response takes up, not counting
+    dict keys (which decoders share between notices). Stops counting once
+    it's past limit."""
+    size = 0
+    objects = [data]
+    while objects and size <= limit:
+        obj = objects.pop()
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            objects.extend(obj.values())
+        elif isinstance(obj, list):
+            objects.extend(obj)
+    return size
+
+
+class MemoryCache(CacheBackend):
+    """Keeps the most recently used responses of another backend in memory, so
+    hot entries skip reading and decoding the file. Holds at most maxsize
+    entries taking up at most max_bytes. Responses bigger than a quarter of
+    that (like a 10000 notice page, which decodes to tens of megabytes) are
+    never kept. Responses are shared between callers, so don't modify
+    them."""
+
+    def __init__(self,
+                 backend: CacheBackend,
+                 maxsize: int = 32,
+                 max_bytes: int = 64_000_000):
+        self.backend = backend
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.nbytes = 0
+
+    def _forget(self, hash_key: str) -> None:
+        if self.entries.pop(hash_key, None) is not None:
+            self.nbytes -= self.sizes.pop(hash_key)
+
+    def _remember(self, hash_key: str, data: Dict[str, Any]) -> None:
+        self._forget(hash_key)
+        size = _approx_size(data, self.max_bytes // 4)
+        if size > self.max_bytes // 4:
+            return
+        self.entries[hash_key] = data
+        self.sizes[hash_key] = size
+        self.nbytes += size
+        while len(self.entries) > self.maxsize or self.nbytes > self.max_bytes:
+            self._forget(next(iter(self.entries)))
+
+    def get(self, hash_key: str) -> Optional[Dict[str, Any]]:
+        data = self.entries.get(hash_key)
+        if data is not None:
+            self.entries.move_to_end(hash_key)
+            return data
+
+        data = self.backend.get(hash_key)
+        if data is not None:
+            self._remember(hash_key, data)
+        return data
+
+    def put(self, hash_key: str, key: Dict[str, str],
+            data: Dict[str, Any]) -> None:
+        self.backend.put(hash_key, key, data)
+        self._remember(hash_key, data)
+
+    def writer(self, hash_key: str, key: Dict[str, str]):
+        # Streamed entries are never decoded, so don't keep a stale one
+        self._forget(hash_key)
+        return self.backend.writer(hash_key, key)
+
+    def delete(self, hash_key: str) -> None:
+        self._forget(hash_key)
+        self.backend.delete(hash_key)
+
+    def keys(self) -> Iterator[str]:
+        return self.backend.keys()
+
+    def metadata(self, hash_key: str) -> Optional[Dict[str, str]]:
+        return self.backend.metadata(hash_key)
+
+    def created(self, hash_key: str) -> Optional[float]:
+        return self.backend.created(hash_key)
+
+    def touch(self, hash_key: str) -> None:
+        self.backend.touch(hash_key)
+
+    def stats(self) -> Iterator[EntryStats]:
+        return self.backend.stats()
+
+    def compact(self) -> None:
+        self.backend.compact()
+
+    def __contains__(self, hash_key: str) -> bool:
+        return hash_key in self.entries or hash_key in self.backend
+
+    def batch(self):
+        return self.backend.batch()
+
+    def close(self) -> None:
+        self.entries.clear()
+        self.sizes.clear()
+        self.nbytes = 0
+        self.backend.close()
+
+    def __repr__(self) -> str:
+        return f"MemoryCache({self.backend!r})"
+
+
+def open_cache(cache: Optional[Union[Path, CacheBackend]],
+               memory_cache_size: int = 0,
+               codec: Optional[CacheCodec] = None) -> Optional[CacheBackend]:
+    """Turn the cache argument the managers take into a backend. Paths ending
+    in .sqlite or .db become a SQLiteCache, other paths are a DirectoryCache
+    like before, and None means no caching. Paths are opened with codec. With
+    a memory_cache_size, the backend is wrapped in a MemoryCache of that
+    size."""
+    if cache is None:
+        return None
+    if isinstance(cache, CacheBackend):
+        backend = cache
+    elif cache.suffix in (".sqlite", ".db"):
+        backend = SQLiteCache(cache, codec)
+    else:
+        backend = DirectoryCache(cache, codec)
+    if memory_cache_size > 0:
+        backend = MemoryCache(backend, memory_cache_size)
+    return backend
+
+
+def migrate_cache(source: CacheBackend,
+                  dest: CacheBackend,
+                  batch_size: int = 1000) -> int:
+    """Copy every entry in source into dest, returning how many were copied.
+    Writes are committed every batch_size entries."""
+    copied = 0
+    hash_keys = source.keys()
+
+    while True:
+        with dest.batch():
+            count = 0
+            for hash_key in hash_keys:
+                data = source.get(hash_key)
+                key = source.metadata(hash_key)
+                if data is None or key is None:
+                    logging.warning("Skipping %s, it is missing its data or "
+                                    "metadata", hash_key)
+                    continue
+                dest.put(hash_key, key, data)
+                count += 1
+                if count == batch_size:
+                    break
+        copied += count
+        logging.info("Migrated %d entries", copied)
+        if count < batch_size:
+            return copied
+
+
+def rekey_cache(cache: CacheBackend,
+                batch_size: int = 1000) -> Tuple[int, int]:
+    """Move every entry that isn't under its current cache_key (because it was
+    cached under an older KEY_VERSION) to where it belongs now. Entries that
+    turn out to be the same request as one already there are dropped. Returns
+    how many entries were moved and how many were dropped.
+
+    Old entries with a digits-only param other than the page numbers are
+    dropped too: version 3 stripped their leading zeros, so a response for
+    title=007 might be filed under title=7, and there's no telling which."""
+    moved = dropped = 0
+    # Listed up front since we add entries as we go
+    hash_keys = iter(list(cache.keys()))
+
+    while True:
+        with cache.batch():
+            count = 0
+            for hash_key in islice(hash_keys, batch_size):
+                count += 1
+                key = cache.metadata(hash_key)
+                if key is None:
+                    logging.warning("Skipping %s, it is missing its metadata",
+                                    hash_key)
+                    continue
+                params = {k: v for k, v in key.items() if k != "path"}
+                new_key, new_hash_key = cache_key(key["path"], params)
+                if new_hash_key == hash_key:
+                    continue
+
+                if new_hash_key in cache or any(
+                        name not in NUMBER_PARAMS and value.isdigit()
+                        for name, value in params.items()):
+                    dropped += 1
+                else:
+                    data = cache.get(hash_key)
+                    if data is None:
+                        continue
+                    cache.put(new_hash_key, new_key, data)
+                    moved += 1
+                cache.delete(hash_key)
+        logging.info("Moved %d entries, dropped %d duplicates", moved,
+                     dropped)
+        if count < batch_size:
+            return moved, dropped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Copy a cache into another cache, for instance an old "
+        "cache/ folder into a single cache.sqlite file, or into a compressed "
+        "cache. With --rekey, move a cache's entries to their current keys "
+        "instead.")
+    parser.add_argument("source", type=Path)
+    parser.add_argument("dest", type=Path, nargs="?")
+    parser.add_argument("--rekey",
+                        action="store_true",
+                        help="re-key source in place after upgrading")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--compression", choices=["zstd", "zlib"])
+    parser.add_argument(
+        "--dictionary-samples",
+        type=int,
+        default=0,
+        help="train a compression dictionary on this many source entries")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not args.rekey and args.dest is None:
+        parser.error("dest is needed to copy a cache")
+    source = open_cache(args.source)
+    assert source is not None
+
+    if args.rekey:
+        moved, dropped = rekey_cache(source, args.batch_size)
+        print(f"Moved {moved} entries to new keys and dropped {dropped} "
+              f"duplicates in {source}")
+    else:
+        dictionary = None
+        if args.compression and args.dictionary_samples:
+            samples = (data for _, data in source.items())
+            dictionary = train_dictionary(
+                islice(samples, args.dictionary_samples), args.compression)
+        dest = open_cache(args.dest,
+                          codec=CacheCodec(args.compression, dictionary))
+        assert dest is not None
+        print(f"Copied {migrate_cache(source, dest, args.batch_size)} "
+              f"entries from {source} to {dest}")
+        dest.close()
+    source.close()
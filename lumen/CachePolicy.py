@@ -0,0 +1,201 @@
+import argparse
+import logging
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from lumen.CacheBackend import (DEFAULT_PARAMS, CacheBackend, EntryStats,
+                                canonical_params, open_cache)
+from lumen.Metrics import endpoint_of
+
+if sys.version_info >= (3, 11):
+    from typing import Self
+else:
+    from typing_extensions import Self
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
+FRESH = "fresh"
+STALE = "stale"
+EXPIRED = "expired"
+
+
+@dataclass(frozen=True)
+class TTL:
+    """How long a cached response is good for. It's fresh for `fresh` seconds
+    (None is forever), then stale for `stale` seconds more: still served, but
+    the async manager refreshes it in the background. After that it's expired
+    and requested again."""
+    fresh: Optional[float] = None
+    stale: float = 0
+
+    def state(self, age: float) -> str:
+        if self.fresh is None or age < self.fresh:
+            return FRESH
+        if age < self.fresh + self.stale:
+            return STALE
+        return EXPIRED
+
+
+def _effective_params(path: str, params: Dict[str, str]) -> Dict[str, str]:
+    # Canonical params leave out defaults, put them back so a rule can ask
+    # for page 1 and match requests that didn't give a page
+    return dict(DEFAULT_PARAMS.get(path, {}), **canonical_params(path, params))
+
+
+class CachePolicy:
+    """Which TTL each cached request gets. Rules match an endpoint (like
+    "/topics.json" or "/notices/{id}.json") and optionally some params, and
+    the last rule added that matches wins. Anything no rule matches gets
+    default, which by default is cached forever.
+
+        policy = CachePolicy().with_ttl("/topics.json", TTL(WEEK)).with_ttl(
+            "/notices/search.json", TTL(HOUR, stale=DAY), {
+                "sort_by": Sort.DateReceivedDesc,
+                "page": "1"
+            })
+
+    Params are compared after canonicalizing, so they match however the
+    request spelled them."""
+
+    def __init__(self, default: TTL = TTL()):
+        self.default = default
+        self.rules: List[Tuple[str, Dict[str, str], TTL]] = []
+
+    def with_ttl(self,
+                 endpoint: str,
+                 ttl: TTL,
+                 params: Optional[Dict[str, str]] = None) -> Self:
+        """Give requests to endpoint (with these params, if given) ttl."""
+        params = params or {}
+        effective = _effective_params(endpoint, params)
+        self.rules.append((endpoint, {
+            name: effective[name]
+            for name in params if name in effective
+        }, ttl))
+        return self
+
+    def ttl(self, path: str, params: Optional[Dict[str, str]] = None) -> TTL:
+        endpoint = endpoint_of(path)
+        effective = None
+        for rule_endpoint, rule_params, ttl in reversed(self.rules):
+            if rule_endpoint != endpoint:
+                continue
+            if effective is None:
+                effective = _effective_params(path, params or {})
+            if all(effective.get(name) == value
+                   for name, value in rule_params.items()):
+                return ttl
+        return self.default
+
+    def state(self, cache: CacheBackend, hash_key: str, path: str,
+              params: Optional[Dict[str, str]] = None) -> str:
+        """Whether a cached entry is FRESH, STALE or EXPIRED. Entries whose
+        age the cache doesn't know are fresh."""
+        ttl = self.ttl(path, params)
+        if ttl.fresh is None:
+            # Cached forever, no need to ask the cache how old it is
+            return FRESH
+        created = cache.created(hash_key)
+        if created is None:
+            return FRESH
+        return ttl.state(time.time() - created)
+
+
+class GCResult(NamedTuple):
+    expired: int
+    evicted: int
+    freed_bytes: int
+    bytes_left: int
+
+
+def _eviction_order(entry: EntryStats, strategy: str) -> Tuple[float, ...]:
+    if strategy == "lfu":
+        # Least hits first, least recently used among equals
+        return (entry.hits, entry.accessed)
+    return (entry.accessed, )
+
+
+def gc_cache(cache: CacheBackend,
+             policy: Optional[CachePolicy] = None,
+             max_bytes: Optional[int] = None,
+             strategy: str = "lru",
+             batch_size: int = 1000) -> GCResult:
+    """Tidy up a cache: delete entries policy says have expired, then if the
+    cache is still bigger than max_bytes, evict entries until it fits, least
+    recently used first ("lru") or least often used ("lfu"), and finally
+    compact the cache to reclaim the space."""
+    if strategy not in ("lru", "lfu"):
+        raise Exception(f"Unknown eviction strategy {strategy}!")
+    entries = list(cache.stats())
+    doomed: List[EntryStats] = []
+    kept: List[EntryStats] = []
+
+    now = time.time()
+    for entry in entries:
+        key = cache.metadata(entry.hash_key) if policy else None
+        if key is not None and policy is not None:
+            params = {k: v for k, v in key.items() if k != "path"}
+            ttl = policy.ttl(key["path"], params)
+            if ttl.state(now - entry.created) == EXPIRED:
+                doomed.append(entry)
+                continue
+        kept.append(entry)
+    expired = len(doomed)
+
+    total = sum(entry.size for entry in kept)
+    if max_bytes is not None and total > max_bytes:
+        kept.sort(key=lambda entry: _eviction_order(entry, strategy))
+        evict = 0
+        while total > max_bytes and evict < len(kept):
+            total -= kept[evict].size
+            evict += 1
+        doomed.extend(kept[:evict])
+
+    for start in range(0, len(doomed), batch_size):
+        with cache.batch():
+            for entry in doomed[start:start + batch_size]:
+                cache.delete(entry.hash_key)
+    cache.compact()
+
+    result = GCResult(expired, len(doomed) - expired,
+                      sum(entry.size for entry in doomed), total)
+    logging.info("Expired %d entries and evicted %d, freeing %d bytes",
+                 result.expired, result.evicted, result.freed_bytes)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Shrink a cache to a size by evicting the least recently "
+        "(or least often) used entries, then compact it.")
+    parser.add_argument("cache",
+                        type=Path,
+                        help="cache folder or .sqlite cache file")
+    parser.add_argument("--max-mb",
+                        type=float,
+                        help="evict entries until the cache is this small")
+    parser.add_argument("--strategy", choices=["lru", "lfu"], default="lru")
+    parser.add_argument("--max-age-days",
+                        type=float,
+                        help="also delete anything cached longer ago")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    cache = open_cache(args.cache)
+    assert cache is not None
+    policy = (CachePolicy(TTL(args.max_age_days * DAY))
+              if args.max_age_days is not None else None)
+    result = gc_cache(
+        cache, policy,
+        int(args.max_mb * 1e6) if args.max_mb is not None else None,
+        args.strategy)
+    print(f"Expired {result.expired} entries and evicted {result.evicted}, "
+          f"freeing {result.freed_bytes / 1e6:.1f} MB "
+          f"({result.bytes_left / 1e6:.1f} MB left) in {cache}")
+    cache.close()
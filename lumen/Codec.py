@@ -0,0 +1,146 @@
+import json
+import zlib
+from typing import Any, Iterable, Optional
+
+# Optional faster JSON libraries, we fall back to the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+# Optional, only needed to use zstd compression
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# zlib streams start with 0x78, which can't start a JSON document
+ZLIB_MAGIC = b"\x78"
+# zlib can only look back 32KB, so a bigger dictionary is wasted
+ZLIB_MAX_DICTIONARY = 32 * 1024
+
+
+def loads(data: bytes) -> Any:
+    """Decode JSON with orjson or msgspec if installed, json otherwise."""
+    if orjson is not None:
+        return orjson.loads(data)
+    if msgspec is not None:
+        return msgspec.json.decode(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode JSON with orjson or msgspec if installed, json otherwise."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    if msgspec is not None:
+        return msgspec.json.encode(obj)
+    return json.dumps(obj).encode()
+
+
+class _Uncompressed:
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+class CacheCodec:
+    """How cache entries are written: as plain JSON (compression=None), or
+    compressed with "zstd" (needs the zstandard package) or "zlib" (the same
+    compression as gzip, in the standard library).
+
+    Responses are very repetitive (the same keys, URLs and boilerplate), so
+    compressing with a dictionary trained on other responses (see
+    train_dictionary) shrinks them even more. Every entry starts with magic
+    bytes saying how it was written, so a codec can read entries written by
+    any other codec, as long as it has the same dictionary."""
+
+    def __init__(self,
+                 compression: Optional[str] = None,
+                 dictionary: Optional[bytes] = None,
+                 level: Optional[int] = None):
+        if compression not in (None, "zstd", "zlib"):
+            raise Exception(f"Unknown compression {compression}!")
+        if compression == "zstd" and zstandard is None:
+            raise Exception("zstd compression needs the zstandard package!")
+        self.compression = compression
+        self.dictionary = dictionary
+        self.level = level
+
+    def _zstd_dictionary(self) -> Optional[Any]:
+        if self.dictionary is None:
+            return None
+        return zstandard.ZstdCompressionDict(self.dictionary)
+
+    def encode(self, data: Any) -> bytes:
+        raw = dumps(data)
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor(
+                level=self.level or 3,
+                dict_data=self._zstd_dictionary()).compress(raw)
+        if self.compression == "zlib":
+            compressor = self.compressor()
+            return compressor.compress(raw) + compressor.flush()
+        return raw
+
+    def compressor(self) -> Any:
+        """Something with compress(chunk) and flush() methods like zlib's, to
+        encode JSON that's still arriving a chunk at a time, in a format
+        decode can read."""
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor(
+                level=self.level or 3,
+                dict_data=self._zstd_dictionary()).compressobj()
+        if self.compression == "zlib":
+            if self.dictionary:
+                return zlib.compressobj(
+                    self.level or 6,
+                    zdict=self.dictionary[-ZLIB_MAX_DICTIONARY:])
+            return zlib.compressobj(self.level or 6)
+        return _Uncompressed()
+
+    def decode(self, raw: bytes) -> Any:
+        if raw.startswith(ZSTD_MAGIC):
+            if zstandard is None:
+                raise Exception(
+                    "This cache entry is zstd compressed, install zstandard!")
+            dictionary = self._zstd_dictionary()
+            decompressor = zstandard.ZstdDecompressor(
+                dict_data=dictionary
+            ) if dictionary else zstandard.ZstdDecompressor()
+            # Entries compressed in one go record their size, streamed ones
+            # don't, so decompress as a stream in case
+            raw = decompressor.decompressobj().decompress(raw)
+        elif raw.startswith(ZLIB_MAGIC):
+            decompressor = zlib.decompressobj(
+                zdict=self.dictionary[-ZLIB_MAX_DICTIONARY:]
+            ) if self.dictionary else zlib.decompressobj()
+            raw = decompressor.decompress(raw) + decompressor.flush()
+        return loads(raw)
+
+
+def train_dictionary(samples: Iterable[Any],
+                     compression: str = "zstd",
+                     size: int = 112640) -> bytes:
+    """Build a compression dictionary from sample responses. For zstd this uses
+    zstd's dictionary trainer. zlib has no trainer, so its dictionary is just
+    the end of the samples, which holds the keys and boilerplate responses
+    share."""
+    encoded = [dumps(sample) for sample in samples]
+    if compression == "zstd":
+        if zstandard is None:
+            raise Exception("zstd compression needs the zstandard package!")
+        return zstandard.train_dictionary(size, encoded).as_bytes()
+
+    # zlib prefers the most useful strings at the end of the dictionary
+    dictionary = b""
+    for sample in encoded:
+        dictionary = (dictionary + sample[:4096])[-ZLIB_MAX_DICTIONARY:]
+    return dictionary
@@ -0,0 +1,489 @@
+import argparse
+import asyncio
+import hmac
+import ipaddress
+import logging
+import multiprocessing
+import secrets
+from collections import deque
+from os import getenv
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from lumen.AsyncLumenAPIManager import AsyncLumenAPIManager
+from lumen.Codec import dumps, loads
+from lumen.CrawlJob import CrawlJob, CrawlProgress, read_queries
+from lumen.NoticeStore import NoticeStore
+from lumen.RateLimiter import TokenBucket
+
+# The protocol is one JSON object per line each way. A worker sends a message
+# and waits for the reply before sending the next. The first message on every
+# connection has to carry the coordinator's token, or it's hung up on:
+#   {"op": "hello", "token": "..."} -> {}, or {"error": "..."}
+#   {"op": "lease"} -> {"unit_id": 12, "path": ..., "params": {...}}, or
+#                      {"unit_id": null} once there's nothing left to do
+#   {"op": "done", "unit_id": 12, "notices": 100} -> {}
+#   {"op": "failed", "unit_id": 12, "error": "..."} -> {}
+#   {"op": "token"} -> {"delay": 0.5}, wait that long, then make a request
+Address = Tuple[str, int]
+
+# How long a new connection has to say hello
+HELLO_TIMEOUT = 10
+
+
+def _is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class _Connection:
+    """One connection to a coordinator, sending a message and reading its
+    reply at a time."""
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, address: Address, token: str) -> "_Connection":
+        connection = cls(*await asyncio.open_connection(*address))
+        try:
+            reply = await connection.request({"op": "hello", "token": token})
+            if "error" in reply:
+                raise Exception(f"The coordinator refused us: "
+                                f"{reply['error']}")
+        except BaseException:
+            await connection.close()
+            raise
+        return connection
+
+    async def request(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        async with self._lock:
+            self.writer.write(dumps(message) + b"\n")
+            await self.writer.drain()
+            line = await self.reader.readline()
+        if not line:
+            raise Exception("The coordinator closed the connection!")
+        return loads(line)
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class RemoteTokenBucket(TokenBucket):
+    """A rate limiter that takes its tokens from a coordinator's limiter, so
+    every worker on every machine shares the coordinator's budget. Only works
+    with AsyncLumenAPIManager, as a token is a round trip to the
+    coordinator."""
+
+    def __init__(self, connection: _Connection):
+        # The rate is the coordinator's business, this one's never used
+        super().__init__(rate=1)
+        self.connection = connection
+
+    def reserve(self) -> float:
+        raise Exception("RemoteTokenBucket only works with "
+                        "AsyncLumenAPIManager!")
+
+    async def acquire_async(self) -> float:
+        reply = await self.connection.request({"op": "token"})
+        delay = reply["delay"]
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+
+class CrawlCoordinator:
+    """Runs a CrawlJob with worker processes doing the fetching, so parsing
+    and storing notices isn't stuck on one core. The coordinator keeps the
+    job's file and the rate limit, workers connect to it over TCP (see
+    run_worker), lease pages one at a time, fetch them, store their notices,
+    and report back. Every request any worker makes takes a token from the
+    coordinator's job.manager.rate_limiter first, so however many workers
+    there are, the whole crawl stays under one budget.
+
+        job = CrawlJob(api, Path("crawl.sqlite"))
+        await CrawlCoordinator(job).run(processes=4, store=Path(...))
+
+    Workers can also run on other machines, started with
+    `python -m lumen.CrawlCluster worker coordinator-host:port --token ...`,
+    if the coordinator listens on an address they can reach. Every worker has
+    to know the coordinator's token; without one, a random token is made for
+    the workers started here, and only loopback addresses are allowed. Pages
+    leased to a worker that disconnects go back in the queue, and only the
+    coordinator writes to the job's file, so it resumes like any CrawlJob."""
+
+    def __init__(self,
+                 job: CrawlJob,
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 token: Optional[str] = None):
+        if token is None and not _is_loopback(host):
+            raise Exception(f"Anyone who can reach {host} could lease pages "
+                            "and spend the rate limit, give the coordinator "
+                            "a token for the workers!")
+        self.job = job
+        self.rate_limiter = job.manager.rate_limiter
+        self.host = host
+        self.port = port
+        self.token = token or secrets.token_urlsafe()
+        self._connections: Set[asyncio.Task] = set()
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._queue: Deque[tuple] = deque()
+        self._leased = 0
+        self._changed = asyncio.Condition()
+
+    @property
+    def address(self) -> Address:
+        return self.host, self.port
+
+    def _finished(self) -> bool:
+        return not self._queue and not self._leased
+
+    async def _lease(self) -> Optional[tuple]:
+        """The next unit to fetch, waiting while there's none queued but some
+        leased out (they might fail and come back), or None once every unit
+        is done."""
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: self._queue or self._finished())
+            if not self._queue:
+                return None
+            self._leased += 1
+            return self._queue.popleft()
+
+    async def _return(self, unit: Optional[tuple]) -> None:
+        """Give back a lease, queueing unit if given (one to redo, or a new
+        one)."""
+        async with self._changed:
+            self._leased -= 1
+            if unit is not None:
+                self._queue.append(unit)
+            self._changed.notify_all()
+
+    async def _reply(self, message: Dict[str, Any],
+                     leased: Dict[int, tuple]) -> Dict[str, Any]:
+        op = message.get("op")
+        if op == "token":
+            return {"delay": self.rate_limiter.reserve()}
+        if op == "lease":
+            unit = await self._lease()
+            if unit is None:
+                return {"unit_id": None}
+            leased[unit[0]] = unit
+            return {
+                "unit_id": unit[0],
+                "path": "/notices/search.json",
+                "params": self.job.page_params(*unit[1:])
+            }
+        if op == "done":
+            leased.pop(message["unit_id"])
+            # The next page of a query still getting notices, if there is one
+            await self._return(
+                self.job.finish_unit(message["unit_id"], message["notices"]))
+            return {}
+        if op == "failed":
+            unit = leased.pop(message["unit_id"])
+            logging.warning("Failed to get unit %d: %s", unit[0],
+                            message["error"])
+            retry = self.job.fail_unit(unit[0], message["error"])
+            await self._return(unit if retry else None)
+            return {}
+        raise Exception(f"Unknown message {message}!")
+
+    async def _hello(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> bool:
+        """Check a new connection's token, telling it whether it's in."""
+        try:
+            line = await asyncio.wait_for(reader.readline(), HELLO_TIMEOUT)
+            message = loads(line)
+            token = message["token"] if message["op"] == "hello" else None
+        except Exception:
+            token = None
+        if not isinstance(token, str) or not hmac.compare_digest(
+                token.encode(), self.token.encode()):
+            logging.warning("Refusing a connection from %s without the right "
+                            "token", writer.get_extra_info("peername"))
+            writer.write(dumps({"error": "wrong token"}) + b"\n")
+            return False
+        writer.write(dumps({}) + b"\n")
+        await writer.drain()
+        return True
+
+    async def _serve(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        if not await self._hello(reader, writer):
+            writer.close()
+            return
+        # The units this connection has leased
+        leased: Dict[int, tuple] = {}
+        task = asyncio.current_task()
+        assert task is not None
+        self._connections.add(task)
+        self._writers.add(writer)
+        try:
+            while line := await reader.readline():
+                writer.write(
+                    dumps(await self._reply(loads(line), leased)) + b"\n")
+                await writer.drain()
+        except Exception as e:
+            logging.warning("Dropping worker connection: %r", e)
+        finally:
+            self._connections.discard(task)
+            self._writers.discard(writer)
+            # A worker that went away gives its units back to be redone
+            if leased:
+                logging.warning("Lost a worker, redoing units %s",
+                                list(leased))
+            for unit in leased.values():
+                await self._return(unit)
+            writer.close()
+
+    async def _wait(self, processes: List[Any]) -> None:
+        async with self._changed:
+            while not self._finished():
+                try:
+                    await asyncio.wait_for(
+                        self._changed.wait_for(self._finished), 1)
+                except asyncio.TimeoutError:
+                    if (processes and not self._connections
+                            and not any(p.is_alive() for p in processes)):
+                        raise Exception("Every worker process exited before "
+                                        "the crawl finished!")
+
+    async def run(self,
+                  processes: int = 0,
+                  tasks: int = 4,
+                  api_key: str = "",
+                  cache: Optional[Path] = Path("cache"),
+                  store: Optional[Path] = None) -> CrawlProgress:
+        """Plan any new queries, then serve the pending units to workers until
+        every one is done or has failed, logging progress every
+        job.report_every seconds.
+
+        processes worker processes are started on this machine, each fetching
+        tasks pages at a time with api_key into cache and store (which can be
+        the same files for every worker). Otherwise start workers yourself
+        once this is listening on address."""
+        await self.job.plan()
+        self._queue = deque(self.job.pending_units())
+        logging.info("%d pages to fetch", len(self._queue))
+
+        server = await asyncio.start_server(self._serve, self.host,
+                                            self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        logging.info("Coordinating workers on %s:%d", self.host, self.port)
+
+        # Spawned, not forked, so workers don't inherit our event loop and
+        # database connections
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(target=_worker_process,
+                            args=(self.address, self.token, api_key, cache,
+                                  store, tasks, self.job.manager.base_url))
+            for _ in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+
+        self.job.start_run()
+        reporter = asyncio.create_task(self.job.report())
+        try:
+            await self._wait(workers)
+        finally:
+            reporter.cancel()
+            loop = asyncio.get_running_loop()
+            for worker in workers:
+                await loop.run_in_executor(None, worker.join)
+            server.close()
+            # Workers hang up once they hear there's nothing left, give them
+            # a moment before hanging up on them
+            if self._connections:
+                await asyncio.wait(list(self._connections), timeout=5)
+            for writer in list(self._writers):
+                writer.close()
+            if self._connections:
+                await asyncio.wait(list(self._connections), timeout=1)
+
+        progress = self.job.progress()
+        logging.info("%s", progress)
+        return progress
+
+
+async def _work(manager: AsyncLumenAPIManager, store: Optional[NoticeStore],
+                address: Address, token: str) -> int:
+    connection = await _Connection.open(address, token)
+    pages = 0
+    try:
+        while True:
+            unit = await connection.request({"op": "lease"})
+            if unit["unit_id"] is None:
+                return pages
+            try:
+                data = await manager._req(unit["path"], unit["params"])
+                notices: List[Dict[str, Any]] = data['notices']
+                if store is not None:
+                    store.add(notices)
+            except Exception as e:
+                await connection.request({
+                    "op": "failed",
+                    "unit_id": unit["unit_id"],
+                    "error": repr(e)
+                })
+                continue
+            await connection.request({
+                "op": "done",
+                "unit_id": unit["unit_id"],
+                "notices": len(notices)
+            })
+            pages += 1
+    finally:
+        await connection.close()
+
+
+async def run_worker(address: Address,
+                     token: str,
+                     api_key: str,
+                     cache: Optional[Path] = Path("cache"),
+                     store: Optional[Path] = None,
+                     tasks: int = 4,
+                     base_url: str = "https://lumendatabase.org") -> int:
+    """Fetch pages for the coordinator at address, which has to have the same
+    token, until it runs out, returning how many this worker did. tasks pages
+    are fetched at a time, each over its own connection, and their notices are
+    added to store if given. Several workers on one machine can share a cache
+    and store."""
+    rate_limiter = RemoteTokenBucket(await _Connection.open(address, token))
+    notice_store = NoticeStore(store) if store else None
+    try:
+        async with AsyncLumenAPIManager(api_key,
+                                        cache=cache,
+                                        rate_limiter=rate_limiter,
+                                        base_url=base_url) as api:
+            pages = await asyncio.gather(
+                *(_work(api, notice_store, address, token)
+                  for _ in range(tasks)))
+    finally:
+        await rate_limiter.connection.close()
+        if notice_store is not None:
+            notice_store.close()
+    return sum(pages)
+
+
+def _worker_process(address: Address, token: str, api_key: str,
+                    cache: Optional[Path], store: Optional[Path], tasks: int,
+                    base_url: str) -> None:
+    # The coordinator logs progress, workers only say when something's wrong
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(
+        run_worker(address, token, api_key, cache, store, tasks, base_url))
+
+
+def _parse_address(address: str) -> Address:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+async def coordinate(args: argparse.Namespace,
+                     api_key: str) -> CrawlProgress:
+    async with AsyncLumenAPIManager(api_key,
+                                    cache=args.cache,
+                                    rate_limiter=TokenBucket(args.rate),
+                                    base_url=args.base_url) as api:
+        with CrawlJob(api, args.job, per_page=args.per_page) as job:
+            if args.queries:
+                job.add_specs(read_queries(args.queries))
+            if args.retry_failed:
+                job.retry_failed()
+            coordinator = CrawlCoordinator(job, args.host, args.port,
+                                           args.token)
+            return await coordinator.run(args.processes, args.tasks, api_key,
+                                         args.cache, args.store)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Crawl with several worker processes (on this machine "
+        "or others) sharing one rate limit.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    coordinator_parser = commands.add_parser(
+        "coordinator", help="run a crawl job, handing its pages to workers")
+    coordinator_parser.add_argument("job",
+                                    type=Path,
+                                    help="the job's SQLite file")
+    coordinator_parser.add_argument(
+        "--queries", type=Path, help="JSON file of query specs to add to the "
+        "job")
+    coordinator_parser.add_argument("--processes",
+                                    type=int,
+                                    default=multiprocessing.cpu_count(),
+                                    help="workers to start on this machine")
+    coordinator_parser.add_argument("--host",
+                                    default="127.0.0.1",
+                                    help="address to listen on, use 0.0.0.0 "
+                                    "for workers on other machines")
+    coordinator_parser.add_argument("--port", type=int, default=0)
+    coordinator_parser.add_argument("--per-page", type=int, default=100)
+    coordinator_parser.add_argument("--rate",
+                                    type=float,
+                                    default=0.5,
+                                    help="requests per second, for everyone")
+    coordinator_parser.add_argument("--retry-failed", action="store_true")
+
+    worker_parser = commands.add_parser(
+        "worker", help="fetch pages for a coordinator")
+    worker_parser.add_argument("coordinator", help="the coordinator's "
+                               "host:port")
+
+    for command_parser in (coordinator_parser, worker_parser):
+        command_parser.add_argument("--store",
+                                    type=Path,
+                                    help="NoticeStore to add the notices to")
+        command_parser.add_argument("--cache",
+                                    type=Path,
+                                    default=Path("cache"))
+        command_parser.add_argument("--tasks",
+                                    type=int,
+                                    default=4,
+                                    help="pages each worker fetches at a time")
+        command_parser.add_argument("--base-url",
+                                    default="https://lumendatabase.org")
+        command_parser.add_argument(
+            "--token",
+            help="shared secret workers need to join, LUMEN_CLUSTER_TOKEN in "
+            ".env by default (needed unless the coordinator only listens on "
+            "this machine)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    api_key = getenv("LUMEN_API")
+    if not api_key:
+        print("A Lumen API key needs to be in a .env file, please see the "
+              "README")
+        exit(1)
+    args.token = args.token or getenv("LUMEN_CLUSTER_TOKEN")
+    if args.command == "worker":
+        if not args.token:
+            print("Workers need the coordinator's --token")
+            exit(1)
+        pages = asyncio.run(
+            run_worker(_parse_address(args.coordinator), args.token, api_key,
+                       args.cache, args.store, args.tasks, args.base_url))
+        print(f"Fetched {pages} pages")
+    else:
+        progress = asyncio.run(coordinate(args, api_key))
+        exit(1 if progress.failed else 0)
@@ -0,0 +1,435 @@
+import argparse
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from datetime import date
+from os import getenv
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from dotenv import load_dotenv
+
+from lumen.AsyncLumenAPIManager import AsyncLumenAPIManager
+from lumen.IncrementalSync import FETCH_PARAMS
+from lumen.NoticeStore import NoticeStore
+from lumen.RateLimiter import TokenBucket
+from lumen.SearchQuery import SearchQueryCore, Sort
+from lumen.ShardPlanner import EARLIEST_DATE, RESULT_WINDOW, ShardPlanner
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass(frozen=True)
+class CrawlProgress:
+    """How far along a crawl is. Rates and the ETA are for this run only."""
+    done: int
+    failed: int
+    pending: int
+    notices: int
+    elapsed: float
+    pages_per_second: float
+    notices_per_second: float
+    eta: Optional[float]
+
+    def __str__(self) -> str:
+        total = self.done + self.failed + self.pending
+        eta = (f"{self.eta / 60:.1f} minutes left"
+               if self.eta is not None else "ETA unknown")
+        return (f"{self.done}/{total} pages done ({self.failed} failed), "
+                f"{self.notices} notices, "
+                f"{self.pages_per_second:.2f} pages/s, "
+                f"{self.notices_per_second:.1f} notices/s, {eta}")
+
+
+class CrawlJob:
+    """A resumable crawl of any number of queries, kept in a SQLite file.
+
+    Each query is split into shards with ShardPlanner, and every page of every
+    shard becomes a unit of work in the file. Workers fetch the pending units
+    concurrently, add their notices to the store (if given), and mark each
+    unit done as soon as it's stored, one transaction per unit. If the process
+    dies, running the job again picks up exactly the units that weren't
+    finished; a unit that was stored but not yet marked done is just fetched
+    (from the cache) and stored again, which changes nothing.
+
+        job = CrawlJob(api, Path("crawl.sqlite"), NoticeStore(...))
+        job.add_query(SearchQueryCore().with_topic(Topic.DMCANotice))
+        await job.run()
+
+    Pages within a shard are sorted oldest first, so notices arriving while
+    the crawl runs don't shift the pages under it."""
+
+    def __init__(self,
+                 manager: AsyncLumenAPIManager,
+                 path: Path,
+                 store: Optional[NoticeStore] = None,
+                 per_page: int = 100,
+                 workers: int = 8,
+                 max_attempts: int = 3,
+                 report_every: float = 10):
+        self.manager = manager
+        self.path = path
+        self.store = store
+        self.per_page = per_page
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.report_every = report_every
+
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS queries (
+                query_id INTEGER PRIMARY KEY,
+                params TEXT NOT NULL,
+                start TEXT NOT NULL,
+                end TEXT,
+                planned INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (params, start, end))""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS units (
+                unit_id INTEGER PRIMARY KEY,
+                query_id INTEGER NOT NULL REFERENCES queries,
+                shard_start TEXT NOT NULL,
+                shard_end TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                notices INTEGER,
+                error TEXT,
+                UNIQUE (query_id, shard_start, page))""")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS units_status ON units (status)")
+        self.conn.commit()
+
+        self._started = time.monotonic()
+        self._pages_done = 0
+        self._notices_done = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def add_query(self,
+                  query: SearchQueryCore,
+                  start: date = EARLIEST_DATE,
+                  end: Optional[date] = None) -> bool:
+        """Add a query to crawl between start and end (until today if end is
+        None), returning False if the job already has it. Pagination, sorting
+        and date range params on the query are ignored."""
+        params = {
+            k: v
+            for k, v in query.canonical_params().items()
+            if k not in FETCH_PARAMS
+        }
+        with self.conn:
+            return self.conn.execute(
+                "INSERT OR IGNORE INTO queries (params, start, end) "
+                "VALUES (?, ?, ?)",
+                (json.dumps(params, sort_keys=True), start.isoformat(),
+                 end.isoformat() if end else None)).rowcount == 1
+
+    def add_specs(self, specs: Iterable[Dict[str, Any]]) -> int:
+        """Add queries given as specs (see read_queries), returning how many
+        were new."""
+        added = 0
+        for spec in specs:
+            spec = dict(spec)
+            start = spec.pop("start", None)
+            end = spec.pop("end", None)
+            query = SearchQueryCore()
+            query.params = spec
+            added += self.add_query(
+                query,
+                date.fromisoformat(start) if start else EARLIEST_DATE,
+                date.fromisoformat(end) if end else None)
+        return added
+
+    async def plan(self) -> int:
+        """Split every query that hasn't been planned yet into units, returning
+        how many units were added. A query's units are all added at once, so
+        a crash while planning just plans that query again."""
+        added = 0
+        for query_id, params, start, end in self.conn.execute(
+                "SELECT query_id, params, start, end FROM queries "
+                "WHERE NOT planned").fetchall():
+            query = SearchQueryCore()
+            query.params = json.loads(params)
+            planner = ShardPlanner(self.manager, query,
+                                   date.fromisoformat(start),
+                                   date.fromisoformat(end) if end else None)
+            shards = await planner.plan()
+            units = [(query_id, shard.start.isoformat(),
+                      shard.end.isoformat(), page, PENDING)
+                     for shard in shards
+                     for page in range(1,
+                                       shard.pages(self.per_page) + 1)]
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO units (query_id, shard_start, "
+                    "shard_end, page, status) VALUES (?, ?, ?, ?, ?)", units)
+                self.conn.execute(
+                    "UPDATE queries SET planned = 1 WHERE query_id = ?",
+                    (query_id, ))
+            added += len(units)
+            logging.info("Planned %d pages in %d shards for %s", len(units),
+                         len(shards), params)
+        return added
+
+    def retry_failed(self) -> int:
+        """Put units that ran out of attempts back in the queue, returning how
+        many there were."""
+        with self.conn:
+            return self.conn.execute(
+                "UPDATE units SET status = ?, attempts = 0 WHERE status = ?",
+                (PENDING, FAILED)).rowcount
+
+    def progress(self) -> CrawlProgress:
+        counts: Dict[str, int] = dict(
+            self.conn.execute(
+                "SELECT status, COUNT(*) FROM units GROUP BY status"))
+        notices = self.conn.execute(
+            "SELECT COALESCE(SUM(notices), 0) FROM units").fetchone()[0]
+        elapsed = time.monotonic() - self._started
+        pages_per_second = self._pages_done / elapsed if elapsed else 0
+        pending = counts.get(PENDING, 0)
+        return CrawlProgress(
+            done=counts.get(DONE, 0),
+            failed=counts.get(FAILED, 0),
+            pending=pending,
+            notices=notices,
+            elapsed=elapsed,
+            pages_per_second=pages_per_second,
+            notices_per_second=self._notices_done /
+            elapsed if elapsed else 0,
+            eta=pending / pages_per_second if pages_per_second else None)
+
+    def page_params(self, params: str, shard_start: str, shard_end: str,
+                    page: int) -> Dict[str, str]:
+        """The search params for a unit, given as pending_units returns it."""
+        query = SearchQueryCore()
+        query.params = json.loads(params)
+        return query.with_order(Sort.DateRecievedAsc).with_amount(
+            self.per_page).with_date_range(
+                date.fromisoformat(shard_start),
+                date.fromisoformat(shard_end)).with_page(page).params
+
+    def pending_units(self) -> List[tuple]:
+        """Every unit still to fetch, as (unit_id, params, shard_start,
+        shard_end, page)."""
+        return self.conn.execute(
+            "SELECT unit_id, params, shard_start, shard_end, page "
+            "FROM units JOIN queries USING (query_id) "
+            "WHERE status = ? ORDER BY unit_id", (PENDING, )).fetchall()
+
+    def finish_unit(self, unit_id: int, notices: int) -> Optional[tuple]:
+        """Mark a unit done once its notices are stored. This is the
+        checkpoint: once it commits, the unit is never redone.
+
+        Queries without an end date keep getting notices while they're
+        crawled, and pages are oldest first, so the newest shard's page count
+        from planning goes stale. When a full page of that shard is done, the
+        page after it is added too, and returned (like pending_units does) so
+        it can be queued. Paging only stops at a short page, or at the result
+        window."""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE units SET status = ?, notices = ?, error = NULL "
+                "WHERE unit_id = ?", (DONE, notices, unit_id))
+            next_unit = None
+            if notices >= self.per_page:
+                next_unit = self._next_page(unit_id)
+        self._pages_done += 1
+        self._notices_done += notices
+        return next_unit
+
+    def _next_page(self, unit_id: int) -> Optional[tuple]:
+        query_id, params, end, shard_start, shard_end, page = \
+            self.conn.execute(
+                "SELECT query_id, params, end, shard_start, shard_end, page "
+                "FROM units JOIN queries USING (query_id) WHERE unit_id = ?",
+                (unit_id, )).fetchone()
+        if end is not None or (page + 1) * self.per_page > RESULT_WINDOW:
+            return None
+        newest = self.conn.execute(
+            "SELECT MAX(shard_start) FROM units WHERE query_id = ?",
+            (query_id, )).fetchone()[0]
+        if shard_start != newest:
+            return None
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO units (query_id, shard_start, shard_end, "
+            "page, status) VALUES (?, ?, ?, ?, ?)",
+            (query_id, shard_start, shard_end, page + 1, PENDING))
+        if cursor.rowcount != 1:
+            # Already there, planned or added by an earlier page
+            return None
+        logging.info("Page %d of %s..%s for %s was full, adding page %d",
+                     page, shard_start, shard_end, params, page + 1)
+        return (cursor.lastrowid, params, shard_start, shard_end, page + 1)
+
+    def fail_unit(self, unit_id: int, error: str) -> bool:
+        """Count a failed attempt at a unit, returning whether it should be
+        tried again (otherwise it's marked failed)."""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE units SET attempts = attempts + 1, error = ? "
+                "WHERE unit_id = ?", (error, unit_id))
+            attempts = self.conn.execute(
+                "SELECT attempts FROM units WHERE unit_id = ?",
+                (unit_id, )).fetchone()[0]
+            if attempts >= self.max_attempts:
+                self.conn.execute(
+                    "UPDATE units SET status = ? WHERE unit_id = ?",
+                    (FAILED, unit_id))
+        return attempts < self.max_attempts
+
+    async def _work(self, units: "asyncio.Queue[Optional[tuple]]") -> None:
+        """Fetch units until told to stop with None. Any unit to redo or go
+        on with is queued before this one's marked done, so units.join()
+        only returns once nothing is left anywhere."""
+        while True:
+            unit = await units.get()
+            try:
+                if unit is None:
+                    return
+                await self._fetch(units, unit)
+            finally:
+                units.task_done()
+
+    async def _fetch(self, units: "asyncio.Queue[Optional[tuple]]",
+                     unit: tuple) -> None:
+        unit_id, params, shard_start, shard_end, page = unit
+
+        try:
+            data = await self.manager._req(
+                "/notices/search.json",
+                self.page_params(params, shard_start, shard_end, page))
+            notices: List[Dict[str, Any]] = data['notices']
+            if self.store is not None:
+                self.store.add(notices)
+        except Exception as e:
+            logging.warning("Failed to get page %d of %s..%s for %s: %r",
+                            page, shard_start, shard_end, params, e)
+            if self.fail_unit(unit_id, repr(e)):
+                units.put_nowait(unit)
+            return
+
+        next_unit = self.finish_unit(unit_id, len(notices))
+        if next_unit is not None:
+            units.put_nowait(next_unit)
+
+    def start_run(self) -> None:
+        """Start timing a run, for the rates and ETA in progress."""
+        self._started = time.monotonic()
+        self._pages_done = self._notices_done = 0
+
+    async def report(self) -> None:
+        """Log progress every report_every seconds, until cancelled."""
+        while True:
+            await asyncio.sleep(self.report_every)
+            logging.info("%s", self.progress())
+
+    async def run(self) -> CrawlProgress:
+        """Plan any new queries, then fetch every pending unit with `workers`
+        workers (the manager's rate limiter spaces out the requests), logging
+        progress every report_every seconds."""
+        await self.plan()
+
+        units: "asyncio.Queue[Optional[tuple]]" = asyncio.Queue()
+        for unit in self.pending_units():
+            units.put_nowait(unit)
+        logging.info("%d pages to fetch", units.qsize())
+
+        self.start_run()
+        reporter = asyncio.create_task(self.report())
+        # Workers wait for more while units are in flight (they can fail and
+        # come back, or bring the next page), and stop once every unit is done
+        workers = [
+            asyncio.create_task(self._work(units))
+            for _ in range(self.workers)
+        ]
+        joined = asyncio.create_task(units.join())
+        try:
+            # A worker only finishes early if it crashed
+            await asyncio.wait([joined, *workers],
+                               return_when=asyncio.FIRST_COMPLETED)
+            for _ in workers:
+                units.put_nowait(None)
+            await asyncio.gather(*workers)
+        finally:
+            reporter.cancel()
+            joined.cancel()
+            for worker in workers:
+                worker.cancel()
+
+        progress = self.progress()
+        logging.info("%s", progress)
+        return progress
+
+
+def read_queries(path: Path) -> Iterable[Dict[str, Any]]:
+    """Query specs from a JSON file holding a list of them, or a file with
+    one per line. A spec is a dict of search params, plus optional start and
+    end dates (like "2020-01-31")."""
+    text = path.read_text()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+async def main(args: argparse.Namespace, api_key: str) -> CrawlProgress:
+    async with AsyncLumenAPIManager(api_key,
+                                    cache=args.cache,
+                                    rate_limiter=TokenBucket(args.rate),
+                                    base_url=args.base_url) as api:
+        store = NoticeStore(args.store) if args.store else None
+        with CrawlJob(api, args.job, store, args.per_page,
+                      args.workers) as job:
+            if args.queries:
+                job.add_specs(read_queries(args.queries))
+            if args.retry_failed:
+                job.retry_failed()
+            progress = await job.run()
+        if store is not None:
+            store.close()
+        return progress
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Crawl every result of some queries, resuming where the "
+        "last run stopped.")
+    parser.add_argument("job", type=Path, help="the job's SQLite file")
+    parser.add_argument("--queries",
+                        type=Path,
+                        help="JSON file of query specs to add to the job")
+    parser.add_argument("--store",
+                        type=Path,
+                        help="NoticeStore to add the notices to")
+    parser.add_argument("--cache", type=Path, default=Path("cache"))
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--per-page", type=int, default=100)
+    parser.add_argument("--rate",
+                        type=float,
+                        default=0.5,
+                        help="requests per second")
+    parser.add_argument("--base-url", default="https://lumendatabase.org")
+    parser.add_argument("--retry-failed", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    api_key = getenv("LUMEN_API")
+    if not api_key:
+        print("A Lumen API key needs to be in a .env file, please see the "
+              "README")
+        exit(1)
+    progress = asyncio.run(main(args, api_key))
+    exit(1 if progress.failed else 0)
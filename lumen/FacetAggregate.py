@@ -0,0 +1,224 @@
+import heapq
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import (Any, Counter, Deque, Dict, Iterable, Iterator, List,
+                    Optional, Union)
+
+from lumen.CacheBackend import CacheBackend, open_cache
+from lumen.IdSet import IdSet
+from lumen.SearchResult import (CompactNotice, Metadata, NameCount, Notice,
+                                NoticeFilter)
+
+# Each Metadata field, and the notice field it counts
+FIELDS = {
+    "principals": "principal_name",
+    "recipients": "recipient_name",
+    "senders": "sender_name",
+    "topics": "topics",
+    "tags": "tags",
+    "countries": "jurisdictions",
+    "lang": "language",
+    "action_taken": "action_taken",
+    "submitters": "submitter_name",
+    "submitter_country": "submitter_country_code",
+}
+# The Lumen facet for each Metadata field, see meta_from_facets
+FACET_NAMES = {
+    "principals": "principal_name_facet",
+    "recipients": "recipient_name_facet",
+    "senders": "sender_name_facet",
+    "topics": "topic_facet",
+    "tags": "tag_list_facet",
+    "countries": "country_code_facet",
+    "lang": "language_facet",
+    "action_taken": "action_taken_facet",
+    "submitters": "submitter_name_facet",
+    "submitter_country": "submitter_country_code_facet",
+}
+
+
+def _values(notice: Union[Notice, CompactNotice, Dict[str, Any]],
+            field: str) -> Iterator[str]:
+    if isinstance(notice, dict):
+        value = notice.get(field)
+    else:
+        # Notices don't have the submitter fields
+        value = getattr(notice, field, None)
+    if isinstance(value, (list, tuple)):
+        yield from (v for v in value if v)
+    elif value:
+        yield value
+
+
+class FacetAggregate:
+    """Counts the same things as Lumen's facets (see Metadata), but over any
+    notices you like: a filtered list, several pages, or a whole cache.
+
+    Every value is counted exactly, so aggregates of separate sets of notices
+    can be added together with + to get the aggregate of all of them, for
+    instance to sum up shards counted in parallel. Only turning them into
+    Metadata picks the top values."""
+
+    def __init__(self) -> None:
+        self.notices = 0
+        self.counts: Dict[str, Counter[str]] = {
+            name: Counter()
+            for name in FIELDS
+        }
+
+    def add(self, notice: Union[Notice, CompactNotice, Dict[str,
+                                                             Any]]) -> None:
+        """Count a notice, either a Notice or its JSON from Lumen."""
+        self.notices += 1
+        for name, field in FIELDS.items():
+            self.counts[name].update(_values(notice, field))
+
+    def update(
+        self, notices: Iterable[Union[Notice, CompactNotice, Dict[str, Any]]]
+    ) -> "FacetAggregate":
+        for notice in notices:
+            self.add(notice)
+        return self
+
+    def __iadd__(self, other: "FacetAggregate") -> "FacetAggregate":
+        self.notices += other.notices
+        for name, counter in other.counts.items():
+            self.counts[name].update(counter)
+        return self
+
+    def __add__(self, other: "FacetAggregate") -> "FacetAggregate":
+        total = FacetAggregate()
+        total += self
+        total += other
+        return total
+
+    def top(self, name: str, n: Optional[int] = 10) -> List[NameCount]:
+        """The n most common values of a Metadata field (or all of them if n
+        is None), most common first."""
+        counter = self.counts[name]
+        items: Iterable = counter.items()
+        if n is not None:
+            items = heapq.nlargest(n, items, key=lambda item: item[1])
+        else:
+            items = sorted(items, key=lambda item: item[1], reverse=True)
+        return [NameCount(key, count) for key, count in items]
+
+    def to_metadata(self, n: Optional[int] = 10) -> Metadata:
+        """Metadata with the top n values of each field, like a search's."""
+        return Metadata(**{name: self.top(name, n) for name in FIELDS})
+
+    def to_facets(self, n: Optional[int] = 10) -> Dict[str, Any]:
+        """The top n values of each field in the same format as the facets in
+        Lumen's search responses."""
+        return {
+            FACET_NAMES[name]: {
+                "buckets": [{
+                    "key": key,
+                    "doc_count": count
+                } for key, count in self.top(name, n)]
+            }
+            for name in FIELDS
+        }
+
+    @classmethod
+    def from_notices(
+        cls, notices: Iterable[Union[Notice, CompactNotice, Dict[str, Any]]]
+    ) -> "FacetAggregate":
+        return cls().update(notices)
+
+    @classmethod
+    def from_cache(cls,
+                   cache: Union[Path, CacheBackend],
+                   notice_filter: Optional[NoticeFilter] = None,
+                   parallel: bool = False,
+                   max_workers: Optional[int] = None,
+                   chunksize: int = 64,
+                   dedupe: bool = True) -> "FacetAggregate":
+        """Aggregate every notice in a cache (optionally filtered). With
+        dedupe set, a notice cached by several queries (or on overlapping
+        pages) is only counted once. With parallel set, chunks of chunksize
+        entries are read in a pool of processes, a couple per worker at a
+        time, and their partial aggregates are added up. Deduping needs every
+        id in one place, so then the workers send back just the counted
+        fields of each notice instead."""
+        backend = open_cache(cache)
+        assert backend is not None
+        total = cls()
+        seen = IdSet() if dedupe else None
+
+        if not parallel:
+            for hash_key in backend.keys():
+                total._add_new(seen,
+                               _chunk_notices(backend, [hash_key],
+                                              notice_filter))
+            return total
+
+        hash_keys = backend.keys()
+        max_workers = max_workers or os.cpu_count() or 1
+        work = _chunk_notices if dedupe else _aggregate_chunk
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            in_flight: Deque[Future] = deque()
+
+            def submit_next() -> bool:
+                chunk = list(islice(hash_keys, chunksize))
+                if chunk:
+                    in_flight.append(
+                        executor.submit(work, backend, chunk, notice_filter))
+                return bool(chunk)
+
+            # Keep every worker busy with one chunk queued behind it
+            for _ in range(2 * max_workers):
+                if not submit_next():
+                    break
+
+            while in_flight:
+                partial = in_flight.popleft().result()
+                submit_next()
+                if dedupe:
+                    total._add_new(seen, partial)
+                else:
+                    total += partial
+        return total
+
+    def _add_new(self, seen: Optional[IdSet],
+                 notices: Iterable[Dict[str, Any]]) -> None:
+        """Count the notices whose id isn't in seen (all of them if seen is
+        None, or if they have no id)."""
+        for notice in notices:
+            id = notice.get('id')
+            if seen is None or id is None or seen.add(id):
+                self.add(notice)
+
+
+def _chunk_notices(backend: CacheBackend, hash_keys: Iterable[str],
+                   notice_filter: Optional[NoticeFilter]
+                   ) -> List[Dict[str, Any]]:
+    """The notices of some entries, cut down to their id and the fields an
+    aggregate counts. Runs in a worker process when parallel."""
+    fields = ("id", ) + tuple(FIELDS.values())
+    notices = []
+    for hash_key in hash_keys:
+        data = backend.get(hash_key)
+        if data is None:
+            continue
+        for notice in data.get('notices', []):
+            if notice_filter is None or notice_filter.matches(notice):
+                notices.append({field: notice.get(field) for field in fields})
+    return notices
+
+
+def _aggregate_chunk(backend: CacheBackend, hash_keys: Iterable[str],
+                     notice_filter: Optional[NoticeFilter]) -> FacetAggregate:
+    """Runs in a worker process: aggregate the notices of some entries."""
+    aggregate = FacetAggregate()
+    for hash_key in hash_keys:
+        data = backend.get(hash_key)
+        if data is None:
+            continue
+        aggregate.update(
+            notice for notice in data.get('notices', [])
+            if notice_filter is None or notice_filter.matches(notice))
+    return aggregate
@@ -0,0 +1,77 @@
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+# Optional, only needed for HTTP/2
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+HEADERS = {"User-Agent": "CSE291BResearch", "Accept-Encoding": "gzip"}
+# Give up on a connection that hangs instead of stalling forever. Reads are
+# per chunk, so big pages don't need a bigger read timeout
+DEFAULT_TIMEOUT = httpx.Timeout(60, connect=10)
+# As many connections as AdaptiveConcurrency allows requests by default
+DEFAULT_LIMITS = httpx.Limits(max_connections=32,
+                              max_keepalive_connections=32,
+                              keepalive_expiry=60)
+
+
+def _check_http2(http2: bool) -> None:
+    if http2 and h2 is None:
+        raise Exception("HTTP/2 needs the h2 package, install httpx[http2]!")
+
+
+def async_client(
+        http2: bool = False,
+        limits: httpx.Limits = DEFAULT_LIMITS,
+        timeout: httpx.Timeout = DEFAULT_TIMEOUT) -> httpx.AsyncClient:
+    """An AsyncClient set up for Lumen, which can be passed as client to
+    several AsyncLumenAPIManagers so they share one connection pool.
+
+    The pool needs about as many connections as requests in flight, which is
+    roughly the rate limit times how long a request takes (so 10 requests a
+    second taking half a second each needs 5). With http2 every request goes
+    over one connection instead."""
+    _check_http2(http2)
+    return httpx.AsyncClient(headers=HEADERS,
+                             http2=http2,
+                             limits=limits,
+                             timeout=timeout)
+
+
+def client(http2: bool = False,
+           limits: httpx.Limits = DEFAULT_LIMITS,
+           timeout: httpx.Timeout = DEFAULT_TIMEOUT) -> httpx.Client:
+    """A Client set up for Lumen, which can be passed as client to several
+    LumenAPIManagers so they share one connection pool."""
+    _check_http2(http2)
+    return httpx.Client(headers=HEADERS,
+                        http2=http2,
+                        limits=limits,
+                        timeout=timeout)
+
+
+class ConnectionTrace:
+    """Passed to httpx as a request's trace extension, to find out whether the
+    request opened a new connection (and how long connecting took) or reused
+    one from the pool."""
+
+    def __init__(self) -> None:
+        self.new = False
+        self.seconds = 0.0
+        self._started: Optional[float] = None
+
+    def __call__(self, event: str, info: Dict[str, Any]) -> None:
+        if event == "connection.connect_tcp.started":
+            self.new = True
+            self._started = time.perf_counter()
+        elif (event.startswith("connection.")
+              and event.endswith(".complete") and self._started is not None):
+            # Connecting is done once TCP (and TLS, if any) are
+            self.seconds = time.perf_counter() - self._started
+
+    async def atrace(self, event: str, info: Dict[str, Any]) -> None:
+        self(event, info)
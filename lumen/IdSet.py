@@ -0,0 +1,129 @@
+from typing import Iterable, Iterator, Tuple
+
+import numpy as np
+
+# How many bits are set in each possible byte
+_BITS_SET = np.array([bin(byte).count("1") for byte in range(256)],
+                     dtype=np.int64)
+
+
+class IdSet:
+    """A set of notice ids kept as a bitmap, one bit per id up to the largest
+    one. Lumen's ids are dense (they count up from 1), so even every notice
+    there is fits in a few megabytes, checking or adding an id is a couple of
+    byte operations, and &, |, - and ^ between sets run over the bitmaps with
+    numpy instead of over the ids one at a time.
+
+        seen = IdSet(notice.id for notice in result.notices)
+        both = IdSet(a_ids) & IdSet(b_ids)
+    """
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self.bits = bytearray()
+        self._len = 0
+        self.update(ids)
+
+    @classmethod
+    def _from_bits(cls, bits: np.ndarray) -> "IdSet":
+        ids = cls()
+        ids.bits = bytearray(bits.tobytes())
+        ids._len = int(_BITS_SET[bits].sum())
+        return ids
+
+    def add(self, id: int) -> bool:
+        """Add an id, returning whether it's new."""
+        if id < 0:
+            raise Exception("Notice ids can't be negative!")
+        byte = id >> 3
+        if byte >= len(self.bits):
+            self._grow(byte)
+        mask = 1 << (id & 7)
+        if self.bits[byte] & mask:
+            return False
+        self.bits[byte] |= mask
+        self._len += 1
+        return True
+
+    def _grow(self, byte: int) -> None:
+        # Grow by at least half again, so adding ids in order is cheap
+        self.bits.extend(
+            bytes(max(byte + 1,
+                      len(self.bits) * 3 // 2) - len(self.bits)))
+
+    def update(self, ids: Iterable[int]) -> int:
+        """Add ids, returning how many were new. Much faster than add for
+        lots of ids at once."""
+        array = np.sort(np.fromiter(ids, dtype=np.int64))
+        if not len(array):
+            return 0
+        # Drop repeats (much faster than np.unique)
+        array = array[np.concatenate(([True], array[1:] != array[:-1]))]
+        if array[0] < 0:
+            raise Exception("Notice ids can't be negative!")
+        if array[-1] >> 3 >= len(self.bits):
+            self._grow(int(array[-1]) >> 3)
+        view = np.frombuffer(self.bits, dtype=np.uint8)
+        masks = np.left_shift(1, array & 7).astype(np.uint8)
+        new = (view[array >> 3] & masks) == 0
+        np.bitwise_or.at(view, array[new] >> 3, masks[new])
+        added = int(new.sum())
+        self._len += added
+        return added
+
+    def discard(self, id: int) -> None:
+        byte = id >> 3
+        mask = 1 << (id & 7)
+        if 0 <= byte < len(self.bits) and self.bits[byte] & mask:
+            self.bits[byte] &= ~mask
+            self._len -= 1
+
+    def __contains__(self, id: object) -> bool:
+        if not isinstance(id, int) or id < 0:
+            return False
+        byte = id >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 <<
+                                                                 (id & 7)))
+
+    def __len__(self) -> int:
+        return self._len
+
+    def to_array(self) -> np.ndarray:
+        """The ids, smallest first."""
+        return np.flatnonzero(
+            np.unpackbits(np.frombuffer(self.bits, dtype=np.uint8),
+                          bitorder="little"))
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.to_array().tolist())
+
+    def _aligned(self, other: "IdSet") -> Tuple[np.ndarray, np.ndarray]:
+        size = max(len(self.bits), len(other.bits))
+        mine = np.zeros(size, dtype=np.uint8)
+        theirs = np.zeros(size, dtype=np.uint8)
+        mine[:len(self.bits)] = np.frombuffer(self.bits, dtype=np.uint8)
+        theirs[:len(other.bits)] = np.frombuffer(other.bits, dtype=np.uint8)
+        return mine, theirs
+
+    def __and__(self, other: "IdSet") -> "IdSet":
+        mine, theirs = self._aligned(other)
+        return self._from_bits(mine & theirs)
+
+    def __or__(self, other: "IdSet") -> "IdSet":
+        mine, theirs = self._aligned(other)
+        return self._from_bits(mine | theirs)
+
+    def __sub__(self, other: "IdSet") -> "IdSet":
+        mine, theirs = self._aligned(other)
+        return self._from_bits(mine & ~theirs)
+
+    def __xor__(self, other: "IdSet") -> "IdSet":
+        mine, theirs = self._aligned(other)
+        return self._from_bits(mine ^ theirs)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, IdSet):
+            return NotImplemented
+        return len(self) == len(other) and not (self ^ other)
+
+    def __repr__(self) -> str:
+        return f"IdSet({len(self)} ids)"
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from lumen.AsyncLumenAPIManager import AsyncLumenAPIManager
+from lumen.CacheBackend import cache_key
+from lumen.IdSet import IdSet
+from lumen.NoticeStore import NoticeStore
+from lumen.SearchQuery import AsyncSearchQuery, SearchQueryCore, Sort
+from lumen.SearchResult import Notice, notice_from_data
+
+# Params that change how results are fetched, not which notices match
+FETCH_PARAMS = ("page", "per_page", "sort_by", "date_received_facet")
+
+
+def _match_params(query: SearchQueryCore) -> Dict[str, str]:
+    return {k: v for k, v in query.params.items() if k not in FETCH_PARAMS}
+
+
+def query_key(query: SearchQueryCore) -> str:
+    """Identifies a query by the notices it matches, ignoring pagination,
+    sorting and date range."""
+    return cache_key("/notices/search.json", _match_params(query))[1]
+
+
+class IncrementalSync:
+    """Keep a NoticeStore up to date with queries, only fetching what's new.
+
+    For each query we remember the newest date_received we've seen. Syncing
+    again asks Lumen for notices from that day onwards, newest first, and stops
+    paging as soon as it reaches a notice older than that. Queries are
+    tracked separately, so notices another query already put in the store
+    still count as new for this one. Pages are always requested from Lumen
+    rather than the cache, since the cache would have last time's results.
+
+    The first sync of a query has no date to start from, so it pages through
+    everything (up to max_pages, if set)."""
+
+    def __init__(self,
+                 manager: AsyncLumenAPIManager,
+                 store: NoticeStore,
+                 per_page: int = 100,
+                 max_pages: Optional[int] = None):
+        self.manager = manager
+        self.store = store
+        self.per_page = per_page
+        self.max_pages = max_pages
+
+    async def sync(self, query: SearchQueryCore) -> List[Notice]:
+        """Fetch the notices matching query that are newer than the last sync,
+        add them to the store, and return them (newest first)."""
+        key = query_key(query)
+        params = _match_params(query)
+        high_water = self.store.high_water(key)
+
+        search = AsyncSearchQuery(self.manager)
+        search.params = params.copy()
+        search = search.with_order(Sort.DateReceivedDesc).with_amount(
+            self.per_page)
+        if high_water is not None:
+            # Date ranges are by local day but high_water is in UTC, so start
+            # a day before the last one we saw (whatever the timezone, that's
+            # before high_water, and the overlap is skipped below) and go
+            # until the end of today
+            search = search.with_date_range(
+                date.fromisoformat(high_water[:10]) - timedelta(days=1),
+                date.today() + timedelta(days=1))
+
+        new = []
+        # Pages shift as notices arrive, so the same notice can come up twice
+        seen = IdSet()
+        page = 1
+        while self.max_pages is None or page <= self.max_pages:
+            page_params = search.copy().with_page(page).params
+            data = await self.manager._req("/notices/search.json",
+                                           page_params,
+                                           refresh=True)
+            notices = data['notices']
+
+            caught_up = False
+            for notice in notices:
+                received = notice.get('date_received') or ""
+                if high_water is not None:
+                    if received < high_water:
+                        caught_up = True
+                        break
+                    if received == high_water and notice['id'] in self.store:
+                        # Received at the same moment as the newest notice
+                        # last time, so it was probably synced then
+                        continue
+                if seen.add(notice['id']):
+                    new.append(notice)
+
+            if caught_up or len(notices) < self.per_page:
+                break
+            page += 1
+
+        self.store.add(new)
+        newest = max((n['date_received']
+                      for n in new if n.get('date_received')),
+                     default=None)
+        if newest is not None and (high_water is None or newest > high_water):
+            self.store.set_high_water(key, params, newest)
+
+        logging.info("Synced %d new notices for %s", len(new), params)
+        return [notice_from_data(notice) for notice in new]
+
+    async def sync_all(
+            self,
+            queries: Iterable[SearchQueryCore]) -> Dict[str, List[Notice]]:
+        """Sync several queries concurrently, returning the new notices for
+        each by query_key."""
+        queries = list(queries)
+        results = await asyncio.gather(*(self.sync(q) for q in queries))
+        return {query_key(q): r for q, r in zip(queries, results)}
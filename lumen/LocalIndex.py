@@ -0,0 +1,279 @@
+import argparse
+import logging
+import re
+import sqlite3
+from array import array
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+from urllib.parse import urlparse
+
+import numpy as np
+
+from lumen.CacheBackend import CacheBackend, open_cache
+from lumen.Codec import dumps, loads
+from lumen.FacetAggregate import FACET_NAMES, FacetAggregate
+from lumen.SearchQuery import SearchQueryCore, Sort
+from lumen.SearchResult import SearchResult
+
+# The query params that search a field, and the fields they search
+FIELDS = {
+    "title": ("title", ),
+    "topics": ("topics", ),
+    "tags": ("tags", ),
+    "jurisdictions": ("jurisdictions", ),
+    "sender_name": ("sender_name", ),
+    "principal_name": ("principal_name", ),
+    "recipient_name": ("recipient_name", ),
+    "works": ("works", ),
+    "action_taken": ("action_taken", ),
+    "term": ("title", "topics", "tags", "jurisdictions", "sender_name",
+             "principal_name", "recipient_name", "works", "domains"),
+}
+DEFAULT_PER_PAGE = 10
+# Notices loaded from the index per query
+LOAD_BATCH = 500
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return re.findall(r"\w+", text.lower()) if text else []
+
+
+def _field_text(notice: Dict[str, Any], field: str) -> Iterator[str]:
+    """The text of a field of a notice, as one or more strings."""
+    if field == "works":
+        for work in notice.get('works', []):
+            if work.get('description'):
+                yield work['description']
+    elif field == "domains":
+        for work in notice.get('works', []):
+            for urlJSON in work.get('infringing_urls', []):
+                yield urlparse(urlJSON['url']).netloc
+    else:
+        value = notice.get(field)
+        if isinstance(value, list):
+            yield from (v for v in value if v)
+        elif value:
+            yield value
+
+
+def _to_iso(epoch_ms: str) -> str:
+    # Formatted exactly like Lumen's date_received (UTC, to the millisecond),
+    # so comparing the text compares the times, bounds included
+    when = datetime.fromtimestamp(int(epoch_ms) / 1000, timezone.utc)
+    return when.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class LocalIndex:
+    """An inverted index over cached notices, searchable offline with the same
+    query builder as the API:
+
+        index = LocalIndex.build(Path("cache"), Path("index.sqlite"))
+        result = index.search(SearchQueryCore().with_title("star wars"))
+
+    Notices are numbered in date_received order, so every posting list is
+    sorted by date. Searching gives back a SearchResult like the API does.
+
+    Words are matched exactly (lowercased), and across fields like the API
+    words are OR'd together unless the field's require_all is set. There's no
+    relevancy score, so relevancy sorts return the newest notices first."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.conn = sqlite3.connect(self.path)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    @classmethod
+    def build(cls, cache: Union[Path, CacheBackend],
+              path: Path) -> "LocalIndex":
+        """Index every notice in a cache into a new index at path. Notices that
+        show up in several cache entries are only indexed once."""
+        backend = open_cache(cache)
+        assert backend is not None
+        path.unlink(missing_ok=True)
+        index = cls(path)
+        conn = index.conn
+
+        conn.execute("""CREATE TEMPORARY TABLE raw (
+                id INTEGER UNIQUE,
+                date_received TEXT,
+                data BLOB NOT NULL)""")
+        with conn:
+            for _, data in backend.items():
+                conn.executemany(
+                    "INSERT OR IGNORE INTO raw VALUES (?, ?, ?)",
+                    ((notice.get('id'), notice.get('date_received'),
+                      dumps(notice)) for notice in data.get('notices', [])))
+
+        # Number the notices by date, so doc ids sort the same as dates
+        conn.execute("""CREATE TABLE docs (
+                doc_id INTEGER PRIMARY KEY,
+                date_received TEXT,
+                data BLOB NOT NULL)""")
+        with conn:
+            conn.execute("""INSERT INTO docs
+                    SELECT row_number() OVER (ORDER BY date_received) - 1,
+                        date_received, data FROM raw""")
+            conn.execute("DROP TABLE raw")
+            conn.execute("CREATE INDEX docs_date ON docs (date_received)")
+
+        postings: Dict[tuple, array] = defaultdict(lambda: array("i"))
+        for doc_id, data in conn.execute(
+                "SELECT doc_id, data FROM docs ORDER BY doc_id"):
+            notice = loads(data)
+            for field in FIELDS["term"]:
+                terms = {
+                    token
+                    for text in _field_text(notice, field)
+                    for token in tokenize(text)
+                }
+                for term in terms:
+                    postings[(field, term)].append(doc_id)
+            if notice.get('action_taken'):
+                postings[("action_taken",
+                          notice['action_taken'].lower())].append(doc_id)
+
+        conn.execute("""CREATE TABLE postings (
+                field TEXT NOT NULL,
+                term TEXT NOT NULL,
+                docs BLOB NOT NULL,
+                PRIMARY KEY (field, term))""")
+        with conn:
+            conn.executemany(
+                "INSERT INTO postings VALUES (?, ?, ?)",
+                ((field, term, docs.tobytes())
+                 for (field, term), docs in postings.items()))
+
+        logging.info("Indexed %d notices with %d terms into %s", len(index),
+                     len(postings), path)
+        return index
+
+    def _postings(self, field: str, term: str) -> np.ndarray:
+        row = self.conn.execute(
+            "SELECT docs FROM postings WHERE field = ? AND term = ?",
+            (field, term)).fetchone()
+        if not row:
+            return np.empty(0, dtype=np.int32)
+        return np.frombuffer(row[0], dtype=np.int32)
+
+    def _match(self, key: str, value: str, require_all: bool) -> np.ndarray:
+        """The sorted doc ids matching one query param."""
+        if key == "action_taken":
+            return self._postings("action_taken", value.lower())
+
+        matches: Optional[np.ndarray] = None
+        for term in tokenize(value):
+            # A word can be in any of the param's fields
+            docs = np.empty(0, dtype=np.int32)
+            for field in FIELDS[key]:
+                docs = np.union1d(docs, self._postings(field, term))
+            if matches is None:
+                matches = docs
+            elif require_all:
+                matches = np.intersect1d(matches, docs, assume_unique=True)
+            else:
+                matches = np.union1d(matches, docs)
+        return matches if matches is not None else np.empty(0,
+                                                            dtype=np.int32)
+
+    def _date_bounds(self, facet: str) -> range:
+        """The doc ids (a range, since doc ids are in date order) in a
+        date_received_facet."""
+        start, end = (_to_iso(ms) for ms in facet.split(".."))
+        first = self.conn.execute(
+            "SELECT MIN(doc_id) FROM docs WHERE date_received >= ?",
+            (start, )).fetchone()[0]
+        last = self.conn.execute(
+            "SELECT MAX(doc_id) FROM docs WHERE date_received <= ?",
+            (end, )).fetchone()[0]
+        if first is None or last is None:
+            return range(0)
+        return range(first, last + 1)
+
+    def matching(self, query: SearchQueryCore) -> np.ndarray:
+        """The doc ids of every notice matching the query, oldest first."""
+        params = query.params
+        matches: Optional[np.ndarray] = None
+        for key, value in params.items():
+            if key not in FIELDS:
+                continue
+            require_all = params.get(key + "-require-all") == "true"
+            docs = self._match(key, value, require_all)
+            matches = docs if matches is None else np.intersect1d(
+                matches, docs, assume_unique=True)
+
+        if "date_received_facet" in params:
+            dates = self._date_bounds(params["date_received_facet"])
+            if matches is None:
+                matches = np.arange(dates.start, dates.stop, dtype=np.int32)
+            else:
+                matches = matches[(matches >= dates.start)
+                                  & (matches < dates.stop)]
+
+        if matches is None:
+            matches = np.arange(len(self), dtype=np.int32)
+        return matches
+
+    def _load(self, doc_ids: Iterable[int]) -> List[Dict[str, Any]]:
+        doc_ids = [int(doc_id) for doc_id in doc_ids]
+        rows: Dict[int, bytes] = {}
+        # Older SQLites allow 999 variables a query
+        for start in range(0, len(doc_ids), LOAD_BATCH):
+            batch = doc_ids[start:start + LOAD_BATCH]
+            rows.update(
+                self.conn.execute(
+                    f"SELECT doc_id, data FROM docs WHERE doc_id IN "
+                    f"({','.join('?' * len(batch))})", batch))
+        return [loads(rows[doc_id]) for doc_id in doc_ids]
+
+    def _facets(self, doc_ids: np.ndarray) -> Dict[str, Any]:
+        aggregate = FacetAggregate()
+        for start in range(0, len(doc_ids), LOAD_BATCH):
+            aggregate.update(self._load(doc_ids[start:start + LOAD_BATCH]))
+        return aggregate.to_facets()
+
+    def search(self,
+               query: SearchQueryCore,
+               facets: bool = False) -> SearchResult:
+        """Search the index like SearchQuery.search searches Lumen, honoring
+        the query's sort, page and amount per page. Set facets to count the
+        metadata over every match (this loads every matching notice, so it's
+        slower than the search itself)."""
+        params = query.params
+        matches = self.matching(query)
+        if params.get("sort_by") != Sort.DateRecievedAsc:
+            matches = matches[::-1]
+
+        per_page = int(params.get("per_page", DEFAULT_PER_PAGE))
+        page = int(params.get("page", 1))
+        page_ids = matches[(page - 1) * per_page:page * per_page]
+
+        return SearchResult({
+            "notices": self._load(page_ids),
+            "meta": {
+                "facets": (self._facets(matches) if facets else {
+                    name: {"buckets": []}
+                    for name in FACET_NAMES.values()
+                }),
+                "total_entries": len(matches),
+                "current_page": page,
+                "per_page": per_page,
+            }
+        })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build a local search index over a cache.")
+    parser.add_argument("cache", type=Path)
+    parser.add_argument("index", type=Path)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    LocalIndex.build(args.cache, args.index).close()
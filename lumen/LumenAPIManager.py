@@ -1,32 +1,92 @@
-import json
 import logging
-from datetime import datetime
-from hashlib import sha256
+import time
+from contextlib import nullcontext
 from pathlib import Path
-from time import sleep
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
 
 import httpx
 
+from lumen.CacheBackend import (CacheBackend, cache_key, canonical_params,
+                                open_cache)
+from lumen.CachePolicy import FRESH, CachePolicy
+from lumen.Codec import loads
+from lumen.HTTPClient import (DEFAULT_LIMITS, DEFAULT_TIMEOUT, ConnectionTrace,
+                               client as http_client)
+from lumen.Metrics import Hooks, endpoint_of
+from lumen.NoticeBatch import NoticeFetch
+from lumen.NoticeStore import NoticeStore
+from lumen.RateLimiter import TokenBucket, Unlimited
+from lumen.Retry import CircuitBreaker, RetryPolicy
+from lumen.SearchResult import notice_from_response
+from lumen.StreamParser import StreamParser
+
+
+def _size(req: httpx.Response) -> int:
+    if req.is_stream_consumed:
+        return len(req.content)
+    return int(req.headers.get("Content-Length", 0))
+
 
 class LumenAPIManager:
     """Manage requests to the Lumen database and timing requests."""
 
     def __init__(self,
                  api_key: str,
-                 cache: Optional[Path] = Path("cache"),
-                 timeout: int = 2):
-        headers = {
-            "User-Agent": "CSE291BResearch",
-            "X-Authentication-Token": api_key,
-            "Accept-Encoding": "gzip"
-        }
-        self.session = httpx.Client(headers=headers, timeout=None)
-        self.last_req: Union[datetime, None] = None
+                 cache: Optional[Union[Path, CacheBackend]] = Path("cache"),
+                 timeout: int = 2,
+                 rate_limiter: Optional[TokenBucket] = None,
+                 retry: RetryPolicy = RetryPolicy(),
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 memory_cache_size: int = 32,
+                 hooks: Optional[Hooks] = None,
+                 base_url: str = "https://lumendatabase.org",
+                 client: Optional[httpx.Client] = None,
+                 http2: bool = False,
+                 limits: httpx.Limits = DEFAULT_LIMITS,
+                 http_timeout: httpx.Timeout = DEFAULT_TIMEOUT,
+                 store: Optional[NoticeStore] = None,
+                 cache_policy: Optional[CachePolicy] = None):
+        """By default, requests are limited to one every `timeout` seconds (0
+        doesn't limit them at all). To share a limit between several
+        managers, pass them the same rate_limiter (a SharedTokenBucket also
+        works across processes).
+
+        Failed requests (429s, 5xxs and connection errors) are retried
+        according to retry, and too many failures in a row trip the
+        circuit_breaker.
+
+        The memory_cache_size most recently used responses are also kept in
+        memory, up to 64 MB of them and none bigger than 16 MB (set it to 0
+        to turn that off).
+
+        hooks are told about every request, cache lookup and sleep, pass a
+        MetricsRecorder to see where time goes. base_url is where Lumen lives,
+        point it at a MockLumenServer to try things out offline.
+
+        Requests give up on connections that hang for longer than
+        http_timeout. To share one connection pool between several managers,
+        make a client with HTTPClient.client and pass it to each of them.
+
+        get_notice looks in store first, if given, see NoticeStore.
+
+        Cached responses are kept forever, unless cache_policy gives their
+        endpoint or query a TTL. There's no background refreshing here, so
+        stale responses are requested again like expired ones (the async
+        manager serves them while it refreshes them)."""
+        self.headers = {"X-Authentication-Token": api_key}
+        # A shared client is closed by whoever made it, not by us
+        self._owns_session = client is None
+        self.session = client or http_client(http2, limits, http_timeout)
         self.timeout = timeout
-        self.cache = cache
-        if self.cache:
-            self.cache.mkdir(exist_ok=True)
+        self.rate_limiter = rate_limiter or (TokenBucket(
+            rate=1 / timeout) if timeout > 0 else Unlimited())
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.cache = open_cache(cache, memory_cache_size)
+        self.hooks = hooks or Hooks()
+        self.base_url = base_url
+        self.store = store
+        self.cache_policy = cache_policy or CachePolicy()
 
     def __enter__(self):
         """Start the session using a with-context block."""
@@ -38,13 +98,39 @@ class LumenAPIManager:
 
     def close(self):
         """Close the requests session."""
-        self.session.close()
+        if self._owns_session:
+            self.session.close()
+        if self.cache:
+            self.cache.close()
 
     def get_notice(self, id: int) -> Dict[str, Any]:
         """Return a JSON-encoded representation of selected notice attributes.
         Notice Types will have mapped attributes applied, and be under a root
-        key articulating their type."""
-        return self._req(f"/notices/{id}.json")
+        key articulating their type.
+
+        With a store, notices in it are served from there without a request,
+        and fetched notices are added to it."""
+        if self.store is not None:
+            stored = self.store.get_response(id)
+            if stored is not None:
+                logging.info("Store hit on notice %s", id)
+                return stored
+        data = self._req(f"/notices/{id}.json")
+        if self.store is not None:
+            self.store.add_response(data)
+        return data
+
+    def get_notices(self, ids: Iterable[int]) -> Iterator[NoticeFetch]:
+        """Fetch many notices, yielding a parsed NoticeFetch for each id in
+        order. Errors are yielded rather than raised. (AsyncLumenAPIManager
+        can fetch them concurrently.)"""
+        for id in ids:
+            try:
+                notice = notice_from_response(self.get_notice(id))
+                yield NoticeFetch(id, notice, None)
+            except Exception as e:
+                logging.warning("Failed to get notice %s: %r", id, e)
+                yield NoticeFetch(id, None, e)
 
     def get_topics(self) -> List[Any]:
         """Return a JSON-encoded array of topics, including an id, name, and
@@ -69,53 +155,167 @@ class LumenAPIManager:
     def _req(self,
              path: str,
              params: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
-        """Make a request on the path on the lumen database (or load from cache)."""
-        key = {}
-        if params:
-            key.update(params)
-        key['path'] = path
-        hash_key = sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
-
-        if self.cache:
-            # Try loading from cache
-            cache_path = self.cache / f"{hash_key}.json"
-            try:
-                with cache_path.open() as input:
-                    logging.info(
-                        f"Cache hit on {path} with {params} at {cache_path}")
-                    return json.load(input)
-            except FileNotFoundError:
-                # File was not found, continue to make api request
-                pass
+        """Make a request on the path on the lumen database (or load from cache).
+        Params are canonicalized first, so equivalent requests share an
+        entry."""
+        params = canonical_params(path, params)
+        key, hash_key = cache_key(path, params)
+        cached = self._load_cached(path, params)
+        if cached is not None:
+            return cached
 
         # Not in cache (or no cache), make a request
-        self._wait()
-
-        logging.info(f"Requesting {path} with params {params}")
-        req = self.session.get("https://lumendatabase.org" + path,
-                               params=params)
-        self.last_req = datetime.now()
-        req.raise_for_status()  # Raises exception on error
-        req_json = req.json()
+        req = self._get_with_retries(path, params)
+        start = time.perf_counter()
+        req_json = loads(req.content)
+        self.hooks.on_decode(endpoint_of(path), time.perf_counter() - start)
 
         # Save to cache
         if self.cache:
-            with cache_path.open("w+") as output:
-                logging.info(f"Caching at {cache_path}")
-                json.dump(req_json, output)
-            with (self.cache / f"{hash_key}.metadata").open("w+") as output:
-                json.dump(key, output, sort_keys=True, indent=2)
+            logging.info("Caching at %s in %s", hash_key, self.cache)
+            self.cache.put(hash_key, key, req_json)
 
         return req_json
 
-    def _wait(self):
-        """Ensure that we only make one request per second."""
-        if not self.last_req:
-            # No requests have been made
+    def _stream(self,
+                path: str,
+                params: Optional[Dict[str, str]] = None,
+                key: str = "notices") -> Iterator[Any]:
+        """Like _req, but yield the items of the response's `key` array one at
+        a time as they're downloaded, so only one item is ever decoded at
+        once however big the response is. The raw response is written to the
+        cache as it arrives, and only kept if it all arrives."""
+        params = canonical_params(path, params)
+        cached = self._load_cached(path, params)
+        if cached is not None:
+            yield from cached[key]
             return
 
-        req_delta = (datetime.now() - self.last_req).total_seconds()
+        cache_entry, hash_key = cache_key(path, params)
+        req = self._get_with_retries(path, params, stream=True)
+        parser = StreamParser(key)
+        decoding = 0.0
+        try:
+            with (self.cache.writer(hash_key, cache_entry) if self.cache else
+                  nullcontext(lambda chunk: None)) as write:
+                for chunk in req.iter_bytes():
+                    write(chunk)
+                    start = time.perf_counter()
+                    items = parser.feed(chunk)
+                    decoding += time.perf_counter() - start
+                    yield from items
+                start = time.perf_counter()
+                items = parser.close()
+                decoding += time.perf_counter() - start
+                yield from items
+        finally:
+            req.close()
+        if self.cache:
+            logging.info("Cached stream at %s in %s", hash_key, self.cache)
+        self.hooks.on_decode(endpoint_of(path), decoding)
+
+    def _load_cached(
+            self,
+            path: str,
+            params: Optional[Dict[str, str]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Return the cached response for a request, or None if it isn't
+        cached (or isn't fresh). Never touches the network or the rate
+        limiter."""
+        if not self.cache:
+            return None
+
+        _, hash_key = cache_key(path, params)
+        start = time.perf_counter()
+        cached = self.cache.lookup(hash_key)
+        if cached is not None and self.cache_policy.state(
+                self.cache, hash_key, path, params) != FRESH:
+            cached = None
+        self.hooks.on_cache(endpoint_of(path), cached is not None,
+                            time.perf_counter() - start)
+        if cached is not None:
+            self.cache.touch(hash_key)
+            logging.info("Cache hit on %s with %s at %s", path, params,
+                         hash_key)
+        return cached
+
+    def _get_with_retries(self,
+                          path: str,
+                          params: Optional[Dict[str, str]] = None,
+                          stream: bool = False) -> httpx.Response:
+        """Make the request, retrying with backoff on 429s, server errors and
+        connection errors. Raises once the retries run out. With stream set,
+        the response is returned as soon as its headers arrive, and the caller
+        has to read and close it."""
+        for attempt in range(self.retry.max_attempts):
+            last_attempt = attempt == self.retry.max_attempts - 1
+            self.circuit_breaker.check()
+            self._wait()
+
+            logging.info("Requesting %s with params %s", path, params)
+            connection = ConnectionTrace()
+            request = self.session.build_request(
+                "GET",
+                self.base_url + path,
+                params=params,
+                headers=self.headers,
+                extensions={"trace": connection})
+            start = time.perf_counter()
+            try:
+                req = self.session.send(request, stream=stream)
+            except httpx.TransportError as e:
+                self._record(path, start, connection)
+                self.circuit_breaker.record_failure()
+                if last_attempt:
+                    raise
+                delay = self.retry.delay(attempt)
+                logging.warning(
+                    "Request for %s failed (%r), retrying in %.1f seconds",
+                    path, e, delay)
+            else:
+                self._record(path, start, connection, req)
+                if req.is_error:
+                    # Nothing wants an error's body, free the connection
+                    req.close()
+                if req.status_code not in self.retry.statuses:
+                    # Lumen answered, even if it's an error, so it's up
+                    self.circuit_breaker.record_success()
+                    req.raise_for_status()  # Raises exception on error
+                    return req
+
+                if req.status_code == 429:
+                    # Lumen is fine, we're just going too fast
+                    self.circuit_breaker.record_success()
+                else:
+                    self.circuit_breaker.record_failure()
+                if last_attempt:
+                    req.raise_for_status()
+                delay = self.retry.delay(attempt, req)
+                logging.warning("Got %s for %s, retrying in %.1f seconds",
+                                req.status_code, path, delay)
+
+            time.sleep(delay)
+
+        raise Exception("Retry policy needs at least one attempt!")
+
+    def _wait(self):
+        """Wait until the rate limiter lets us make another request."""
+        slept = self.rate_limiter.acquire()
+        if slept:
+            self.hooks.on_wait(slept)
+            logging.info("Slept for %.2f seconds", slept)
 
-        if req_delta < self.timeout:
-            logging.info(f"Sleeping for {self.timeout} seconds")
-            sleep(self.timeout)
+    def _record(self,
+                path: str,
+                start: float,
+                connection: ConnectionTrace,
+                req: Optional[httpx.Response] = None) -> None:
+        """Tell the hooks about a request that started at start (req is None
+        if it failed without a response). A streamed response is recorded
+        when its headers arrive, with the size it says it'll be."""
+        endpoint = endpoint_of(path)
+        self.hooks.on_request(endpoint,
+                              time.perf_counter() - start,
+                              _size(req) if req else 0,
+                              req.status_code if req else 0)
+        self.hooks.on_connection(endpoint, connection.new, connection.seconds)
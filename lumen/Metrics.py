@@ -0,0 +1,253 @@
+import bisect
+import json
+import re
+from collections import defaultdict
+from typing import Any, DefaultDict, Dict, List, Sequence
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+def endpoint_of(path: str) -> str:
+    """Group paths by endpoint, so /notices/123.json is /notices/{id}.json."""
+    return re.sub(r"/\d+", "/{id}", path)
+
+
+class Hooks:
+    """Called by the API managers as they work. This does nothing, subclass it
+    (like MetricsRecorder does) and pass it to a manager as hooks to watch
+    where time goes."""
+
+    def on_request(self, endpoint: str, seconds: float, num_bytes: int,
+                   status: int) -> None:
+        """A request to Lumen finished (including failed attempts)."""
+        pass
+
+    def on_connection(self, endpoint: str, new: bool, seconds: float) -> None:
+        """A request opened a new connection, taking seconds to connect, or
+        reused one from the pool. Warming up counts as the warm_up endpoint."""
+        pass
+
+    def on_cache(self, endpoint: str, hit: bool, seconds: float) -> None:
+        """We looked in the cache, taking seconds (reading and decoding)."""
+        pass
+
+    def on_wait(self, seconds: float) -> None:
+        """We slept for the rate limiter."""
+        pass
+
+    def on_decode(self, endpoint: str, seconds: float) -> None:
+        """We decoded a response's JSON."""
+        pass
+
+    def on_parse(self, notices: int, seconds: float) -> None:
+        """We turned notices' JSON into Notices."""
+        pass
+
+
+class Histogram:
+    """Counts observations into buckets, Prometheus-style."""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        # The last count is for observations above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {
+                str(bound): count
+                for bound, count in zip(self.buckets + ["+Inf"], self.counts)
+            },
+        }
+
+
+class MetricsRecorder(Hooks):
+    """Hooks that keep count of everything: request latency and bytes per
+    endpoint, new and reused connections, cache hits and misses, time slept for
+    the rate limiter, and time spent decoding JSON and parsing notices. Get the
+    numbers with snapshot(), to_json() or to_prometheus()."""
+
+    def __init__(self) -> None:
+        self.request_seconds: DefaultDict[str,
+                                          Histogram] = defaultdict(Histogram)
+        self.request_bytes: DefaultDict[str, int] = defaultdict(int)
+        self.request_statuses: DefaultDict[str, DefaultDict[
+            int, int]] = defaultdict(lambda: defaultdict(int))
+        self.connections_opened: DefaultDict[str, int] = defaultdict(int)
+        self.connections_reused: DefaultDict[str, int] = defaultdict(int)
+        self.connect_seconds = Histogram()
+        self.cache_hits: DefaultDict[str, int] = defaultdict(int)
+        self.cache_misses: DefaultDict[str, int] = defaultdict(int)
+        self.cache_seconds = Histogram()
+        self.wait_seconds = 0.0
+        self.waits = 0
+        self.decode_seconds = Histogram()
+        self.parse_seconds = 0.0
+        self.notices_parsed = 0
+
+    def on_request(self, endpoint: str, seconds: float, num_bytes: int,
+                   status: int) -> None:
+        self.request_seconds[endpoint].observe(seconds)
+        self.request_bytes[endpoint] += num_bytes
+        self.request_statuses[endpoint][status] += 1
+
+    def on_connection(self, endpoint: str, new: bool, seconds: float) -> None:
+        if new:
+            self.connections_opened[endpoint] += 1
+            self.connect_seconds.observe(seconds)
+        else:
+            self.connections_reused[endpoint] += 1
+
+    def on_cache(self, endpoint: str, hit: bool, seconds: float) -> None:
+        if hit:
+            self.cache_hits[endpoint] += 1
+        else:
+            self.cache_misses[endpoint] += 1
+        self.cache_seconds.observe(seconds)
+
+    def on_wait(self, seconds: float) -> None:
+        self.wait_seconds += seconds
+        self.waits += 1
+
+    def on_decode(self, endpoint: str, seconds: float) -> None:
+        self.decode_seconds.observe(seconds)
+
+    def on_parse(self, notices: int, seconds: float) -> None:
+        self.notices_parsed += notices
+        self.parse_seconds += seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        """All the metrics as a JSON-friendly dictionary."""
+        hits = sum(self.cache_hits.values())
+        lookups = hits + sum(self.cache_misses.values())
+        reused = sum(self.connections_reused.values())
+        connections = reused + sum(self.connections_opened.values())
+        return {
+            "requests": {
+                endpoint: {
+                    "seconds": histogram.to_dict(),
+                    "bytes": self.request_bytes[endpoint],
+                    "statuses": dict(self.request_statuses[endpoint]),
+                }
+                for endpoint, histogram in self.request_seconds.items()
+            },
+            "in_flight_seconds":
+            sum(h.sum for h in self.request_seconds.values()),
+            "connections": {
+                "opened": dict(self.connections_opened),
+                "reused": dict(self.connections_reused),
+                "reuse_ratio": reused / connections if connections else None,
+                "connect_seconds": self.connect_seconds.to_dict(),
+            },
+            "cache": {
+                "hits": dict(self.cache_hits),
+                "misses": dict(self.cache_misses),
+                "hit_ratio": hits / lookups if lookups else None,
+                "seconds": self.cache_seconds.to_dict(),
+            },
+            "wait": {
+                "seconds": self.wait_seconds,
+                "count": self.waits
+            },
+            "decode_seconds": self.decode_seconds.to_dict(),
+            "parse": {
+                "seconds": self.parse_seconds,
+                "notices": self.notices_parsed
+            },
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """All the metrics in Prometheus' text format."""
+        lines: List[str] = []
+
+        def braces(labels: str) -> str:
+            return f"{{{labels}}}" if labels else ""
+
+        def histogram(name: str, help: str,
+                      histograms: Dict[str, Histogram]) -> None:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, h in histograms.items():
+                sep = "," if labels else ""
+                total = 0
+                for bound, count in zip(h.buckets + ["+Inf"], h.counts):
+                    total += count
+                    lines.append(
+                        f'{name}_bucket{{{labels}{sep}le="{bound}"}} {total}')
+                lines.append(f"{name}_sum{braces(labels)} {h.sum}")
+                lines.append(f"{name}_count{braces(labels)} {h.count}")
+
+        def counter(name: str, help: str, values: Dict[str, float]) -> None:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in values.items():
+                lines.append(f"{name}{braces(labels)} {value}")
+
+        histogram(
+            "lumen_request_seconds", "Time spent on requests to Lumen", {
+                f'endpoint="{endpoint}"': h
+                for endpoint, h in self.request_seconds.items()
+            })
+        counter(
+            "lumen_request_bytes_total", "Response bytes from Lumen", {
+                f'endpoint="{endpoint}"': n
+                for endpoint, n in self.request_bytes.items()
+            })
+        counter(
+            "lumen_requests_total", "Requests to Lumen by status", {
+                f'endpoint="{endpoint}",status="{status}"': n
+                for endpoint, statuses in self.request_statuses.items()
+                for status, n in statuses.items()
+            })
+        counter(
+            "lumen_connections_total",
+            "Requests by whether they opened a new connection", {
+                **{
+                    f'endpoint="{endpoint}",connection="new"': n
+                    for endpoint, n in self.connections_opened.items()
+                },
+                **{
+                    f'endpoint="{endpoint}",connection="reused"': n
+                    for endpoint, n in self.connections_reused.items()
+                }
+            })
+        histogram("lumen_connect_seconds",
+                  "Time spent opening new connections",
+                  {"": self.connect_seconds})
+        counter(
+            "lumen_cache_lookups_total", "Cache lookups", {
+                **{
+                    f'endpoint="{endpoint}",result="hit"': n
+                    for endpoint, n in self.cache_hits.items()
+                },
+                **{
+                    f'endpoint="{endpoint}",result="miss"': n
+                    for endpoint, n in self.cache_misses.items()
+                }
+            })
+        histogram("lumen_cache_seconds", "Time spent reading the cache",
+                  {"": self.cache_seconds})
+        counter("lumen_wait_seconds_total",
+                "Time spent sleeping for the rate limiter",
+                {"": self.wait_seconds})
+        histogram("lumen_decode_seconds", "Time spent decoding JSON",
+                  {"": self.decode_seconds})
+        counter("lumen_parse_seconds_total", "Time spent parsing notices",
+                {"": self.parse_seconds})
+        counter("lumen_notices_parsed_total", "Notices parsed",
+                {"": self.notices_parsed})
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,323 @@
+import argparse
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from lumen.Codec import dumps
+from lumen.FacetAggregate import FacetAggregate
+from lumen.SearchTypes import NoticeType, Topic
+
+# Notice i was received at FIRST_NOTICE + i * NOTICE_INTERVAL, so ids are in
+# date order like on Lumen
+FIRST_NOTICE = datetime(2012, 1, 1, tzinfo=timezone.utc)
+NOTICE_INTERVAL = timedelta(minutes=5)
+# Lumen won't page past this many results, that's what ShardPlanner is for
+MAX_RESULTS = 10000
+
+_SENDERS = [f"Rights Holder {i}" for i in range(200)]
+_RECIPIENTS = ["Google LLC", "Twitter", "GitHub", "Automattic", "Cloudflare"]
+_LANGUAGES = ["en", "en", "en", "es", "de", "fr", "ru", "pt"]
+_COUNTRIES = ["US", "US", "GB", "DE", "FR", "BR", "RU", "IN"]
+_WORDS = ("star wars movie song album game book photo episode season stream "
+          "download free watch online full hd copy").split()
+
+
+def synthetic_notice(id: int, seed: int = 0) -> Dict[str, Any]:
+    """A made up notice, always the same for the same id and seed. Sizes
+    follow a long tail like real notices: most have a work or two and a few
+    URLs, and a few have hundreds of works or thousands of URLs."""
+    rng = random.Random(seed * 1_000_003 + id)
+    notice_type = rng.choices(list(NoticeType),
+                              weights=[1, 2, 1, 2, 85, 2, 2, 1, 2, 2])[0]
+    received = FIRST_NOTICE + id * NOTICE_INTERVAL
+    sent = received - timedelta(days=rng.randrange(30))
+    works = []
+    for _ in range(min(500, int(rng.lognormvariate(0, 1)) + 1)):
+        domain = f"site{int(rng.paretovariate(1.2)) % 5000}.com"
+        works.append({
+            "description":
+            " ".join(rng.choices(_WORDS, k=rng.randrange(2, 12))),
+            "infringing_urls": [{
+                "url": f"https://{domain}/{rng.getrandbits(48):x}"
+            } for _ in range(min(2000, int(rng.paretovariate(1.1))))],
+            "copyrighted_urls": [{
+                "url": f"https://example.com/{rng.getrandbits(32):x}"
+            } for _ in range(rng.randrange(2))],
+        })
+    return {
+        "id": id,
+        "type": notice_type.value.capitalize(),
+        "title": " ".join(rng.choices(_WORDS, k=rng.randrange(2, 8))),
+        "body": "Please remove the following. " * rng.randrange(1, 20),
+        "date_sent": sent.isoformat(timespec="milliseconds")[:-6] + "Z",
+        "date_received":
+        received.isoformat(timespec="milliseconds")[:-6] + "Z",
+        "topics": [t.value for t in rng.sample(list(Topic), rng.randrange(3))],
+        "sender_name": rng.choice(_SENDERS),
+        "principal_name": rng.choice(_SENDERS),
+        "recipient_name": rng.choice(_RECIPIENTS),
+        "works": works,
+        "tags": rng.sample(_WORDS, rng.randrange(3)),
+        "jurisdictions": rng.sample(_COUNTRIES, rng.randrange(1, 3)),
+        "action_taken": rng.choice(["Yes", "No", "Partial", ""]),
+        "language": rng.choice(_LANGUAGES),
+    }
+
+
+@lru_cache(maxsize=20000)
+def _notice(id: int, seed: int) -> Tuple[Dict[str, Any], bytes]:
+    # Made up notices are cached so the server doesn't slow the client down
+    notice = synthetic_notice(id, seed)
+    return notice, dumps(notice)
+
+
+class MockLumenServer:
+    """A stand-in for the Lumen API on localhost, serving made up notices
+    (see synthetic_notice) from /notices/search.json, /notices/{id}.json,
+    /entities/search.json and /topics.json, so things can be tried and
+    benchmarked without an API key:
+
+        with MockLumenServer(latency=0.05) as server:
+            api = LumenAPIManager("key", base_url=server.url)
+
+    There are `notices` notices with ids 1 to `notices`. Searches match every
+    notice (only date_received_facet, sort_by, page and per_page are looked
+    at), and their facets only count the page's notices.
+
+    Every response is slowed by latency plus up to jitter seconds. Going over
+    rate_limit requests a second (in bursts of up to burst), or getting
+    unlucky with throttle_probability, gets a 429 with a Retry-After."""
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 notices: int = 1_000_000,
+                 latency: float = 0,
+                 jitter: float = 0,
+                 rate_limit: Optional[float] = None,
+                 burst: int = 10,
+                 throttle_probability: float = 0,
+                 retry_after: float = 1,
+                 seed: int = 0):
+        self.notices = notices
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.throttle_probability = throttle_probability
+        self.retry_after = retry_after
+        self.seed = seed
+
+        self.requests = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self  # type: ignore
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockLumenServer":
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def _throttle(self) -> bool:
+        """Count a request, returning whether it should get a 429."""
+        with self._lock:
+            self.requests += 1
+            throttled = random.random() < self.throttle_probability
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate_limit)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                else:
+                    throttled = True
+            if throttled:
+                self.throttled += 1
+            return throttled
+
+    def _id_range(self, params: Dict[str, str]) -> range:
+        """The ids of the notices matching a search, oldest first."""
+        first, last = 1, self.notices
+        facet = params.get("date_received_facet")
+        if facet:
+            # with_date_range sends milliseconds since the epoch
+            start, end = (datetime.fromtimestamp(int(ms) / 1000, timezone.utc)
+                          for ms in facet.split(".."))
+            first = max(first, -((FIRST_NOTICE - start) // NOTICE_INTERVAL))
+            last = min(last, (end - FIRST_NOTICE) // NOTICE_INTERVAL)
+        return range(first, max(first, last + 1))
+
+    def search(self, params: Dict[str, str]) -> bytes:
+        ids = self._id_range(params)
+        if params.get("sort_by") != "date_received asc":
+            ids = ids[::-1]
+        per_page = int(params.get("per_page", 10))
+        page = int(params.get("page", 1))
+        start = (page - 1) * per_page
+        end = min(page * per_page, MAX_RESULTS)
+        notices = [_notice(id, self.seed) for id in ids[start:end]]
+
+        meta = dumps({
+            "facets":
+            FacetAggregate.from_notices(n for n, _ in notices).to_facets(),
+            "current_page": page,
+            "per_page": per_page,
+            "total_entries": len(ids),
+            "total_pages": -(-len(ids) // per_page),
+        })
+        return (b'{"notices":[' + b",".join(raw for _, raw in notices) +
+                b'],"meta":' + meta + b"}")
+
+    def get_notice(self, id: int) -> Optional[bytes]:
+        if not 1 <= id <= self.notices:
+            return None
+        notice, raw = _notice(id, self.seed)
+        return b'{"' + notice["type"].lower().encode() + b'":' + raw + b"}"
+
+    def search_entities(self, params: Dict[str, str]) -> bytes:
+        per_page = int(params.get("per_page", 10))
+        page = int(params.get("page", 1))
+        term = params.get("term", "")
+        return dumps({
+            "entities": [{
+                "id": i,
+                "name": f"{term} {i}",
+                "kind": "organization",
+                "country_code": _COUNTRIES[i % len(_COUNTRIES)],
+            } for i in range((page - 1) * per_page, page * per_page)],
+            "meta": {
+                "current_page": page,
+                "per_page": per_page,
+                "total_entries": 1000,
+            }
+        })
+
+    def topics(self) -> bytes:
+        return dumps({
+            "topics": [{
+                "id": i,
+                "name": topic.value,
+                "parent_id": None
+            } for i, topic in enumerate(Topic, 1)]
+        })
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections alive like Lumen does
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, without this every response
+    # waits on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:
+        mock: MockLumenServer = self.server.mock  # type: ignore
+        url = urlparse(self.path)
+        params = {
+            key: values[-1]
+            for key, values in parse_qs(url.query).items()
+        }
+
+        delay = mock.latency + random.uniform(0, mock.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if mock._throttle():
+            self._send(429, b'{"error":"Too many requests"}',
+                       {"Retry-After": str(mock.retry_after)})
+            return
+
+        body: Optional[bytes] = None
+        notice = re.fullmatch(r"/notices/(\d+)\.json", url.path)
+        if url.path == "/notices/search.json":
+            body = mock.search(params)
+        elif notice:
+            body = mock.get_notice(int(notice.group(1)))
+        elif url.path == "/entities/search.json":
+            body = mock.search_entities(params)
+        elif url.path == "/topics.json":
+            body = mock.topics()
+
+        if body is None:
+            self._send(404, b'{"error":"Not found"}')
+        else:
+            self._send(200, body)
+
+    def do_HEAD(self) -> None:
+        # Enough for warm_up to open a connection
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send(self,
+              status: int,
+              body: bytes,
+              headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        mock: MockLumenServer = self.server.mock  # type: ignore
+        with mock._lock:
+            mock.bytes_sent += len(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve a fake Lumen API with made up notices.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--notices", type=int, default=1_000_000)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--rate-limit", type=float)
+    parser.add_argument("--throttle-probability", type=float, default=0)
+    args = parser.parse_args()
+
+    server = MockLumenServer(args.host, args.port, args.notices, args.latency,
+                             args.jitter, args.rate_limit,
+                             throttle_probability=args.throttle_probability)
+    print(f"Serving a fake Lumen at {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import (TYPE_CHECKING, AsyncIterator, Deque, Dict, Iterable,
+                    Optional, Set, TextIO)
+
+from lumen.SearchResult import Notice, notice_from_response
+
+if TYPE_CHECKING:
+    from lumen.AsyncLumenAPIManager import AsyncLumenAPIManager
+
+# Completed ids are written to the checkpoint file this many at a time
+CHECKPOINT_FLUSH_EVERY = 100
+
+
+@dataclass(frozen=True)
+class NoticeFetch:
+    """The outcome of fetching one notice: either the notice or the error."""
+    id: int
+    notice: Optional[Notice]
+    error: Optional[Exception]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class NoticeBatch:
+    """Fetch many notices by id concurrently. Ids in the cache come back
+    straight away, the rest go through the manager's rate limiter.
+
+    Failures don't stop the batch: they're yielded like everything else and
+    collected in errors. Ids that were fetched successfully are remembered in
+    completed (and appended to the checkpoint file, if given), so running the
+    batch again, even in a new process with the same checkpoint, only fetches
+    what's left."""
+
+    def __init__(self,
+                 manager: "AsyncLumenAPIManager",
+                 ids: Iterable[int],
+                 concurrency: int = 32,
+                 checkpoint: Optional[Path] = None):
+        self.manager = manager
+        self.ids = list(ids)
+        self.concurrency = concurrency
+        self.checkpoint = checkpoint
+        self.completed: Set[int] = set()
+        self.errors: Dict[int, Exception] = {}
+        self._output: Optional[TextIO] = None
+        self._unflushed = 0
+
+        if checkpoint is not None and checkpoint.exists():
+            with checkpoint.open() as input:
+                self.completed.update(json.loads(line) for line in input)
+
+    @property
+    def remaining(self) -> int:
+        return len([id for id in self.ids if id not in self.completed])
+
+    async def _fetch(self, id: int) -> NoticeFetch:
+        try:
+            data = await self.manager.get_notice(id)
+            return NoticeFetch(id, notice_from_response(data), None)
+        except Exception as e:
+            logging.warning("Failed to get notice %d: %r", id, e)
+            return NoticeFetch(id, None, e)
+
+    def _record(self, fetch: NoticeFetch) -> None:
+        if fetch.ok:
+            self.completed.add(fetch.id)
+            self.errors.pop(fetch.id, None)
+            if self._output is not None:
+                self._output.write(f"{fetch.id}\n")
+                self._unflushed += 1
+                if self._unflushed >= CHECKPOINT_FLUSH_EVERY:
+                    self._output.flush()
+                    self._unflushed = 0
+        else:
+            assert fetch.error is not None
+            self.errors[fetch.id] = fetch.error
+
+    async def run(self, ordered: bool = True) -> AsyncIterator[NoticeFetch]:
+        """Fetch every id not completed yet, yielding the results in the
+        order of ids (ordered) or as soon as each one finishes. At most
+        `concurrency` fetches are outstanding at once. The checkpoint file
+        is kept open while this runs and written to every
+        CHECKPOINT_FLUSH_EVERY ids, so a crash can lose the last few, which
+        are just fetched again."""
+        ids = iter([id for id in self.ids if id not in self.completed])
+        in_flight: Deque[asyncio.Task[NoticeFetch]] = deque()
+
+        def fetch_next() -> None:
+            id = next(ids, None)
+            if id is not None:
+                in_flight.append(asyncio.create_task(self._fetch(id)))
+
+        if self.checkpoint is not None:
+            self._output = self.checkpoint.open("a")
+        try:
+            for _ in range(self.concurrency):
+                fetch_next()
+
+            while in_flight:
+                if ordered:
+                    finished = [await in_flight.popleft()]
+                else:
+                    done, _ = await asyncio.wait(
+                        in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        in_flight.remove(task)
+                    finished = [task.result() for task in done]
+
+                for fetch in finished:
+                    self._record(fetch)
+                    fetch_next()
+                    yield fetch
+        finally:
+            for task in in_flight:
+                task.cancel()
+            if self._output is not None:
+                self._output.close()
+                self._output = None
+                self._unflushed = 0
@@ -0,0 +1,169 @@
+import argparse
+import json
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Union
+
+from lumen.CacheBackend import CacheBackend, open_cache
+from lumen.Codec import dumps, loads
+from lumen.IdSet import IdSet
+
+
+def response_notices(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The notices in a response: every notice on a search page, or the one
+    notice a get_notice response has under a key naming its type (which is
+    filled in as the notice's type if it doesn't have one). Other responses
+    have none."""
+    if isinstance(data.get('notices'), list):
+        return data['notices']
+    if len(data) == 1:
+        notice_type, notice = next(iter(data.items()))
+        if isinstance(notice, dict) and 'id' in notice:
+            if 'type' not in notice:
+                notice = dict(notice, type=notice_type)
+            return [notice]
+    return []
+
+
+class NoticeStore:
+    """A local SQLite store of notices, one row per notice id, holding the
+    notice's JSON as Lumen returned it. Also remembers how far each synced
+    query has gotten, see IncrementalSync.
+
+    Pages from any number of queries normalize into it (see add_cache), so
+    each notice is stored once however many pages it was on. The ids stored
+    are also kept in an IdSet, so checking whether a notice is stored mostly
+    doesn't touch the database."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS notices (
+                id INTEGER PRIMARY KEY,
+                date_received TEXT,
+                data BLOB NOT NULL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS sync_state (
+                query_key TEXT PRIMARY KEY,
+                params TEXT NOT NULL,
+                high_water TEXT NOT NULL)""")
+        self.conn.commit()
+        # The ids known to be stored. Another process can add more, so ids
+        # that aren't in here are double checked against the database
+        self.ids = IdSet(id for (id, ) in self.conn.execute(
+            "SELECT id FROM notices"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __contains__(self, id: int) -> bool:
+        if id in self.ids:
+            return True
+        if self.conn.execute("SELECT 1 FROM notices WHERE id = ?",
+                             (id, )).fetchone() is None:
+            return False
+        self.ids.add(id)
+        return True
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM notices").fetchone()[0]
+
+    def get(self, id: int) -> Optional[Dict[str, Any]]:
+        """The stored JSON of a notice, or None if we don't have it."""
+        row = self.conn.execute("SELECT data FROM notices WHERE id = ?",
+                                (id, )).fetchone()
+        return loads(row[0]) if row else None
+
+    def get_response(self, id: int) -> Optional[Dict[str, Any]]:
+        """A stored notice shaped like a get_notice response, under a key
+        naming its type, or None if we don't have it. Notices stored from
+        search pages can have fewer fields than Lumen's notice endpoint
+        gives."""
+        if id not in self:
+            return None
+        notice = self.get(id)
+        if notice is None:
+            return None
+        return {notice['type'].lower(): notice}
+
+    def add(self, notices: Iterable[Dict[str, Any]]) -> int:
+        """Store notices (as JSON from Lumen), replacing any we already have
+        with the same id. Returns how many were new."""
+        rows = []
+        new: Set[int] = set()
+        for notice in notices:
+            if notice['id'] not in new and notice['id'] not in self:
+                new.add(notice['id'])
+            rows.append(
+                (notice['id'], notice.get('date_received'), dumps(notice)))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO notices (id, date_received, data) "
+                "VALUES (?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+                "date_received = excluded.date_received, data = excluded.data",
+                rows)
+        self.ids.update(new)
+        return len(new)
+
+    def add_response(self, data: Dict[str, Any]) -> int:
+        """Store the notices in a response (see response_notices), returning
+        how many were new."""
+        return self.add(response_notices(data))
+
+    def add_cache(self,
+                  cache: Union[Path, CacheBackend],
+                  batch_size: int = 10000) -> int:
+        """Store every notice in a cache, one record per notice however many
+        cached pages it's on, returning how many were new. Notices are added
+        batch_size at a time."""
+        backend = open_cache(cache)
+        assert backend is not None
+        new = 0
+        batch: List[Dict[str, Any]] = []
+        for _, data in backend.items():
+            batch.extend(response_notices(data))
+            if len(batch) >= batch_size:
+                new += self.add(batch)
+                batch = []
+        return new + self.add(batch)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        """Every stored notice, newest first."""
+        for (data, ) in self.conn.execute(
+                "SELECT data FROM notices ORDER BY date_received DESC"):
+            yield loads(data)
+
+    def high_water(self, query_key: str) -> Optional[str]:
+        """The newest date_received seen for a synced query, if it's been
+        synced before."""
+        row = self.conn.execute(
+            "SELECT high_water FROM sync_state WHERE query_key = ?",
+            (query_key, )).fetchone()
+        return row[0] if row else None
+
+    def set_high_water(self, query_key: str, params: Dict[str, str],
+                       high_water: str) -> None:
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)",
+                (query_key, json.dumps(params, sort_keys=True), high_water))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Store every notice in a cache, once per notice.")
+    parser.add_argument("cache",
+                        type=Path,
+                        help="cache folder or .sqlite cache file")
+    parser.add_argument("store", type=Path, help="the store's SQLite file")
+    args = parser.parse_args()
+
+    with NoticeStore(args.store) as store:
+        new = store.add_cache(args.cache)
+        print(f"Stored {new} new notices, {len(store)} in total")
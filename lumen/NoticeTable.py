@@ -0,0 +1,293 @@
+from pathlib import Path
+from typing import (Any, Dict, Iterable, List, Optional, Sequence, Tuple,
+                    Union)
+from urllib.parse import urlparse
+
+import numpy as np
+
+from lumen.CacheBackend import CacheBackend, open_cache
+from lumen.SearchResult import (CompactNotice, NameCount, Notice, NoticeFilter,
+                                 SearchResult)
+
+# Columns with one value per notice, stored as dictionary codes (-1 is None)
+SINGLE_COLUMNS = ("title", "type", "sender_name", "recipient_name",
+                  "principal_name", "language", "action_taken")
+# Columns with several values per notice, stored CSR-style: the values for
+# row i are codes[offsets[i]:offsets[i + 1]]
+MULTI_COLUMNS = ("topics", "tags", "jurisdictions", "domains")
+DATE_COLUMNS = ("date_sent", "date_received")
+
+
+class _Encoder:
+    """Assigns each distinct string an integer code as it's seen."""
+
+    def __init__(self) -> None:
+        self.codes: Dict[str, int] = {}
+        self.categories: List[str] = []
+
+    def encode(self, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.categories)
+            self.categories.append(value)
+        return code
+
+
+def _to_datetime64(value: Optional[str]) -> str:
+    # Lumen gives ISO 8601 timestamps with a timezone suffix numpy doesn't
+    # parse, so keep the date and time to the second and drop the rest
+    return value[:19] if value else "NaT"
+
+
+class NoticeTable:
+    """A column-oriented table of notices. Strings are stored once in a list of
+    categories and each notice only keeps an integer code, so millions of
+    notices fit in a small fraction of the memory of Notice objects, and counts
+    are done with numpy instead of Python loops.
+
+    Build one with from_notices, from_search_result, from_data or from_cache,
+    then use value_counts/top_k, where and date_histogram."""
+
+    def __init__(self, length: int, single: Dict[str, Tuple[np.ndarray,
+                                                            List[str]]],
+                 multi: Dict[str, Tuple[np.ndarray, np.ndarray, List[str]]],
+                 dates: Dict[str, np.ndarray]):
+        self.length = length
+        self.single = single
+        self.multi = multi
+        self.dates = dates
+
+    @classmethod
+    def from_data(cls, notices: Iterable[Dict[str, Any]]) -> "NoticeTable":
+        """Build a table from raw notice JSON, like the entries in a search
+        response's 'notices' list. This skips building Notice objects."""
+        return cls._build((
+            data['title'],
+            data['type'].lower(),
+            data['sender_name'],
+            data['recipient_name'],
+            data.get('principal_name'),
+            data['language'],
+            data['action_taken'],
+            data['topics'],
+            data['tags'],
+            data['jurisdictions'],
+            [
+                url for work in data.get('works', [])
+                for urlJSON in work.get('infringing_urls', [])
+                if (url := urlparse(urlJSON['url']).netloc)
+            ],
+            data['date_sent'],
+            data['date_received'],
+        ) for data in notices)
+
+    @classmethod
+    def from_notices(cls, notices: Iterable[Notice]) -> "NoticeTable":
+        """Build a table from Notice objects."""
+        return cls._build(
+            (n.title, n.type, n.sender_name, n.recipient_name,
+             n.principal_name, n.language, n.action_taken, n.topics, n.tags,
+             n.jurisdictions, list(n.infringing_urls.elements()), n.date_sent,
+             n.date_received) for n in notices)
+
+    @classmethod
+    def from_search_result(cls, result: SearchResult) -> "NoticeTable":
+        """Build a table from the notices of a SearchResult. Uses the raw JSON
+        when it's there (kept, or held by CompactNotices), otherwise the parsed
+        Notices."""
+        if result.raw is not None:
+            return cls.from_data(result.raw['notices'])
+        if all(isinstance(n, CompactNotice) for n in result.notices):
+            return cls.from_data(n.raw for n in result.notices)
+        return cls.from_notices(result.notices)
+
+    @classmethod
+    def from_cache(
+            cls,
+            cache: Union[Path, CacheBackend],
+            notice_filter: Optional[NoticeFilter] = None) -> "NoticeTable":
+        """Build a table from every notice in a cache, optionally filtered."""
+        backend = open_cache(cache)
+        assert backend is not None
+        return cls.from_data(
+            notice for _, data in backend.items()
+            for notice in data.get('notices', [])
+            if notice_filter is None or notice_filter.matches(notice))
+
+    @classmethod
+    def _build(cls, rows: Iterable[Sequence[Any]]) -> "NoticeTable":
+        # Rows are the single columns, then the multi columns, then the dates
+        n_single, n_multi = len(SINGLE_COLUMNS), len(MULTI_COLUMNS)
+        single_enc = [_Encoder() for _ in SINGLE_COLUMNS]
+        multi_enc = [_Encoder() for _ in MULTI_COLUMNS]
+        single_codes: List[List[int]] = [[] for _ in SINGLE_COLUMNS]
+        multi_codes: List[List[int]] = [[] for _ in MULTI_COLUMNS]
+        multi_offsets: List[List[int]] = [[0] for _ in MULTI_COLUMNS]
+        dates: List[List[str]] = [[] for _ in DATE_COLUMNS]
+
+        length = 0
+        for row in rows:
+            length += 1
+            for i in range(n_single):
+                single_codes[i].append(single_enc[i].encode(row[i]))
+            for i in range(n_multi):
+                encode = multi_enc[i].encode
+                multi_codes[i].extend(encode(v) for v in row[n_single + i])
+                multi_offsets[i].append(len(multi_codes[i]))
+            for i in range(len(DATE_COLUMNS)):
+                dates[i].append(_to_datetime64(row[n_single + n_multi + i]))
+
+        return cls(
+            length, {
+                name: (np.array(single_codes[i], dtype=np.int32),
+                       single_enc[i].categories)
+                for i, name in enumerate(SINGLE_COLUMNS)
+            }, {
+                name: (np.array(multi_offsets[i], dtype=np.int64),
+                       np.array(multi_codes[i], dtype=np.int32),
+                       multi_enc[i].categories)
+                for i, name in enumerate(MULTI_COLUMNS)
+            }, {
+                name: np.array(dates[i], dtype="datetime64[s]")
+                for i, name in enumerate(DATE_COLUMNS)
+            })
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def nbytes(self) -> int:
+        """Roughly how much memory the arrays take up (not counting the
+        category strings, which are stored once each)."""
+        return (sum(codes.nbytes for codes, _ in self.single.values()) +
+                sum(offsets.nbytes + codes.nbytes
+                    for offsets, codes, _ in self.multi.values()) +
+                sum(d.nbytes for d in self.dates.values()))
+
+    def _categories(self, column: str) -> List[str]:
+        if column in self.single:
+            return self.single[column][1]
+        if column in self.multi:
+            return self.multi[column][2]
+        raise Exception(f"{column} is not a categorical column!")
+
+    def _row_of_value(self, column: str) -> np.ndarray:
+        """For a multi column, the row each value belongs to."""
+        offsets, _, _ = self.multi[column]
+        return np.repeat(np.arange(self.length), np.diff(offsets))
+
+    def where(self, column: str, value: str) -> np.ndarray:
+        """A boolean mask of the rows where the column is (or, for multi
+        columns, contains) value. Combine masks with & and |."""
+        try:
+            code = self._categories(column).index(value)
+        except ValueError:
+            return np.zeros(self.length, dtype=bool)
+
+        if column in self.single:
+            return self.single[column][0] == code
+        mask = np.zeros(self.length, dtype=bool)
+        mask[self._row_of_value(column)[self.multi[column][1] == code]] = True
+        return mask
+
+    def counts(self,
+               column: str,
+               mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """How many times each category of the column appears (in the rows
+        selected by mask), indexed by category code."""
+        categories = self._categories(column)
+        if column in self.single:
+            codes = self.single[column][0]
+            if mask is not None:
+                codes = codes[mask]
+        else:
+            codes = self.multi[column][1]
+            if mask is not None:
+                codes = codes[mask[self._row_of_value(column)]]
+        codes = codes[codes >= 0]
+        return np.bincount(codes, minlength=len(categories))
+
+    def top_k(self,
+              column: str,
+              k: Optional[int] = 10,
+              mask: Optional[np.ndarray] = None) -> List[NameCount]:
+        """The k most common values of a column, most common first. Use
+        column="domains" for the most common infringing domains. Set k to None
+        to get every value."""
+        counts = self.counts(column, mask)
+        categories = self._categories(column)
+        if k is not None and k < len(counts):
+            top = np.argpartition(counts, -k)[-k:]
+        else:
+            top = np.arange(len(counts))
+        top = top[np.argsort(-counts[top], kind="stable")]
+        return [
+            NameCount(categories[i], int(counts[i])) for i in top
+            if counts[i] > 0
+        ]
+
+    def value_counts(self,
+                     column: str,
+                     mask: Optional[np.ndarray] = None) -> List[NameCount]:
+        """Every value of a column with its count, most common first."""
+        return self.top_k(column, None, mask)
+
+    def group_by(self,
+                 by: str,
+                 column: str,
+                 k: Optional[int] = 10) -> Dict[str, List[NameCount]]:
+        """For each value of the single column `by`, the top k values of
+        `column`. For instance group_by("sender_name", "domains") gives the
+        domains each sender targets most."""
+        by_codes, by_categories = self.single[by]
+        categories = self._categories(column)
+        if column in self.single:
+            groups, codes = by_codes, self.single[column][0]
+        else:
+            groups = by_codes[self._row_of_value(column)]
+            codes = self.multi[column][1]
+        present = (groups >= 0) & (codes >= 0)
+
+        # Count every (group, value) pair in one pass: sort the pairs combined
+        # into one number, then count the runs
+        pairs = np.sort(groups[present].astype(np.int64) * len(categories) +
+                        codes[present])
+        starts = np.flatnonzero(
+            np.concatenate(([True], pairs[1:] != pairs[:-1])))
+        pair_counts = np.diff(np.append(starts, len(pairs)))
+        pair_groups, pair_codes = np.divmod(pairs[starts], len(categories))
+
+        # Most common first within each group, ties in category order
+        order = np.lexsort((pair_codes, -pair_counts, pair_groups))
+        pair_groups = pair_groups[order]
+        group_starts = np.searchsorted(pair_groups, pair_groups)
+        keep = (np.arange(len(order)) - group_starts < k
+                if k is not None else np.ones(len(order), dtype=bool))
+
+        result: Dict[str, List[NameCount]] = {
+            name: []
+            for name in by_categories
+        }
+        for group, code, count in zip(pair_groups[keep].tolist(),
+                                      pair_codes[order][keep].tolist(),
+                                      pair_counts[order][keep].tolist()):
+            result[by_categories[group]].append(
+                NameCount(categories[code], count))
+        return result
+
+    def date_histogram(
+            self,
+            unit: str = "D",
+            column: str = "date_received",
+            mask: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Count notices per day ("D"), week ("W"), month ("M") or year ("Y").
+        Returns the bins as datetime64s and their counts, skipping empty
+        bins."""
+        dates = self.dates[column]
+        if mask is not None:
+            dates = dates[mask]
+        dates = dates[~np.isnat(dates)].astype(f"datetime64[{unit}]")
+        return np.unique(dates, return_counts=True)
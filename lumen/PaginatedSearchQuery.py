@@ -1,12 +1,14 @@
 import asyncio
 import itertools
 import sys
+from collections import deque
 from datetime import date
-from typing import List, Optional
+from typing import AsyncIterator, Deque, List, Optional
 
 from lumen.AsyncLumenAPIManager import AsyncLumenAPIManager
+from lumen.IdSet import IdSet
 from lumen.SearchQuery import AsyncSearchQuery, Sort
-from lumen.SearchResult import Notice
+from lumen.SearchResult import Notice, SearchResult, unique_notices
 from lumen.SearchTypes import Topic
 
 if sys.version_info >= (3, 11):
@@ -44,24 +46,64 @@ class PaginatedSearchQuery:
 
     # TODO: facet country code, language
 
-    async def search(self) -> List[Notice]:
+    async def search(self, dedupe: bool = True) -> List[Notice]:
         """Search and get the collected notices for the page range. Does not return
-        metadata or the raw queries."""
-        tasks = []
-
+        metadata or the raw queries. Notices that show up on two pages (new
+        notices arriving while paging push old ones onto the next page) are
+        only returned once, unless dedupe is False."""
+        # Every page is started at once: pages in the cache come back
+        # straight away, and the manager's rate limiter spaces out the pages
+        # that actually need a request
         # Since page_end is inclusive, we need to add 1
-        for page in range(self.page_start, self.page_end + 1):
-            # Make a copy of the query so the query can be changed and won't impact
-            # earlier tasks!
-            tasks.append(
-                asyncio.create_task(self.query.copy().with_page(page).search()))
-            # TODO: This is unfriendly for loading from cache. should maybe
-            # separate cache loading from requests and only sleep between requests
-            await asyncio.sleep(2)
-
-        data = await asyncio.gather(*tasks)
-
-        return list(itertools.chain.from_iterable(n.notices for n in data))
+        data = await asyncio.gather(*(
+            # Make a copy of the query so the query can be changed and won't
+            # impact earlier pages!
+            self.query.copy().with_page(page).search()
+            for page in range(self.page_start, self.page_end + 1)))
+
+        notices = itertools.chain.from_iterable(n.notices for n in data)
+        return list(unique_notices(notices) if dedupe else notices)
+
+    async def stream(self,
+                     prefetch: int = 4,
+                     dedupe: bool = True) -> AsyncIterator[Notice]:
+        """Yield the notices for the page range in order, as their pages come
+        in. Use with `async for notice in query.stream()`.
+
+        At most `prefetch` pages are requested ahead of the page being
+        consumed, and the next page is only requested once you move on to a
+        page, so memory stays constant no matter how big the page range is.
+        Like search, repeated notices are skipped unless dedupe is False."""
+        if prefetch < 1:
+            raise Exception("Must prefetch at least 1 page!")
+
+        pages = iter(range(self.page_start, self.page_end + 1))
+        seen = IdSet()
+        in_flight: Deque[asyncio.Task[SearchResult]] = deque()
+
+        def request_next_page() -> None:
+            page = next(pages, None)
+            if page is not None:
+                in_flight.append(
+                    asyncio.create_task(
+                        self.query.copy().with_page(page).search()))
+
+        try:
+            for _ in range(prefetch):
+                request_next_page()
+
+            while in_flight:
+                result = await in_flight.popleft()
+                request_next_page()
+                for notice in result.notices:
+                    if (not dedupe or notice.id is None
+                            or seen.add(notice.id)):
+                        yield notice
+        finally:
+            # The consumer stopped early (or a page failed), don't leave
+            # requests running in the background
+            for task in in_flight:
+                task.cancel()
 
     # Boilerplate, forwards calls to the inner query
 
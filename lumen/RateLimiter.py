@@ -0,0 +1,108 @@
+import asyncio
+import fcntl
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Tuple
+
+
+def _refill_and_take(tokens: float, updated: float, now: float, rate: float,
+                     burst: int) -> Tuple[float, float]:
+    """Work out a reservation against a bucket that had `tokens` tokens at
+    time `updated`. Returns the tokens left after taking one (negative when
+    callers are queued up waiting) and how long the caller has to wait."""
+    tokens = min(burst, tokens + (now - updated) * rate) - 1
+    return tokens, max(0.0, -tokens / rate)
+
+
+class TokenBucket:
+    """A token bucket rate limiter: requests can be made at `rate` per second
+    on average, with bursts of up to `burst` requests at once after being idle.
+
+    Each request reserves a token and then sleeps exactly as long as it takes
+    for that token to be refilled, so callers are never slept longer than
+    needed. It's thread-safe, and the same limiter can be used from asyncio
+    with acquire_async, so one limiter can be shared by several managers."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        if rate <= 0:
+            raise Exception("Rate must be positive!")
+        if burst < 1:
+            raise Exception("Burst must be at least 1!")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, returning how many seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens, delay = _refill_and_take(self._tokens,
+                                                   self._updated, now,
+                                                   self.rate, self.burst)
+            self._updated = now
+            return delay
+
+    def acquire(self) -> float:
+        """Block until a request can be made, returning how long we slept."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    async def acquire_async(self) -> float:
+        """Wait (without blocking the event loop) until a request can be made,
+        returning how long we slept."""
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+
+class Unlimited(TokenBucket):
+    """A rate limiter that never makes anyone wait."""
+
+    def __init__(self):
+        super().__init__(rate=1)
+
+    def reserve(self) -> float:
+        return 0.0
+
+
+class SharedTokenBucket(TokenBucket):
+    """A TokenBucket whose state lives in a file, so every process using the
+    same file shares one budget. The file is locked with flock while a token is
+    taken, which only takes a moment, so processes never hold it while
+    sleeping. Processes must agree on rate and burst."""
+
+    def __init__(self, path: Path, rate: float, burst: int = 1):
+        super().__init__(rate, burst)
+        self.path = path
+        self.path.touch(exist_ok=True)
+
+    def reserve(self) -> float:
+        # The thread lock keeps threads in this process off the file while we
+        # hold it, the file lock keeps other processes off
+        with self._lock, self.path.open("r+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                # time.time as monotonic clocks aren't shared across processes
+                now = time.time()
+                contents = file.read()
+                if contents:
+                    state = json.loads(contents)
+                    tokens, updated = state["tokens"], state["updated"]
+                else:
+                    tokens, updated = float(self.burst), now
+                tokens, delay = _refill_and_take(tokens, updated, now,
+                                                 self.rate, self.burst)
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps({"tokens": tokens, "updated": now}))
+                file.flush()
+                return delay
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
@@ -0,0 +1,165 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import FrozenSet, Optional
+
+import httpx
+
+# Responses worth trying again: rate limited, or the server having a bad time
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request while Lumen looks to be down."""
+    pass
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How many times to try a request, and how long to back off between
+    tries. Backoff is exponential with full jitter (a random delay between 0
+    and base_delay * 2^attempt, capped at max_delay), unless the server sent a
+    Retry-After header, which is followed instead."""
+    max_attempts: int = 5
+    base_delay: float = 1
+    max_delay: float = 60
+    statuses: FrozenSet[int] = RETRY_STATUSES
+
+    def backoff(self, attempt: int) -> float:
+        """How long to wait after the attempt'th try (starting at 0) failed."""
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def delay(self, attempt: int,
+              response: Optional[httpx.Response] = None) -> float:
+        """How long to wait before retrying, honoring Retry-After."""
+        if response is not None:
+            after = retry_after(response)
+            if after is not None:
+                return min(after, self.max_delay)
+        return self.backoff(attempt)
+
+
+def retry_after(response: httpx.Response) -> Optional[float]:
+    """The number of seconds a Retry-After header asks us to wait, if any.
+    It can be either a number of seconds or an HTTP date."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class CircuitBreaker:
+    """Stops requests for a while after too many failures in a row, so a crawl
+    waits out an outage instead of burning through its retries. After
+    reset_timeout seconds one request is let through to test the waters
+    (others are still turned away meanwhile): if it succeeds requests resume,
+    otherwise the breaker opens again. A trial that never reports back is
+    given up on after another reset_timeout, and a new one is let through."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        # When the trial request was let through, if one is out
+        self._trial_at: Optional[float] = None
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    def remaining(self) -> float:
+        """Seconds until the breaker lets a request through again."""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0,
+                   self.opened_at + self.reset_timeout - time.monotonic())
+
+    def check(self) -> None:
+        """Raise CircuitOpenError if requests are currently blocked."""
+        if self.opened_at is None:
+            return
+        remaining = self.remaining()
+        if remaining > 0:
+            raise CircuitOpenError(
+                f"Lumen looks to be down after {self.failures} failures, "
+                f"try again in {remaining:.0f} seconds")
+        now = time.monotonic()
+        if (self._trial_at is not None
+                and now - self._trial_at < self.reset_timeout):
+            raise CircuitOpenError(
+                "Lumen looks to be down, waiting to see if a trial request "
+                "gets through")
+        # Half open: this request is the trial, its outcome decides
+        self._trial_at = now
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._trial_at is not None or \
+                self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._trial_at = None
+
+
+class AdaptiveConcurrency:
+    """Limits how many requests are in flight at once, adjusting the limit
+    AIMD-style like TCP: every healthy response raises it a little (by about
+    one per limit's worth of responses), and every 429 halves it. That way we
+    settle at the most concurrency Lumen will put up with. Use it as
+    `async with concurrency:` around a request."""
+
+    def __init__(self,
+                 initial: int = 4,
+                 minimum: int = 1,
+                 maximum: int = 32,
+                 decrease: float = 0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        self._condition: Optional[asyncio.Condition] = None
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # Made lazily so it's created inside the running event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def __aenter__(self) -> "AdaptiveConcurrency":
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback) -> None:
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self) -> None:
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_throttle(self) -> None:
+        self.limit = max(self.minimum, self.limit * self.decrease)
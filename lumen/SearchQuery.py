@@ -1,10 +1,14 @@
 import sys
+import time
 from datetime import date, datetime
-from typing import Dict, Optional
+from functools import partial
+from typing import AsyncIterator, Dict, Iterator, Optional, Union
 
 from lumen.AsyncLumenAPIManager import AsyncLumenAPIManager
+from lumen.CacheBackend import canonical_params as canonicalize
 from lumen.LumenAPIManager import LumenAPIManager
-from lumen.SearchResult import SearchResult
+from lumen.SearchResult import (CompactNotice, Notice, SearchResult,
+                                StringPool, notice_from_data)
 from lumen.SearchTypes import Topic
 
 if sys.version_info >= (3, 11):
@@ -121,8 +125,8 @@ class SearchQueryCore:
     def with_amount(self, num_of_entries: int) -> Self:
         """Set the amount of results you will get. Cannot go past 10000."""
         if num_of_entries > 10000:
-            # Todo: We can paginate (request a page of 10000 entries, then
-            # the next page of 10000 entries, etc)
+            # To get more, paginate with PaginatedSearchQuery, or use
+            # ShardPlanner to get past Lumen's limit on total results
             raise Exception("Requested too many entries!")
         self.params["per_page"] = str(num_of_entries)
         return self
@@ -153,6 +157,12 @@ class SearchQueryCore:
         self.params["date_received_facet"] = f"{to_epoch(d1)}..{to_epoch(d2)}"
         return self
 
+    def canonical_params(self) -> Dict[str, str]:
+        """The params in the standard form they're requested and cached with,
+        so equivalent queries (say a topic given as a Topic or a string, or
+        with page 1 set or not) come out the same."""
+        return canonicalize("/notices/search.json", self.params)
+
     # TODO: facet country code, language
 
 
@@ -166,7 +176,31 @@ class SearchQuery(SearchQueryCore):
         if len(self.params) == 0:
             raise Exception("No search parameters!")
         data = self.manager._req("/notices/search.json", self.params)
-        return SearchResult(data)
+        start = time.perf_counter()
+        result = SearchResult(data)
+        self.manager.hooks.on_parse(len(result.notices),
+                                    time.perf_counter() - start)
+        return result
+
+    def stream(
+            self,
+            compact: bool = False) -> Iterator[Union[Notice, CompactNotice]]:
+        """Like search, but yields the notices one at a time as the page is
+        downloaded, so even a page of 10000 never has to be in memory all at
+        once. There's no metadata this way, use search for that."""
+        if len(self.params) == 0:
+            raise Exception("No search parameters!")
+        # A pool for this page's names, freed along with it
+        parse = (partial(CompactNotice, pool=StringPool())
+                 if compact else notice_from_data)
+        count, seconds = 0, 0.0
+        for data in self.manager._stream("/notices/search.json", self.params):
+            start = time.perf_counter()
+            notice = parse(data)
+            seconds += time.perf_counter() - start
+            count += 1
+            yield notice
+        self.manager.hooks.on_parse(count, seconds)
 
 
 class AsyncSearchQuery(SearchQueryCore):
@@ -179,7 +213,33 @@ class AsyncSearchQuery(SearchQueryCore):
         if len(self.params) == 0:
             raise Exception("No search parameters!")
         data = await self.manager._req("/notices/search.json", self.params)
-        return SearchResult(data)
+        start = time.perf_counter()
+        result = SearchResult(data)
+        self.manager.hooks.on_parse(len(result.notices),
+                                    time.perf_counter() - start)
+        return result
+
+    async def stream(
+            self,
+            compact: bool = False
+    ) -> AsyncIterator[Union[Notice, CompactNotice]]:
+        """Like search, but yields the notices one at a time as the page is
+        downloaded, so even a page of 10000 never has to be in memory all at
+        once. There's no metadata this way, use search for that."""
+        if len(self.params) == 0:
+            raise Exception("No search parameters!")
+        # A pool for this page's names, freed along with it
+        parse = (partial(CompactNotice, pool=StringPool())
+                 if compact else notice_from_data)
+        count, seconds = 0, 0.0
+        async for data in self.manager._stream("/notices/search.json",
+                                               self.params):
+            start = time.perf_counter()
+            notice = parse(data)
+            seconds += time.perf_counter() - start
+            count += 1
+            yield notice
+        self.manager.hooks.on_parse(count, seconds)
 
     def copy(self) -> Self:
         new = self.__class__(self.manager)
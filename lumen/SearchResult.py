@@ -1,9 +1,16 @@
-import json
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
+from datetime import date
+from itertools import islice
 from pathlib import Path
-from typing import Any, Counter, Dict, List, NamedTuple, Optional
+from typing import (Any, Counter, Deque, Dict, FrozenSet, Iterable, Iterator,
+                    List, NamedTuple, Optional, Tuple, Union)
 from urllib.parse import urlparse
 
+from lumen.CacheBackend import CacheBackend, open_cache
+from lumen.IdSet import IdSet
 from lumen.SearchTypes import NoticeType, Topic
 
 
@@ -26,6 +33,8 @@ class Notice:
     body: Optional[str]
     language: Optional[str]
     action_taken: Optional[str]  # Yes, No, Partial, or blank
+    # Lumen's id for the notice, the same wherever it shows up
+    id: Optional[int] = None
 
     # There are more fields, but this will get us started
     # https://github.com/berkmancenter/lumendatabase/wiki/Lumen-API-documentation#request
@@ -33,6 +42,7 @@ class Notice:
 
 def notice_from_data(data: Dict[str, Any]) -> Notice:
     return Notice(
+        id=data.get('id'),
         title=data['title'],
         type=NoticeType(data['type'].lower()),
         sender_name=data['sender_name'],
@@ -59,6 +69,136 @@ def notice_from_data(data: Dict[str, Any]) -> Notice:
         ])
 
 
+def notice_from_response(data: Dict[str, Any]) -> Notice:
+    """Parse a get_notice response, which has the notice under a single root
+    key naming its type (like {"dmca": {...}})."""
+    notice_type, notice = next(iter(data.items()))
+    if 'type' not in notice:
+        notice = dict(notice, type=notice_type)
+    return notice_from_data(notice)
+
+
+class StringPool:
+    """Hands out a single shared copy of each string it's given, so names that
+    show up on thousands of notices are only stored once. It keeps every
+    string it's seen, so give each batch of notices its own."""
+
+    def __init__(self) -> None:
+        self.strings: Dict[str, str] = {}
+
+    def intern(self, s: Optional[str]) -> Optional[str]:
+        if s is None:
+            return None
+        return self.strings.setdefault(s, s)
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+
+def _same(s: Optional[str]) -> Optional[str]:
+    return s
+
+
+class CompactNotice:
+    """A lighter version of Notice with the same attributes. Repeated strings
+    (names, tags...) are interned through pool if given, the raw notice JSON
+    is referenced rather than copied, and infringing_urls and works are only
+    parsed the first time they're accessed (subject and body are read from the
+    raw JSON). Use this when loading lots of notices, and to_notice() if you
+    need a real Notice."""
+    __slots__ = ("raw", "id", "title", "type", "sender_name", "recipient_name",
+                 "principal_name", "date_sent", "date_received", "topics",
+                 "tags", "jurisdictions", "language", "action_taken",
+                 "_infringing_urls", "_works")
+
+    raw: Dict[str, Any]
+    id: Optional[int]
+    title: str
+    type: NoticeType
+    sender_name: str
+    recipient_name: str
+    principal_name: Optional[str]
+    date_sent: str
+    date_received: str
+    topics: Tuple[Topic, ...]
+    tags: Tuple[str, ...]
+    jurisdictions: Tuple[str, ...]
+    language: Optional[str]
+    action_taken: Optional[str]
+
+    def __init__(self,
+                 data: Dict[str, Any],
+                 pool: Optional[StringPool] = None):
+        intern = pool.intern if pool is not None else _same
+        set_ = object.__setattr__
+        set_(self, "raw", data)
+        set_(self, "id", data.get('id'))
+        # Titles are nearly all different, interning them would only grow
+        # the pool
+        set_(self, "title", data['title'])
+        set_(self, "type", NoticeType(data['type'].lower()))
+        set_(self, "sender_name", intern(data['sender_name']))
+        set_(self, "recipient_name", intern(data['recipient_name']))
+        set_(self, "principal_name", intern(data.get('principal_name')))
+        set_(self, "date_sent", data['date_sent'])
+        set_(self, "date_received", data['date_received'])
+        set_(self, "topics", tuple(Topic(t) for t in data['topics']))
+        set_(self, "tags", tuple(intern(tag) for tag in data['tags']))
+        set_(self, "jurisdictions",
+            tuple(intern(j) for j in data['jurisdictions']))
+        set_(self, "language", intern(data['language']))
+        set_(self, "action_taken", intern(data['action_taken']))
+        set_(self, "_infringing_urls", None)
+        set_(self, "_works", None)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("CompactNotice is immutable")
+
+    @property
+    def subject(self) -> Optional[str]:
+        return self.raw.get('subject')
+
+    @property
+    def body(self) -> Optional[str]:
+        return self.raw.get('body')
+
+    @property
+    def infringing_urls(self) -> Counter[str]:
+        if self._infringing_urls is None:
+            object.__setattr__(
+                self, "_infringing_urls",
+                Counter([
+                    url for work in self.raw.get('works', [])
+                    for urlJSON in work.get('infringing_urls', [])
+                    if (url := urlparse(urlJSON['url']).netloc)
+                ]))
+        return self._infringing_urls
+
+    @property
+    def works(self) -> List[str]:
+        if self._works is None:
+            object.__setattr__(self, "_works", [
+                work['description'].rstrip()
+                for work in self.raw.get('works', [])
+                if 'description' in work and work['description'] is not None
+            ])
+        return self._works
+
+    def to_notice(self) -> Notice:
+        return notice_from_data(self.raw)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CompactNotice):
+            return NotImplemented
+        return self.raw == other.raw
+
+    def __repr__(self) -> str:
+        return (f"CompactNotice(id={self.id!r}, title={self.title!r}, "
+                f"type={self.type!r}, "
+                f"sender_name={self.sender_name!r}, "
+                f"date_received={self.date_received!r})")
+
+
 class NameCount(NamedTuple):
     name: str
     instances: int
@@ -106,27 +246,159 @@ def meta_from_facets(facets: Dict[str, Any]) -> Metadata:
 
 
 class SearchResult:
-    notices: List[Notice]
+    notices: Union[List[Notice], List[CompactNotice]]
     metadata: Metadata
-    raw: Dict[str, Any]
+    # How many notices match the query across every page, if Lumen told us
+    total_entries: Optional[int]
+    # The response, unless keep_raw was False
+    raw: Optional[Dict[str, Any]]
 
-    def __init__(self, data: Dict[str, Any]):
-        self.notices = [notice_from_data(notice) for notice in data['notices']]
+    def __init__(self,
+                 data: Dict[str, Any],
+                 compact: bool = False,
+                 keep_raw: bool = True):
+        """Parse a search response. With compact set, the notices are
+        CompactNotices, which are smaller and faster to build. Set keep_raw to
+        False to let the response be freed once it's parsed (CompactNotices
+        still hold on to their own part of it)."""
+        if compact:
+            pool = StringPool()
+            self.notices = [
+                CompactNotice(notice, pool) for notice in data['notices']
+            ]
+        else:
+            self.notices = [
+                notice_from_data(notice) for notice in data['notices']
+            ]
         self.metadata = meta_from_facets(data["meta"]["facets"])
-        self.raw = data
+        self.total_entries = data["meta"].get("total_entries")
+        self.raw = data if keep_raw else None
+
+
+@dataclass(frozen=True)
+class NoticeFilter:
+    """Which notices to keep when loading a cache. Checked against the raw JSON
+    before a Notice is built, so skipped notices cost almost nothing. Any field
+    left as None doesn't filter."""
+    types: Optional[FrozenSet[NoticeType]] = None
+    # Keeps notices with at least one of these topics
+    topics: Optional[FrozenSet[Topic]] = None
+    # Both ends are inclusive, compared against date_received
+    date_range: Optional[Tuple[date, date]] = None
+
+    def matches(self, data: Dict[str, Any]) -> bool:
+        if self.types is not None and data['type'].lower() not in self.types:
+            return False
+        if self.topics is not None and self.topics.isdisjoint(data['topics']):
+            return False
+        if self.date_range is not None:
+            # Dates come in as ISO 8601 timestamps, the day is the first part
+            received = date.fromisoformat(data['date_received'][:10])
+            if not self.date_range[0] <= received <= self.date_range[1]:
+                return False
+        return True
+
+
+def _notices_in(data: Dict[str, Any],
+                notice_filter: Optional[NoticeFilter]) -> Iterator[Notice]:
+    for notice in data.get('notices', []):
+        if notice_filter is None or notice_filter.matches(notice):
+            yield notice_from_data(notice)
+
+
+def unique_notices(notices: Iterable[Notice]) -> Iterator[Notice]:
+    """Drop notices whose id has already come up, like the same notice on two
+    overlapping pages or in two cached queries. Notices without an id are
+    always kept."""
+    seen = IdSet()
+    for notice in notices:
+        if notice.id is None or seen.add(notice.id):
+            yield notice
+
+
+def iter_cache_entries(cache: Union[Path, CacheBackend],
+                       notice_filter: Optional[NoticeFilter] = None,
+                       dedupe: bool = False) -> Iterator[Notice]:
+    """Lazily yields every notice in a cache, one cache entry at a time, so
+    only one response is held in memory at once. With dedupe set, a notice
+    cached by several queries is only yielded the first time."""
+    backend = open_cache(cache)
+    assert backend is not None
+
+    notices = (notice for _, data in backend.items()
+               for notice in _notices_in(data, notice_filter))
+    yield from unique_notices(notices) if dedupe else notices
+
+
+def _load_chunk(backend: CacheBackend, hash_keys: List[str],
+                notice_filter: Optional[NoticeFilter]) -> List[Notice]:
+    """Runs in a worker process: parse the notices for a chunk of entries."""
+    notices: List[Notice] = []
+    for hash_key in hash_keys:
+        data = backend.get(hash_key)
+        if data is not None:
+            notices.extend(_notices_in(data, notice_filter))
+    backend.close()
+    return notices
+
+
+def iter_cache_entries_parallel(cache: Union[Path, CacheBackend],
+                                notice_filter: Optional[NoticeFilter] = None,
+                                max_workers: Optional[int] = None,
+                                chunksize: int = 64,
+                                dedupe: bool = False) -> Iterator[Notice]:
+    """Like iter_cache_entries, but the entries are split into chunks of
+    chunksize and loaded and parsed by a pool of processes (one per core by
+    default). Notices are yielded a chunk at a time as chunks finish, in the
+    same order as iter_cache_entries. Only a couple of chunks per worker are
+    in flight at once, so memory stays bounded. Deduping happens here as the
+    chunks come back, since it needs to see every id."""
+    if dedupe:
+        yield from unique_notices(
+            iter_cache_entries_parallel(cache, notice_filter, max_workers,
+                                        chunksize))
+        return
+
+    backend = open_cache(cache)
+    assert backend is not None
+    hash_keys = backend.keys()
+    max_workers = max_workers or os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        in_flight: Deque[Future[List[Notice]]] = deque()
+
+        def submit_next() -> bool:
+            chunk = list(islice(hash_keys, chunksize))
+            if chunk:
+                in_flight.append(
+                    executor.submit(_load_chunk, backend, chunk,
+                                    notice_filter))
+            return bool(chunk)
 
+        # Keep every worker busy with one chunk queued behind it
+        for _ in range(2 * max_workers):
+            if not submit_next():
+                break
 
-def load_all_cache_entries(cache: Path) -> List[Notice]:
-    """Loads all .json files from a cache and collects all of their entries
-    into a list."""
-    entries: List[Notice] = []
+        while in_flight:
+            notices = in_flight.popleft().result()
+            submit_next()
+            yield from notices
 
-    for file in cache.iterdir():
-        if file.suffix == ".json":
-            with file.open() as input:
-                data = json.load(input)
-                entries.extend(
-                    notice_from_data(notice)
-                    for notice in data.get('notices', []))
 
-    return entries
+def load_all_cache_entries(cache: Union[Path, CacheBackend],
+                           notice_filter: Optional[NoticeFilter] = None,
+                           parallel: bool = False,
+                           max_workers: Optional[int] = None,
+                           chunksize: int = 64,
+                           dedupe: bool = False) -> List[Notice]:
+    """Loads all entries from a cache (a cache folder, a .sqlite cache file, or
+    a CacheBackend) and collects all of their notices into a list. Set parallel
+    to True to parse with a process pool, see iter_cache_entries_parallel, and
+    dedupe to only keep one copy of notices cached by more than one request.
+    If you don't need everything at once, use the iter_ functions instead."""
+    if parallel:
+        return list(
+            iter_cache_entries_parallel(cache, notice_filter, max_workers,
+                                        chunksize, dedupe))
+    return list(iter_cache_entries(cache, notice_filter, dedupe))
@@ -0,0 +1,111 @@
+import asyncio
+import itertools
+import logging
+import math
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import List, Optional
+
+from lumen.AsyncLumenAPIManager import AsyncLumenAPIManager
+from lumen.PaginatedSearchQuery import PaginatedSearchQuery
+from lumen.SearchQuery import AsyncSearchQuery, SearchQueryCore
+from lumen.SearchResult import Notice, unique_notices
+
+# Lumen (well, the Elasticsearch behind it) won't page past this many results
+RESULT_WINDOW = 10000
+# The earliest notices in Lumen are from when it was Chilling Effects
+EARLIEST_DATE = date(2001, 1, 1)
+
+
+@dataclass(frozen=True)
+class Shard:
+    """A date range of a query, small enough to page through completely."""
+    start: date
+    end: date
+    total_entries: int
+
+    def pages(self, per_page: int, window: int = RESULT_WINDOW) -> int:
+        """How many pages of per_page it takes to get the shard's results."""
+        return max(1, math.ceil(min(self.total_entries, window) / per_page))
+
+
+class ShardPlanner:
+    """Get every result of a query, even past the 10000 result window Lumen
+    lets you page through. The query's date range is split in half until each
+    piece has fewer results than the window, then each piece is paged through
+    concurrently.
+
+        notices = await ShardPlanner(api, SearchQuery(...).with_topic(...))
+            .search()
+
+    Any date range already on the query is replaced by start..end."""
+
+    def __init__(self,
+                 manager: AsyncLumenAPIManager,
+                 query: SearchQueryCore,
+                 start: date = EARLIEST_DATE,
+                 end: Optional[date] = None,
+                 window: int = RESULT_WINDOW):
+        # Copy the params over so any kind of query can be planned (and so
+        # changing it afterwards doesn't change the plan)
+        self.query = AsyncSearchQuery(manager)
+        self.query.params = query.params.copy()
+        self.manager = manager
+        self.start = start
+        # Date ranges end at the start of the last day, so go one past today
+        self.end = end or date.today() + timedelta(days=1)
+        self.window = window
+
+    async def _count(self, start: date, end: date) -> int:
+        """Ask Lumen how many results the query has in a date range."""
+        result = await self.query.copy().with_date_range(
+            start, end).with_amount(1).with_page(1).search()
+        if result.total_entries is None:
+            raise Exception("Lumen didn't say how many results there are!")
+        return result.total_entries
+
+    async def _split(self, start: date, end: date,
+                     total: int) -> List[Shard]:
+        if total <= self.window:
+            return [Shard(start, end, total)] if total else []
+
+        if end - start <= timedelta(days=1):
+            # Date ranges are by day, so we can't split any further
+            logging.warning(
+                "%d results on %s, only the first %d will be fetched", total,
+                start, self.window)
+            return [Shard(start, end, total)]
+
+        middle = start + (end - start) // 2
+        counts = await asyncio.gather(self._count(start, middle),
+                                      self._count(middle, end))
+        halves = await asyncio.gather(self._split(start, middle, counts[0]),
+                                      self._split(middle, end, counts[1]))
+        return halves[0] + halves[1]
+
+    async def plan(self) -> List[Shard]:
+        """Split the query into shards that each fit in the result window,
+        oldest first."""
+        total = await self._count(self.start, self.end)
+        shards = await self._split(self.start, self.end, total)
+        logging.info("Split %d results into %d shards", total, len(shards))
+        return shards
+
+    def paginate(self, shard: Shard) -> PaginatedSearchQuery:
+        """A PaginatedSearchQuery for all of a shard's pages."""
+        per_page = int(self.query.params.get("per_page", 100))
+        paginated = PaginatedSearchQuery(self.manager).with_page_range(
+            1, shard.pages(per_page, self.window))
+        paginated.query = self.query.copy().with_amount(
+            per_page).with_date_range(shard.start, shard.end)
+        return paginated
+
+    async def search(self) -> List[Notice]:
+        """Plan the shards and fetch every page of every shard concurrently
+        (the manager's rate limiter spaces out the requests). Shards that
+        share a boundary can both return notices received exactly at midnight
+        on that day, those are only returned once."""
+        shards = await self.plan()
+        data = await asyncio.gather(
+            *(self.paginate(shard).search() for shard in shards))
+        return list(unique_notices(itertools.chain.from_iterable(data)))
@@ -0,0 +1,162 @@
+import codecs
+import json
+from typing import Any, Dict, List
+
+_WHITESPACE = " \t\n\r"
+
+
+class StreamParser:
+    """Parses a JSON object that arrives in chunks, like a search response
+    being downloaded, handing back the items of one array in it (the notices,
+    by default) as soon as each one is complete. Only one item and one chunk
+    are held at a time, however big the array is.
+
+        parser = StreamParser()
+        for chunk in chunks:
+            for notice in parser.feed(chunk):
+                ...
+        parser.close()
+        parser.rest["meta"]  # everything besides the array
+
+    Items are parsed with json.JSONDecoder.raw_decode straight out of the
+    buffered text. An item that hasn't all arrived yet is only tried again
+    once the text waiting to be parsed has doubled, so even an item of
+    megabytes arriving a few kilobytes at a time is decoded a handful of
+    times, not once per chunk."""
+
+    def __init__(self, key: str = "notices"):
+        self.key = key
+        # The rest of the object's keys, once they've been parsed
+        self.rest: Dict[str, Any] = {}
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        # Text that's arrived since the last parse, joined onto the buffer
+        # once there's enough of it to be worth parsing again
+        self._pending: List[str] = []
+        self._pending_size = 0
+        self._wanted = 0
+        # What comes next: the object, a key (first_key, or next_key after a
+        # comma), an item of the array (first_item, item, or next_item after
+        # a comma), or nothing
+        self._state = "start"
+
+    def _next(self) -> None:
+        """Skip to the next token, raising EOFError if the buffer runs out."""
+        while self._pos < len(self._buffer):
+            if self._buffer[self._pos] not in _WHITESPACE:
+                return
+            self._pos += 1
+        raise EOFError
+
+    def _decode(self, final: bool) -> Any:
+        """Decode the value at the current position, raising EOFError if it
+        might not have fully arrived yet."""
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            raise EOFError
+        if not final and not isinstance(value, (dict, list, str)):
+            # A number could carry on in the next chunk (1 might be 1.5), so
+            # it's only complete once whatever comes after it has arrived
+            after = end
+            while (after < len(self._buffer)
+                   and self._buffer[after] in _WHITESPACE):
+                after += 1
+            if after == len(self._buffer) or self._buffer[after] not in ",]}":
+                raise EOFError
+        self._pos = end
+        return value
+
+    def _expect(self, char: str) -> None:
+        if self._buffer[self._pos] != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self._buffer,
+                                       self._pos)
+        self._pos += 1
+
+    def _key_value(self, final: bool) -> None:
+        """Parse a key and its value, or a key and the start of the array."""
+        if self._state == "next_key":
+            self._expect(",")
+            self._next()
+        key = self._decode(final)
+        self._next()
+        self._expect(":")
+        self._next()
+        if key == self.key and self._buffer[self._pos] == "[":
+            self._pos += 1
+            self._state = "first_item"
+        else:
+            self.rest[key] = self._decode(final)
+            self._state = "next_key"
+
+    def _parse(self, final: bool) -> List[Any]:
+        self._buffer += "".join(self._pending)
+        self._pending.clear()
+        self._pending_size = 0
+        items = []
+        incomplete = False
+        try:
+            while self._state != "done":
+                self._next()
+                char = self._buffer[self._pos]
+
+                if self._state == "start":
+                    self._expect("{")
+                    self._state = "first_key"
+                elif self._state in ("first_key", "next_key"):
+                    if char == "}":
+                        self._pos += 1
+                        self._state = "done"
+                        continue
+                    # Go back to the start of the key if anything up to the
+                    # start of the array (or the end of the value) is missing
+                    start = self._pos
+                    try:
+                        self._key_value(final)
+                    except EOFError:
+                        self._pos = start
+                        raise
+                elif char == "]" and self._state != "item":
+                    self._pos += 1
+                    self._state = "next_key"
+                elif self._state == "next_item":
+                    self._expect(",")
+                    self._state = "item"
+                else:
+                    items.append(self._decode(final))
+                    self._state = "next_item"
+        except EOFError:
+            if final:
+                raise json.JSONDecodeError("Unexpected end of response",
+                                           self._buffer, self._pos)
+            incomplete = True
+        # Drop what's been parsed so the buffer stays small
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        self._wanted = 2 * len(self._buffer) if incomplete else 0
+        return items
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        """Add the next chunk of the response, returning the array's items
+        that are now complete."""
+        text = self._text.decode(chunk)
+        self._pending.append(text)
+        self._pending_size += len(text)
+        if len(self._buffer) + self._pending_size < self._wanted:
+            return []
+        return self._parse(final=False)
+
+    def close(self) -> List[Any]:
+        """Finish parsing once the response has all arrived, returning any
+        last items. Raises json.JSONDecodeError if the response was cut off
+        or isn't valid JSON."""
+        self._pending.append(self._text.decode(b"", final=True))
+        items = self._parse(final=True)
+        if self._state != "done":
+            raise json.JSONDecodeError("Unexpected end of response",
+                                       self._buffer, self._pos)
+        return items